@@ -0,0 +1,317 @@
+"""
+    Reynir: Natural language processing for Icelandic
+
+    Admission control for model server calls
+
+    Copyright (C) 2020 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    Caps the segments and subword tokens in flight to the model server
+    per model.  A request that does not fit waits in a bounded FIFO queue
+    for at most max_wait_ms (or until its own deadline); when the queue is
+    full the request is rejected at once with 429, and when its wait runs
+    out with 503, both with a Retry-After hint, instead of piling up until
+    the worker timeout.
+
+    Clients may send a deadline as an X-Request-Timeout header or a
+    "timeout" field, in seconds.  Work whose deadline has passed is
+    never sent to the model server.
+
+"""
+
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+
+class Rejected(Exception):
+    """ A request that was not admitted, with the HTTP status and
+        Retry-After seconds to answer with """
+
+    def __init__(self, reason, status=503, retry_after=1):
+        super().__init__(reason)
+        self.reason = reason
+        self.status = status
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Rejected):
+    """ The client deadline passed before the work was sent """
+
+    def __init__(self, retry_after=1):
+        super().__init__("Deadline exceeded", status=503, retry_after=retry_after)
+
+
+def deadline_from(timeout):
+    """ Monotonic deadline for a client timeout in seconds, or None """
+    if timeout in (None, ""):
+        return None
+    return time.monotonic() + float(timeout)
+
+
+def remaining(deadline):
+    """ Seconds left until the deadline, None if there is none """
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def check(deadline):
+    """ Raise DeadlineExceeded if the deadline has passed """
+    if deadline is not None and time.monotonic() >= deadline:
+        raise DeadlineExceeded()
+
+
+class _Waiter:
+    """ Place in line of an admit_async call, woken from any thread """
+
+    __slots__ = ("loop", "event")
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(self.event.set)
+
+
+class _Gate:
+    """ In flight totals and waiting requests of one model """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.segments = 0
+        self.tokens = 0
+        self.waiting = deque()
+        self.admitted = 0
+        self.rejected = 0
+        self.expired = 0
+
+
+class AdmissionController:
+    """ Per model caps on in flight segments and tokens, with a bounded
+        wait queue.  A cap of 0 disables it. """
+
+    def __init__(
+        self,
+        max_segments=None,
+        max_tokens=None,
+        max_queue=None,
+        max_wait_ms=None,
+        retry_after=None,
+    ):
+        env = os.environ.get
+        self.max_segments = int(
+            max_segments
+            if max_segments is not None
+            else env("NNSERVER_MAX_INFLIGHT_SEGMENTS", 0)
+        )
+        self.max_tokens = int(
+            max_tokens if max_tokens is not None else env("NNSERVER_MAX_INFLIGHT_TOKENS", 0)
+        )
+        self.max_queue = int(
+            max_queue if max_queue is not None else env("NNSERVER_ADMISSION_QUEUE", 64)
+        )
+        self.max_wait = (
+            float(
+                max_wait_ms
+                if max_wait_ms is not None
+                else env("NNSERVER_ADMISSION_WAIT_MS", 5000)
+            )
+            / 1000
+        )
+        self.retry_after = int(
+            retry_after if retry_after is not None else env("NNSERVER_RETRY_AFTER", 1)
+        )
+        self._lock = threading.Lock()
+        self._gates = {}
+
+    @property
+    def enabled(self):
+        return self.max_segments > 0 or self.max_tokens > 0
+
+    def _gate(self, model_name):
+        with self._lock:
+            gate = self._gates.get(model_name)
+            if gate is None:
+                gate = self._gates[model_name] = _Gate()
+            return gate
+
+    def _fits(self, gate, segments, tokens):
+        # A request over a cap on its own is admitted when nothing else is
+        # in flight, so that it cannot wait forever
+        if not gate.segments and not gate.tokens:
+            return True
+        if self.max_segments and gate.segments + segments > self.max_segments:
+            return False
+        if self.max_tokens and gate.tokens + tokens > self.max_tokens:
+            return False
+        return True
+
+    def _take(self, gate, segments, tokens):
+        gate.segments += segments
+        gate.tokens += tokens
+        gate.admitted += 1
+
+    @staticmethod
+    def _notify(gate):
+        """ Wake the waiters, called holding gate.cond.  Only the first in
+            line can be admitted, so of the async waiters only it is woken. """
+        gate.cond.notify_all()
+        if gate.waiting and isinstance(gate.waiting[0], _Waiter):
+            gate.waiting[0].wake()
+
+    def _release(self, gate, segments, tokens):
+        with gate.cond:
+            gate.segments -= segments
+            gate.tokens -= tokens
+            self._notify(gate)
+
+    def _enqueue(self, gate, ticket=None):
+        """ A place in line, called holding gate.cond """
+        if len(gate.waiting) >= self.max_queue:
+            gate.rejected += 1
+            raise Rejected("Too many requests", 429, self.retry_after)
+        ticket = ticket or object()
+        gate.waiting.append(ticket)
+        return ticket
+
+    def _dequeue(self, gate, ticket):
+        with gate.cond:
+            gate.waiting.remove(ticket)
+            self._notify(gate)
+
+    def _give_up(self, deadline):
+        give_up = time.monotonic() + self.max_wait
+        return give_up if deadline is None else min(give_up, deadline)
+
+    def _expire(self, gate, deadline):
+        gate.expired += 1
+        if deadline is not None and time.monotonic() >= deadline:
+            raise DeadlineExceeded(self.retry_after)
+        raise Rejected("Overloaded", 503, self.retry_after)
+
+    def _ready(self, gate, ticket, segments, tokens):
+        return gate.waiting[0] is ticket and self._fits(gate, segments, tokens)
+
+    @contextmanager
+    def admit(self, model_name, segments, tokens, deadline=None):
+        """ Hold segments and tokens of model_name in flight, waiting for
+            room if needed """
+        check(deadline)
+        if not self.enabled:
+            yield
+            return
+
+        gate = self._gate(model_name)
+        with gate.cond:
+            if not gate.waiting and self._fits(gate, segments, tokens):
+                self._take(gate, segments, tokens)
+            else:
+                ticket = self._enqueue(gate)
+                give_up = self._give_up(deadline)
+                try:
+                    while not self._ready(gate, ticket, segments, tokens):
+                        left = give_up - time.monotonic()
+                        if left <= 0:
+                            self._expire(gate, deadline)
+                        gate.cond.wait(left)
+                    self._take(gate, segments, tokens)
+                finally:
+                    gate.waiting.remove(ticket)
+                    self._notify(gate)
+        try:
+            yield
+        finally:
+            self._release(gate, segments, tokens)
+
+    @asynccontextmanager
+    async def admit_async(self, model_name, segments, tokens, deadline=None):
+        """ admit() for the event loop, which waits on an asyncio.Event that
+            releases set instead of blocking on the condition """
+        check(deadline)
+        if not self.enabled:
+            yield
+            return
+
+        gate = self._gate(model_name)
+        with gate.cond:
+            ticket = None
+            if not gate.waiting and self._fits(gate, segments, tokens):
+                self._take(gate, segments, tokens)
+            else:
+                ticket = self._enqueue(gate, _Waiter())
+        if ticket is not None:
+            give_up = self._give_up(deadline)
+            try:
+                while True:
+                    with gate.cond:
+                        if self._ready(gate, ticket, segments, tokens):
+                            self._take(gate, segments, tokens)
+                            break
+                        left = give_up - time.monotonic()
+                        if left <= 0:
+                            self._expire(gate, deadline)
+                        ticket.event.clear()
+                    try:
+                        await asyncio.wait_for(ticket.event.wait(), left)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                self._dequeue(gate, ticket)
+        try:
+            yield
+        finally:
+            self._release(gate, segments, tokens)
+
+    def stats(self):
+        with self._lock:
+            gates = list(self._gates.items())
+        return {
+            model_name: {
+                "inflight_segments": gate.segments,
+                "inflight_tokens": gate.tokens,
+                "waiting": len(gate.waiting),
+                "admitted": gate.admitted,
+                "rejected": gate.rejected,
+                "expired": gate.expired,
+            }
+            for (model_name, gate) in gates
+        }
+
+
+_CONTROLLER = None
+_CONTROLLER_LOCK = threading.Lock()
+
+
+def get_controller():
+    """ Return the process wide admission controller """
+    global _CONTROLLER
+    if _CONTROLLER is None:
+        with _CONTROLLER_LOCK:
+            if _CONTROLLER is None:
+                _CONTROLLER = AdmissionController()
+    return _CONTROLLER
+
+
+def configure(**kwargs):
+    """ Replace the process wide admission controller """
+    global _CONTROLLER
+    with _CONTROLLER_LOCK:
+        _CONTROLLER = AdmissionController(**kwargs)
+    return _CONTROLLER
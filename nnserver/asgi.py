@@ -0,0 +1,628 @@
+"""
+    Reynir: Natural language processing for Icelandic
+
+    Asynchronous (ASGI) serving mode
+
+    Copyright (C) 2020 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    This module serves /translate.api and /parse.api with the same request
+    and response contract as the Flask app in main.py, but as an asyncio
+    ASGI application.  Calls to the model server do not block a worker, so
+    a single process can keep hundreds of requests in flight.  Subword
+    encoding, length bucketing, decoding and cache I/O are CPU bound, so
+    they run in the default thread pool executor to keep the event loop
+    free; with --transport grpc each model server call runs the
+    synchronous gRPC path of main.py in that executor.
+
+    Example usage:
+    python main.py --asgi -lp 5005
+    gunicorn -k uvicorn.workers.UvicornWorker nnserver.asgi:app
+
+    Requires the optional aiohttp package (and uvicorn to run it), which
+    pip install nnserver[asgi] installs.
+
+"""
+
+import asyncio
+import contextlib
+import functools
+import time
+
+import aiohttp
+
+from nnserver import admission, cache, decoding, dispatch, grpc_client, http_pool
+from nnserver import metrics
+from nnserver import jsoncodec, segmentation, translation_memory
+from nnserver import main
+from nnserver.main import ParsingServer, translation_server
+from nnserver.request_log import new_request_id
+
+_RETRY_STATUS = (502, 503, 504)
+_JSON_CONTENT_TYPE = {"Content-Type": "application/json"}
+
+
+class ModelServerClient:
+    """ Shared aiohttp session with the connection limits, timeouts and
+        retry policy of the synchronous session pool """
+
+    def __init__(self, config=None):
+        self.config = config or http_pool.PoolConfig()
+        self._session = None
+
+    async def session(self):
+        if self._session is None or self._session.closed:
+            config = self.config
+            connector = aiohttp.TCPConnector(
+                limit_per_host=config.pool_size * 10,
+                force_close=not config.keepalive,
+            )
+            timeout = aiohttp.ClientTimeout(
+                sock_connect=config.connect_timeout, sock_read=config.read_timeout
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    async def post_json(self, url, body, timeout=None):
+        """ POST a JSON body, giving up after timeout seconds if given """
+        session = await self.session()
+        kwargs = {}
+        if timeout is not None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(
+                total=timeout, sock_connect=self.config.connect_timeout
+            )
+        attempt = 0
+        while True:
+            try:
+                async with session.post(
+                    url, data=body, headers=_JSON_CONTENT_TYPE, **kwargs
+                ) as resp:
+                    if resp.status in _RETRY_STATUS and attempt < self.config.retries:
+                        raise aiohttp.ClientResponseError(
+                            resp.request_info, resp.history, status=resp.status
+                        )
+                    resp.raise_for_status()
+                    return jsoncodec.loads(await resp.read())
+            except (aiohttp.ClientConnectorError, aiohttp.ClientResponseError) as error:
+                # Connect errors and gateway statuses only, as in http_pool; a
+                # read timeout or dropped response is not sent again
+                status = getattr(error, "status", None)
+                retryable = status is None or status in _RETRY_STATUS
+                if not retryable or attempt >= self.config.retries:
+                    raise
+                await asyncio.sleep(self.config.backoff * (2 ** attempt))
+                attempt += 1
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+client = ModelServerClient()
+
+
+async def in_executor(fn, *args, **kwargs):
+    """ Run a CPU bound call in the default executor, off the event loop """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(fn, *args, **kwargs))
+
+
+async def request_async(
+    server,
+    pgs,
+    tgt_pgs=None,
+    model_name=None,
+    deadline=None,
+    options=None,
+    encodings=None,
+):
+    """ Asynchronous counterpart of NnServer.request """
+    if model_name is None:
+        model_name = server._model_name
+    if encodings is None:
+        encodings = main.Encodings(server)
+    if options is not None and options.max_length:
+        keep, results = await in_executor(
+            server.within_length, pgs, tgt_pgs, options.max_length, encodings
+        )
+        if keep:
+            kept = await request_async(
+                server,
+                [pgs[idx] for idx in keep],
+                None if tgt_pgs is None else [tgt_pgs[idx] for idx in keep],
+                model_name=model_name,
+                deadline=deadline,
+                options=options._replace(max_length=None),
+                encodings=encodings,
+            )
+            for idx, result in zip(keep, kept):
+                results[idx] = result
+        return results
+
+    async def fetch(segments, tgt_segments=None):
+        return await _request_async(
+            server, segments, tgt_segments, model_name, deadline, options, encodings
+        )
+
+    default = options is None or options.default
+    memory = translation_memory.get_memory()
+    if server._reusable and tgt_pgs is None and default and memory.enabled:
+        model_fetch = fetch
+
+        async def fetch(segments, tgt_segments=None):
+            return await memory.lookup_async(model_name, segments, model_fetch)
+
+    segment_cache = cache.get_cache()
+    if server._cacheable and tgt_pgs is None and default and segment_cache.enabled:
+        return await segment_cache.lookup_async(model_name, pgs, fetch)
+    return await fetch(pgs, tgt_pgs)
+
+
+async def _send_chunk(
+    server,
+    pgs,
+    tgt_pgs,
+    model_name,
+    chunk,
+    limit,
+    deadline=None,
+    options=None,
+    encodings=None,
+):
+    sub_pgs = [pgs[idx] for idx in chunk]
+    sub_tgt_pgs = None if tgt_pgs is None else [tgt_pgs[idx] for idx in chunk]
+    if grpc_client.transport(main.app.config.get("transport")) == grpc_client.GRPC:
+        async with limit:
+            return await in_executor(
+                server._request_batch,
+                sub_pgs,
+                sub_tgt_pgs,
+                model_name=model_name,
+                deadline=deadline,
+                options=options,
+                encodings=encodings,
+            )
+    signature_name = decoding.get_config().signature(options)
+
+    def decode(obj):
+        results = server.extract_results(
+            obj,
+            sub_pgs,
+            tgt_pgs=sub_tgt_pgs,
+            src_enc=server.src_enc,
+            tgt_enc=server.tgt_enc,
+        )
+        return decoding.select(results, options)
+
+    async with limit:
+        admission.check(deadline)
+        metrics.observe_batch(model_name, len(sub_pgs))
+        start = time.perf_counter()
+        with metrics.timed("encode", model_name):
+            body = await in_executor(
+                server.package_body, sub_pgs, sub_tgt_pgs, signature_name, encodings
+            )
+        encoded = time.perf_counter()
+        replica, trial = server.choose_replica(model_name)
+        _, _, url = server.model_url(model_name, replica)
+        left = admission.remaining(deadline)
+        own_timeout = left is None or left >= client.config.read_timeout
+        with metrics.timed("model_server", model_name), replica.track(
+            own_timeout, trial
+        ):
+            obj = await client.post_json(url, body, timeout=left)
+        received = time.perf_counter()
+    with metrics.timed("decode", model_name):
+        results = await in_executor(decode, obj)
+    main.request_log.summary(
+        "batch",
+        model=model_name,
+        transport="rest",
+        replica="{}:{}".format(replica.host, replica.port),
+        segments=len(sub_pgs),
+        chars=sum(len(segment) for segment in sub_pgs),
+        encode_ms=round(1000 * (encoded - start), 2),
+        model_server_ms=round(1000 * (received - encoded), 2),
+        decode_ms=round(1000 * (time.perf_counter() - received), 2),
+    )
+    return results
+
+
+async def _request_async(
+    server, pgs, tgt_pgs, model_name, deadline=None, options=None, encodings=None
+):
+    dispatcher = dispatch.get_dispatcher()
+    if encodings is None:
+        encodings = main.Encodings(server)
+    lengths = await in_executor(server.segment_lengths, pgs, tgt_pgs, encodings)
+    controller = admission.get_controller()
+    async with controller.admit_async(model_name, len(pgs), sum(lengths), deadline):
+        chunks = await in_executor(
+            server.plan_chunks, pgs, tgt_pgs, dispatcher.chunk_size, model_name, lengths
+        )
+        limit = asyncio.Semaphore(max(dispatcher.max_workers, 1))
+
+        outcomes = await asyncio.gather(
+            *[
+                _send_chunk(
+                    server,
+                    pgs,
+                    tgt_pgs,
+                    model_name,
+                    chunk,
+                    limit,
+                    deadline,
+                    options,
+                    encodings,
+                )
+                for chunk in chunks
+            ],
+            return_exceptions=True,
+        )
+    return server.merge_chunks(len(pgs), chunks, outcomes)
+
+
+async def request_stream_async(
+    server, pgs, model_name=None, deadline=None, options=None, encodings=None
+):
+    """ Asynchronous counterpart of NnServer.request_stream """
+    if model_name is None:
+        model_name = server._model_name
+    if encodings is None:
+        encodings = main.Encodings(server)
+    if options is not None and options.max_length:
+        return _within_length_stream(
+            server, pgs, model_name, deadline, options, encodings
+        )
+    return _stream(server, pgs, model_name, deadline, options, encodings)
+
+
+async def _stream(server, pgs, model_name, deadline, options, encodings):
+    """ (index, result) pairs of request_stream_async, admitted before the
+        first one is yielded """
+    dispatcher = dispatch.get_dispatcher()
+
+    async def stream(segments, chunks):
+        limit = asyncio.Semaphore(max(dispatcher.max_workers, 1))
+
+        async def send(chunk):
+            try:
+                outcome = await _send_chunk(
+                    server,
+                    segments,
+                    None,
+                    model_name,
+                    chunk,
+                    limit,
+                    deadline,
+                    options,
+                    encodings,
+                )
+            except Exception as error:
+                outcome = server.chunk_error(chunk, error)
+            return chunk, outcome
+
+        tasks = [asyncio.ensure_future(send(chunk)) for chunk in chunks]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                chunk, outcome = await next_done
+                for idx, result in zip(chunk, outcome):
+                    yield idx, result
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    # Held until this generator finishes or is closed
+    async with contextlib.AsyncExitStack() as admitted:
+
+        async def fetch(segments):
+            """ Admit the segments now, and stream their results """
+            lengths = await in_executor(
+                server.segment_lengths, segments, encodings=encodings
+            )
+            controller = admission.get_controller()
+            await admitted.enter_async_context(
+                controller.admit_async(model_name, len(segments), sum(lengths), deadline)
+            )
+            chunks = await in_executor(
+                server.plan_chunks,
+                segments,
+                None,
+                dispatcher.chunk_size,
+                model_name,
+                lengths,
+            )
+            return stream(segments, chunks)
+
+        segment_cache = cache.get_cache()
+        default = options is None or options.default
+        if server._cacheable and default and segment_cache.enabled:
+            records = segment_cache.lookup_stream_async(model_name, pgs, fetch)
+        else:
+            records = await fetch(pgs)
+        async for idx, result in records:
+            yield idx, result
+
+
+async def _within_length_stream(server, pgs, model_name, deadline, options, encodings):
+    """ request_stream_async with the segments over max_length refused """
+    keep, results = await in_executor(
+        server.within_length, pgs, None, options.max_length, encodings
+    )
+    kept = set(keep)
+    refused = [(idx, result) for (idx, result) in enumerate(results) if idx not in kept]
+    if keep:
+        records = await request_stream_async(
+            server,
+            [pgs[idx] for idx in keep],
+            model_name=model_name,
+            deadline=deadline,
+            options=options._replace(max_length=None),
+            encodings=encodings,
+        )
+        async for idx, result in records:
+            yield keep[idx], result
+            # After the first result, once the request is admitted
+            for item in refused:
+                yield item
+            refused = []
+    for item in refused:
+        yield item
+
+
+async def started_async(records):
+    """ Asynchronous counterpart of main.started """
+    try:
+        first = await records.__anext__()
+    except StopAsyncIteration:
+        first = None
+
+    async def chained():
+        if first is not None:
+            yield first
+            async for record in records:
+                yield record
+
+    return chained()
+
+
+async def request_paragraphs_async(
+    server, pgs, segment=False, model_name=None, deadline=None, options=None
+):
+    """ Asynchronous counterpart of main.request_paragraphs """
+    if not segment:
+        return await request_async(
+            server, pgs, model_name=model_name, deadline=deadline, options=options
+        )
+    sentences, spans = segmentation.split_paragraphs(pgs)
+    results = []
+    if sentences:
+        results = await request_async(
+            server, sentences, model_name=model_name, deadline=deadline, options=options
+        )
+    return segmentation.join_paragraphs(results, spans)
+
+
+async def request_paragraphs_stream_async(
+    server, pgs, segment=False, model_name=None, deadline=None, options=None
+):
+    """ Asynchronous counterpart of main.request_paragraphs_stream """
+    if not segment:
+        records = await request_stream_async(
+            server, pgs, model_name=model_name, deadline=deadline, options=options
+        )
+        async for idx, result in records:
+            yield idx, result, None
+        return
+    sentences, spans = segmentation.split_paragraphs(pgs)
+    index = segmentation.paragraph_index(spans)
+    if sentences:
+        records = await request_stream_async(
+            server, sentences, model_name=model_name, deadline=deadline, options=options
+        )
+        async for flat_idx, result in records:
+            pg_idx, sent_idx = index[flat_idx]
+            yield pg_idx, result, sent_idx
+
+
+async def parse_api(obj, deadline=None):
+    return await request_paragraphs_async(
+        ParsingServer, obj["pgs"], segmentation.enabled(obj), deadline=deadline
+    )
+
+
+async def translate_api(obj, deadline=None):
+    server, model_name = translation_server(obj)
+    segment = segmentation.enabled(obj)
+    options = decoding.options_from(obj)
+    if obj.get("stream"):
+        return request_paragraphs_stream_async(
+            server,
+            obj["pgs"],
+            segment,
+            model_name=model_name,
+            deadline=deadline,
+            options=options,
+        )
+    return await request_paragraphs_async(
+        server,
+        obj["pgs"],
+        segment,
+        model_name=model_name,
+        deadline=deadline,
+        options=options,
+    )
+
+
+async def score_api(obj, deadline=None):
+    pgs, tgt_pgs = obj["pgs"], obj["tgt_pgs"]
+    if len(pgs) != len(tgt_pgs):
+        raise ValueError("pgs and tgt_pgs differ in length")
+    results = await request_async(
+        main.TranslationScoringServer, pgs, tgt_pgs, deadline=deadline
+    )
+    if obj.get("log_probs"):
+        return results
+    return [main.strip_log_probs(result) for result in results]
+
+
+_ROUTES = {
+    "/parse.api": parse_api,
+    "/translate.api": translate_api,
+    "/score.api": score_api,
+}
+
+_JSON_HEADERS = [(b"content-type", b"application/json; charset=utf-8")]
+
+
+async def _read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            return body
+
+
+async def _respond(send, obj, status=200, headers=()):
+    body = jsoncodec.dumps(obj)
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": _JSON_HEADERS
+            + [(b"content-length", str(len(body)).encode())]
+            + list(headers),
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _respond_stream(send, records):
+    """ Send records as an ndjson stream, returning whether it completed
+        without an error """
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"application/x-ndjson; charset=utf-8")],
+        }
+    )
+    try:
+        async for record in records:
+            line = main.ndjson_record(*record)
+            await send({"type": "http.response.body", "body": line, "more_body": True})
+        valid = True
+    except admission.Rejected as error:
+        line = jsoncodec.dumps(dict(valid=False, reason=error.reason)) + b"\n"
+        await send({"type": "http.response.body", "body": line, "more_body": True})
+        valid = False
+    except Exception as error:
+        main.app.logger.exception(error)
+        line = jsoncodec.dumps(dict(valid=False, reason="Invalid request")) + b"\n"
+        await send({"type": "http.response.body", "body": line, "more_body": True})
+        valid = False
+    await send({"type": "http.response.body", "body": b""})
+    return valid
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await client.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """ ASGI entry point """
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    path, method = scope["path"], scope["method"]
+    if path == "/metrics" and method == "GET":
+        content_type, body = metrics.render()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", content_type.encode())],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+        return
+    if path == "/stats.api" and method == "GET":
+        await _respond(send, main.stats())
+        return
+    handler = _ROUTES.get(path)
+    if handler is None:
+        await _respond(send, {"valid": False, "reason": "Not found"}, status=404)
+        return
+    if method != "POST":
+        await _respond(send, {"valid": False, "reason": "Method not allowed"}, status=405)
+        return
+    route = path[1:].split(".")[0]
+    if not main.model_enabled(route):
+        await _respond(send, {"valid": False, "reason": "Model not enabled"}, status=404)
+        return
+
+    headers = dict(scope.get("headers") or [])
+    request_id = headers.get(b"x-request-id", b"").decode() or new_request_id()
+    start = time.perf_counter()
+    pgs = None
+    valid = True
+    status = 200
+    extra_headers = []
+    body = await _read_body(receive)
+    try:
+        obj = jsoncodec.loads(body)
+        pgs = obj["pgs"]
+        timeout = headers.get(b"x-request-timeout")
+        if timeout is None:
+            timeout = obj.get("timeout")
+        model_response = await handler(obj, admission.deadline_from(timeout))
+        if hasattr(model_response, "__aiter__"):
+            # Admitted before the 200 of the stream is sent
+            model_response = await started_async(model_response)
+    except admission.Rejected as error:
+        model_response = dict(valid=False, reason=error.reason)
+        status = error.status
+        extra_headers = [(b"retry-after", str(error.retry_after).encode())]
+        valid = False
+    except decoding.InvalidOptions as error:
+        model_response = dict(valid=False, reason=error.reason)
+        status = 400
+        valid = False
+    except Exception as error:
+        model_response = dict(valid=False, reason="Invalid request")
+        main.app.logger.exception(error)
+        valid = False
+    if hasattr(model_response, "__aiter__"):
+        valid = False
+        try:
+            valid = await _respond_stream(send, model_response)
+        finally:
+            # Logged once the stream is done, with its duration
+            main.log_request(route, request_id, start, pgs, valid)
+        return
+    main.log_request(route, request_id, start, pgs, valid)
+    await _respond(send, model_response, status=status, headers=extra_headers)
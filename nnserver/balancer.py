@@ -0,0 +1,394 @@
+"""
+    Reynir: Natural language processing for Icelandic
+
+    Load balancing across model server replicas
+
+    Copyright (C) 2020 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    Routes model server calls over a list of tensorflow_model_server
+    replicas per model, by least outstanding requests or by the power of
+    two random choices.  A replica is ejected while its active status
+    check (GET /v1/models/<name>) fails, and a circuit breaker stops
+    sending it traffic for a cool-down period after consecutive failed
+    calls, so a slow or dead node does not hold up workers.  Only
+    connection errors, 5xx answers and timeouts at the server's own limit
+    count as failed calls; a 4xx answer or a timeout shortened by the
+    client's deadline says nothing about the replica.
+
+    Replicas are configured with NNSERVER_MODEL_SERVERS, a comma
+    separated list of host:port, or host:port:grpc_port for the gRPC
+    transport, used for every model, and/or NNSERVER_MODEL_SERVERS_JSON,
+    a JSON object mapping model names to such lists.  Without either, the
+    single MS_HOST/MS_PORT server is used.
+
+"""
+
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import requests
+
+try:
+    from aiohttp import ClientConnectionError as _AiohttpConnectionError
+except ImportError:
+    _AiohttpConnectionError = ()
+
+LEAST_OUTSTANDING = "least"
+POWER_OF_TWO = "p2c"
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# gRPC status codes that mean the replica failed rather than the request
+_GRPC_FAILURES = frozenset(["UNAVAILABLE", "INTERNAL", "UNKNOWN", "DATA_LOSS"])
+
+
+class NoReplicaAvailable(Exception):
+    """ Every replica of a model is ejected or has an open circuit """
+
+
+def parse_endpoints(spec):
+    """ List of (host, port) or (host, port, grpc_port) from
+        "host:port,host:port:grpc_port" """
+    endpoints = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        parts = item.split(":")
+        if len(parts) == 3:
+            endpoints.append(tuple(parts))
+        else:
+            host, _, port = item.rpartition(":")
+            endpoints.append((host, port))
+    return endpoints
+
+
+def is_replica_failure(error, own_timeout=True):
+    """ Whether a failed call counts against the replica: it could not be
+        reached, answered with a 5xx status, or timed out while the call
+        had the server's own time limit (own_timeout) rather than a
+        shorter one from the client's deadline """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, (requests.Timeout, asyncio.TimeoutError, TimeoutError)):
+        return own_timeout
+    if isinstance(error, requests.HTTPError):
+        response = error.response
+        return response is None or response.status_code >= 500
+    if isinstance(error, (requests.ConnectionError, ConnectionError)):
+        return True
+    # aiohttp.ClientResponseError carries the status
+    status = getattr(error, "status", None)
+    if isinstance(status, int):
+        return status >= 500
+    if isinstance(error, _AiohttpConnectionError):
+        return True
+    # grpc.RpcError carries a status code
+    code = getattr(error, "code", None)
+    if callable(code):
+        name = getattr(code(), "name", "")
+        if name == "DEADLINE_EXCEEDED":
+            return own_timeout
+        return name in _GRPC_FAILURES
+    return False
+
+
+class Replica:
+    """ One model server, with its outstanding request count, health and
+        circuit breaker state """
+
+    def __init__(self, host, port, failure_threshold, cooldown, grpc_port=None):
+        self.host = host
+        self.port = port
+        self.grpc_port = grpc_port
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self._trial = False
+        self._trial_at = 0.0
+        self._lock = threading.Lock()
+
+    def available(self, now=None):
+        """ Whether the replica may take a request now """
+        if not self.healthy:
+            return False
+        now = time.monotonic() if now is None else now
+        if self.state == OPEN and now - self.opened_at < self.cooldown:
+            return False
+        if self.state in (OPEN, HALF_OPEN):
+            # A trial that was never tracked expires after the cool-down
+            return not self._trial or now - self._trial_at >= self.cooldown
+        return True
+
+    def reserve(self, now=None):
+        """ Take the replica for a request if it is available, claiming
+            the single trial request of an open circuit atomically.
+            Returns (reserved, whether this request is the trial). """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if not self.available(now):
+                return False, False
+            if self.state in (OPEN, HALF_OPEN):
+                self.state = HALF_OPEN
+                self._trial = True
+                self._trial_at = now
+                return True, True
+            return True, False
+
+    @contextmanager
+    def track(self, own_timeout=True, trial=False):
+        """ Count the request as outstanding and feed its outcome to the
+            circuit breaker, see is_replica_failure.  trial is whether
+            choose() gave this request the trial of a half open circuit,
+            only then does finishing it free the trial. """
+        with self._lock:
+            self.outstanding += 1
+        try:
+            yield self
+        except Exception as error:
+            if is_replica_failure(error, own_timeout):
+                self._record(False)
+            raise
+        else:
+            self._record(True)
+        finally:
+            with self._lock:
+                self.outstanding -= 1
+                if trial:
+                    self._trial = False
+
+    def _record(self, success):
+        with self._lock:
+            if success:
+                self.failures = 0
+                self.state = CLOSED
+            else:
+                self.failures += 1
+                if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                    self.state = OPEN
+                    self.opened_at = time.monotonic()
+            self._trial = False
+
+    def as_dict(self):
+        return {
+            "endpoint": "{}:{}".format(self.host, self.port),
+            "healthy": self.healthy,
+            "circuit": self.state,
+            "outstanding": self.outstanding,
+            "consecutive_failures": self.failures,
+        }
+
+
+class Balancer:
+    """ Replica sets per model name, with a background status checker """
+
+    def __init__(
+        self,
+        endpoints=None,
+        model_endpoints=None,
+        strategy=None,
+        failure_threshold=None,
+        cooldown=None,
+        check_interval=None,
+        check_timeout=None,
+    ):
+        env = os.environ.get
+        self.endpoints = (
+            endpoints
+            if endpoints is not None
+            else parse_endpoints(env("NNSERVER_MODEL_SERVERS", ""))
+        )
+        if model_endpoints is None:
+            model_endpoints = {
+                model: parse_endpoints(",".join(servers))
+                for (model, servers) in json.loads(
+                    env("NNSERVER_MODEL_SERVERS_JSON", "{}")
+                ).items()
+            }
+        self.model_endpoints = model_endpoints
+        self.strategy = strategy or env("NNSERVER_BALANCE", POWER_OF_TWO)
+        self.failure_threshold = int(
+            failure_threshold
+            if failure_threshold is not None
+            else env("NNSERVER_BREAKER_FAILURES", 5)
+        )
+        self.cooldown = float(
+            cooldown if cooldown is not None else env("NNSERVER_BREAKER_COOLDOWN", 10)
+        )
+        self.check_interval = float(
+            check_interval
+            if check_interval is not None
+            else env("NNSERVER_HEALTH_INTERVAL", 5)
+        )
+        self.check_timeout = float(
+            check_timeout
+            if check_timeout is not None
+            else env("NNSERVER_HEALTH_TIMEOUT", 2)
+        )
+        self._lock = threading.Lock()
+        self._replicas = {}
+        self._checker = None
+        self._stopped = threading.Event()
+        self._pid = os.getpid()
+
+    @property
+    def configured(self):
+        return bool(self.endpoints or self.model_endpoints)
+
+    def replicas(self, model_name, default_host, default_port):
+        """ Replicas serving a model, the default server if none are
+            configured """
+        endpoints = self.model_endpoints.get(model_name) or self.endpoints
+        if not endpoints:
+            endpoints = [(default_host, default_port)]
+        key = (model_name, tuple(endpoints))
+        with self._lock:
+            if self._pid != os.getpid():
+                self._replicas = {}
+                self._checker = None
+                self._pid = os.getpid()
+            replicas = self._replicas.get(key)
+            if replicas is None:
+                replicas = [
+                    Replica(
+                        endpoint[0],
+                        endpoint[1],
+                        self.failure_threshold,
+                        self.cooldown,
+                        grpc_port=endpoint[2] if len(endpoint) > 2 else None,
+                    )
+                    for endpoint in endpoints
+                ]
+                self._replicas[key] = replicas
+            if (
+                self.configured
+                and self._checker is None
+                and self.check_interval > 0
+                and not self._stopped.is_set()
+            ):
+                self._checker = threading.Thread(target=self._check_loop, daemon=True)
+                self._checker.start()
+        return replicas
+
+    def _pick(self, candidates):
+        if len(candidates) == 1:
+            return candidates[0]
+        if self.strategy == LEAST_OUTSTANDING:
+            least = min(replica.outstanding for replica in candidates)
+            return random.choice(
+                [replica for replica in candidates if replica.outstanding == least]
+            )
+        first, second = random.sample(candidates, 2)
+        return first if first.outstanding <= second.outstanding else second
+
+    def choose(self, model_name, default_host, default_port):
+        """ Pick and reserve a replica for a call to model_name, returns
+            the replica and whether the call is its half open trial, to
+            pass on to track() """
+        replicas = self.replicas(model_name, default_host, default_port)
+        now = time.monotonic()
+        candidates = [replica for replica in replicas if replica.available(now)]
+        while candidates:
+            replica = self._pick(candidates)
+            reserved, trial = replica.reserve(now)
+            if reserved:
+                return replica, trial
+            # Another thread took its trial in the meantime
+            candidates.remove(replica)
+        raise NoReplicaAvailable("No model server available for {}".format(model_name))
+
+    def _check_loop(self):
+        while not self._stopped.wait(self.check_interval):
+            self.check_all()
+
+    def check_all(self):
+        """ Probe every replica concurrently, so that one hung replica does
+            not hold up the checks of the others """
+        with self._lock:
+            probes = [
+                (model_name, replica)
+                for (model_name, _), replicas in self._replicas.items()
+                for replica in replicas
+            ]
+        if not probes:
+            return
+        with ThreadPoolExecutor(max_workers=min(len(probes), 16)) as executor:
+            healthy = list(executor.map(lambda probe: self.check(*probe), probes))
+        for (_, replica), is_healthy in zip(probes, healthy):
+            replica.healthy = is_healthy
+
+    def check(self, model_name, replica):
+        """ Whether the replica reports a version of the model AVAILABLE,
+            probed without retries and within check_timeout seconds """
+        url = "http://{}:{}/v1/models/{}".format(replica.host, replica.port, model_name)
+        try:
+            resp = requests.get(
+                url, timeout=self.check_timeout, headers={"Connection": "close"}
+            )
+            if resp.status_code != 200:
+                return False
+            statuses = resp.json().get("model_version_status", [])
+        except Exception:
+            return False
+        return any(status.get("state") == "AVAILABLE" for status in statuses)
+
+    def close(self):
+        """ Stop the status checker """
+        self._stopped.set()
+
+    def stats(self):
+        with self._lock:
+            items = list(self._replicas.items())
+        result = {}
+        for (model_name, _), replicas in items:
+            result[model_name] = [replica.as_dict() for replica in replicas]
+        return result
+
+
+_BALANCER = None
+_BALANCER_LOCK = threading.Lock()
+
+
+def get_balancer():
+    """ Return the process wide balancer """
+    global _BALANCER
+    if _BALANCER is None:
+        with _BALANCER_LOCK:
+            if _BALANCER is None:
+                _BALANCER = Balancer()
+    return _BALANCER
+
+
+def configure(**kwargs):
+    """ Replace the process wide balancer """
+    global _BALANCER
+    with _BALANCER_LOCK:
+        if _BALANCER is not None:
+            _BALANCER.close()
+        _BALANCER = Balancer(**kwargs)
+    return _BALANCER
@@ -0,0 +1,428 @@
+"""
+    Reynir: Natural language processing for Icelandic
+
+    Offline batch translation and parsing
+
+    Copyright (C) 2020 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    Streams a large corpus through the model server without the HTTP API.
+    The input (plain text with one paragraph per line, or JSONL) is read
+    in windows of lines.  Each window is sent as one request to the server
+    class, which length buckets it and keeps --concurrency model server
+    calls in flight, while the next window is already being processed.
+    Results are written in input order.  The score task scores (source,
+    target) pairs for corpus filtering, from tab separated lines or the
+    --field and --target_field of JSONL, writing one length normalized
+    score per line.  After each window the output
+    is flushed and a checkpoint file records the lines done and the
+    output size, so a crashed run started again with the same arguments
+    resumes where it stopped.  Failed segments are retried with backoff;
+    a window that still fails stops the run with a non-zero exit status
+    before it is written, keeping the checkpoint.
+
+    Example usage:
+    nnserver-batch translate --source is --target en -i corpus.txt -o corpus.en
+    nnserver-batch parse --segment --jsonl --field text -i docs.jsonl -o docs.out
+    nnserver-batch score -i pairs.tsv -o pairs.scores
+
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from nnserver import bucketing, dispatch, main
+
+logger = logging.getLogger("nnserver.batch")
+
+
+def _server(args):
+    if args.task == "parse":
+        return main.ParsingServer, None
+    if args.task == "score":
+        return main.TranslationScoringServer, None
+    return main.translation_server(
+        dict(model=args.model, source=args.source, target=args.target)
+    )
+
+
+def read_checkpoint(path):
+    """ (lines done, output bytes) of a previous run, (0, 0) if none """
+    if not os.path.exists(path):
+        return 0, 0
+    with open(path, "r") as fp:
+        state = json.load(fp)
+    return state["lines"], state["offset"]
+
+
+def write_checkpoint(path, lines, offset):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as fp:
+        json.dump(dict(lines=lines, offset=offset), fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, path)
+
+
+def windows(fp, size, skip=0):
+    """ Lists of up to size lines from fp, after skipping skip lines """
+    window = []
+    for line_no, line in enumerate(fp):
+        if line_no < skip:
+            continue
+        window.append(line.rstrip("\n"))
+        if len(window) >= size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+
+class WindowFailed(Exception):
+    """ A window whose segments still failed after the retries """
+
+
+class BatchRunner:
+    """ Translates or parses windows of input lines and renders the
+        output lines """
+
+    def __init__(
+        self,
+        server,
+        model_name,
+        segment=False,
+        jsonl=False,
+        field="text",
+        retries=3,
+        backoff=1.0,
+    ):
+        self.server = server
+        self.model_name = model_name
+        self.segment = segment
+        self.jsonl = jsonl
+        self.field = field
+        self.retries = retries
+        self.backoff = backoff
+
+    def texts(self, window):
+        if not self.jsonl:
+            return window
+        texts = []
+        for line in window:
+            text = json.loads(line).get(self.field) if line else None
+            texts.append(text if isinstance(text, str) else "")
+        return texts
+
+    def fetch(self, count, request):
+        """ Results of request(indices) for indices range(count), asking
+            again with exponential backoff for the segments whose results
+            are errors.  Raises WindowFailed when retries run out. """
+        results = [None] * count
+        todo = list(range(count))
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                outcome = request(todo)
+            except Exception as error:
+                reason = str(error) or type(error).__name__
+            else:
+                for idx, result in zip(todo, outcome):
+                    results[idx] = result
+                todo = [idx for idx in todo if dispatch.is_error_result(results[idx])]
+                if not todo:
+                    return results
+                reason = results[todo[0]]["reason"]
+            if attempt < self.retries:
+                logger.warning(
+                    "%d of %d segments failed (%s), retrying in %.1f sec",
+                    len(todo),
+                    count,
+                    reason,
+                    delay,
+                )
+                time.sleep(delay)
+                delay *= 2
+        raise WindowFailed(
+            "{} of {} segments failed: {}".format(len(todo), count, reason)
+        )
+
+    def process(self, window):
+        """ Results for a window, with its sentence count and the subword
+            tokens encoded for the model server """
+        texts = self.texts(window)
+        todo = [idx for (idx, text) in enumerate(texts) if text.strip()]
+        results = [None] * len(texts)
+        pgs = [texts[idx] for idx in todo]
+        encodings = main.Encodings(self.server)
+        if pgs:
+            outcome = self.fetch(
+                len(pgs),
+                lambda indices: main.request_paragraphs(
+                    self.server,
+                    [pgs[idx] for idx in indices],
+                    self.segment,
+                    model_name=self.model_name,
+                    encodings=encodings,
+                ),
+            )
+            for idx, result in zip(todo, outcome):
+                results[idx] = result
+        sentences = sum(
+            len(result.get("sentences", ())) if self.segment else 1
+            for result in results
+            if result is not None
+        )
+        return window, results, sentences, encodings.tokens()
+
+    def render(self, window, results):
+        """ Output lines for a window and its results """
+        lines = []
+        for line, result in zip(window, results):
+            if self.jsonl:
+                obj = json.loads(line) if line else {}
+                obj["result"] = result
+                lines.append(json.dumps(obj, ensure_ascii=False))
+            elif result is None or dispatch.is_error_result(result):
+                lines.append("")
+            else:
+                lines.append(result["outputs"].replace("\n", " "))
+        return "".join(line + "\n" for line in lines)
+
+
+class ScoringRunner(BatchRunner):
+    """ Scores windows of (source, target) lines and renders the scores """
+
+    def __init__(
+        self,
+        server,
+        jsonl=False,
+        field="text",
+        target_field="target",
+        log_probs=False,
+        retries=3,
+        backoff=1.0,
+    ):
+        super().__init__(
+            server, None, jsonl=jsonl, field=field, retries=retries, backoff=backoff
+        )
+        self.target_field = target_field
+        self.log_probs = log_probs
+
+    def pairs(self, window):
+        if not self.jsonl:
+            return [tuple(line.split("\t", 1)) if line else () for line in window]
+        pairs = []
+        for line in window:
+            obj = json.loads(line) if line else {}
+            pair = (obj.get(self.field), obj.get(self.target_field))
+            pairs.append(pair if all(isinstance(text, str) for text in pair) else ())
+        return pairs
+
+    def process(self, window):
+        """ Scores for a window, with its pair count and the subword tokens
+            encoded for the model server """
+        pairs = self.pairs(window)
+        todo = [idx for (idx, pair) in enumerate(pairs) if len(pair) == 2]
+        results = [None] * len(pairs)
+        pgs = [pairs[idx][0] for idx in todo]
+        tgt_pgs = [pairs[idx][1] for idx in todo]
+        encodings = main.Encodings(self.server)
+        if pgs:
+            outcome = self.fetch(
+                len(pgs),
+                lambda indices: main.score_pairs(
+                    [pgs[idx] for idx in indices],
+                    [tgt_pgs[idx] for idx in indices],
+                    log_probs=self.log_probs,
+                    encodings=encodings,
+                ),
+            )
+            for idx, result in zip(todo, outcome):
+                results[idx] = result
+        return window, results, len(pgs), encodings.tokens()
+
+    def render(self, window, results):
+        if self.jsonl:
+            return super().render(window, results)
+        lines = []
+        for result in results:
+            if result is None or dispatch.is_error_result(result):
+                lines.append("")
+            elif self.log_probs:
+                lines.append(json.dumps(result, ensure_ascii=False))
+            else:
+                lines.append(repr(result["score"]))
+        return "".join(line + "\n" for line in lines)
+
+
+def run(args):
+    server, model_name = _server(args)
+    if args.task == "score":
+        runner = ScoringRunner(
+            server,
+            args.jsonl,
+            args.field,
+            args.target_field,
+            args.log_probs,
+            retries=args.retries,
+            backoff=args.backoff,
+        )
+    else:
+        runner = BatchRunner(
+            server,
+            model_name,
+            args.segment,
+            args.jsonl,
+            args.field,
+            retries=args.retries,
+            backoff=args.backoff,
+        )
+    checkpoint = args.checkpoint or args.output + ".ckpt"
+    done, offset = read_checkpoint(checkpoint)
+    if done:
+        logger.info("Resuming after %d lines", done)
+
+    out = open(args.output, "r+b" if done else "wb")
+    out.seek(offset)
+    out.truncate()
+    start = time.perf_counter()
+    sentences = tokens = errors = 0
+    failed = False
+    try:
+        with open(args.input, "r", encoding="utf-8") as fp, ThreadPoolExecutor(
+            max_workers=args.prefetch + 1
+        ) as executor:
+            pending = deque()
+
+            def flush_one():
+                nonlocal done, sentences, tokens, errors
+                window, results, num_sentences, num_tokens = pending.popleft().result()
+                out.write(runner.render(window, results).encode("utf-8"))
+                out.flush()
+                os.fsync(out.fileno())
+                done += len(window)
+                write_checkpoint(checkpoint, done, out.tell())
+                sentences += num_sentences
+                tokens += num_tokens
+                errors += sum(
+                    1
+                    for result in results
+                    if result is not None and dispatch.is_error_result(result)
+                )
+                elapsed = time.perf_counter() - start
+                logger.info(
+                    "%d lines, %.1f sentences/sec, %.1f tokens/sec, %d errors",
+                    done,
+                    sentences / elapsed,
+                    tokens / elapsed,
+                    errors,
+                )
+
+            try:
+                for window in windows(fp, args.window, skip=done):
+                    pending.append(executor.submit(runner.process, window))
+                    if len(pending) > args.prefetch:
+                        flush_one()
+                while pending:
+                    flush_one()
+            except WindowFailed as error:
+                # Stop before the failed window, so that a restart resumes there
+                logger.error("Stopping after %d lines: %s", done, error)
+                failed = True
+                for future in pending:
+                    future.cancel()
+    finally:
+        out.close()
+    if not failed and not errors and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return dict(
+        lines=done, sentences=sentences, tokens=tokens, errors=errors, failed=failed
+    )
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Offline batch translation and parsing")
+    parser.add_argument("task", choices=["translate", "parse", "score"])
+    parser.add_argument("-i", "--input", required=True, help="Input text or JSONL")
+    parser.add_argument("-o", "--output", required=True, help="Output file")
+    parser.add_argument(
+        "--checkpoint", default=None, help="Checkpoint file (default: output.ckpt)"
+    )
+    parser.add_argument(
+        "--model", default="transformer", choices=sorted(main.MODEL_NAMES)
+    )
+    parser.add_argument("--source", default="is")
+    parser.add_argument("--target", default="en")
+    parser.add_argument(
+        "--segment", action="store_true", help="Split lines into sentences"
+    )
+    parser.add_argument(
+        "--jsonl", action="store_true", help="Input and output are JSON lines"
+    )
+    parser.add_argument("--field", default="text", help="Text field of JSONL input")
+    parser.add_argument(
+        "--target_field", default="target", help="Target field of JSONL pairs to score"
+    )
+    parser.add_argument(
+        "--log_probs", action="store_true", help="Output the log prob of each subword"
+    )
+    parser.add_argument(
+        "--window", type=int, default=2048, help="Lines per length sorted window"
+    )
+    parser.add_argument(
+        "--prefetch", type=int, default=1, help="Windows processed ahead of output"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="Model server calls in flight"
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=64, help="Max segments per model call"
+    )
+    parser.add_argument(
+        "--retries", type=int, default=3, help="Retries of the failed segments"
+    )
+    parser.add_argument(
+        "--backoff", type=float, default=1.0, help="Seconds before the first retry"
+    )
+    parser.add_argument("--bucket_tokens", type=int, default=None)
+    parser.add_argument("-mh", "--model_host", default="localhost")
+    parser.add_argument("-mp", "--model_port", default="9000")
+    parser.add_argument("-mg", "--model_grpc_port", default="8500")
+    parser.add_argument("--transport", default="rest", choices=["rest", "grpc"])
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    main.app.config["out_host"] = args.model_host
+    main.app.config["out_port"] = args.model_port
+    main.app.config["out_grpc_port"] = args.model_grpc_port
+    main.app.config["transport"] = args.transport
+    dispatch.configure(max_workers=args.concurrency, chunk_size=args.batch_size)
+    bucketing.configure(max_tokens=args.bucket_tokens)
+
+    result = run(args)
+    json.dump(result, sys.stdout)
+    sys.stdout.write("\n")
+    if result["failed"] or result["errors"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,268 @@
+"""
+    Reynir: Natural language processing for Icelandic
+
+    Dynamic micro-batching of model server requests
+
+    Copyright (C) 2020 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    This module merges segments from concurrent API requests that target
+    the same model into a single model server call.  A batch is flushed
+    when it holds max_batch_size segments or when its oldest segment has
+    waited max_wait_ms, and the predictions are handed back to each
+    caller in order.
+
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from nnserver import admission
+
+
+class _Pending:
+    """ Segments from one caller waiting to be batched """
+
+    __slots__ = (
+        "pgs",
+        "tgt_pgs",
+        "deadline",
+        "encodings",
+        "enqueued",
+        "done",
+        "results",
+        "error",
+    )
+
+    def __init__(self, pgs, tgt_pgs, deadline=None, encodings=None):
+        self.pgs = pgs
+        self.tgt_pgs = tgt_pgs
+        self.deadline = deadline
+        self.encodings = encodings
+        self.enqueued = time.monotonic()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class _Queue:
+    """ Pending callers for a single (server class, model name) key """
+
+    def __init__(self, dispatch):
+        self.dispatch = dispatch
+        self.items = []
+        self.size = 0
+        self.cond = threading.Condition()
+        self.thread = None
+
+
+class BatchStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+        self.segments = 0
+        self.fill_total = 0.0
+        self.delay_total = 0.0
+        self.delay_max = 0.0
+
+    def record(self, num_requests, num_segments, fill, delays):
+        with self._lock:
+            self.batches += 1
+            self.requests += num_requests
+            self.segments += num_segments
+            self.fill_total += fill
+            self.delay_total += sum(delays)
+            self.delay_max = max([self.delay_max] + delays)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "requests": self.requests,
+                "segments": self.segments,
+                "mean_fill_ratio": self.fill_total / self.batches if self.batches else 0.0,
+                "mean_queue_delay_ms": 1000 * self.delay_total / self.requests
+                if self.requests
+                else 0.0,
+                "max_queue_delay_ms": 1000 * self.delay_max,
+            }
+
+
+class MicroBatcher:
+    """ Collects segments across threads per key and dispatches them in
+        batches.  With max_wait_ms set to 0 batching is disabled and
+        every call is dispatched directly. """
+
+    def __init__(self, max_batch_size=None, max_wait_ms=None, max_inflight=None):
+        env = os.environ.get
+        self.max_batch_size = int(
+            max_batch_size
+            if max_batch_size is not None
+            else env("NNSERVER_BATCH_MAX_SIZE", 64)
+        )
+        self.max_wait = (
+            float(
+                max_wait_ms
+                if max_wait_ms is not None
+                else env("NNSERVER_BATCH_MAX_WAIT_MS", 0)
+            )
+            / 1000
+        )
+        self.max_inflight = int(
+            max_inflight
+            if max_inflight is not None
+            else env("NNSERVER_BATCH_MAX_INFLIGHT", 4)
+        )
+        self.stats = BatchStats()
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._executor = None
+        self._pid = os.getpid()
+
+    @property
+    def enabled(self):
+        return self.max_wait > 0 and self.max_batch_size > 1
+
+    def submit(self, key, dispatch, pgs, tgt_pgs=None, deadline=None, encodings=None):
+        """ Return dispatch(pgs, tgt_pgs, deadline=..., encodings=...),
+            possibly computed as part of a larger batch, whose encodings
+            are merged.  dispatch must return one result per segment.  A
+            caller whose deadline passes while queued is failed with
+            DeadlineExceeded instead of being sent. """
+        if not self.enabled or len(pgs) >= self.max_batch_size:
+            return dispatch(pgs, tgt_pgs, deadline=deadline, encodings=encodings)
+
+        # Requests with and without targets cannot share a payload
+        key = (key, tgt_pgs is not None)
+        pending = _Pending(
+            list(pgs), None if tgt_pgs is None else list(tgt_pgs), deadline, encodings
+        )
+        queue = self._queue(key, dispatch)
+        with queue.cond:
+            queue.items.append(pending)
+            queue.size += len(pending.pgs)
+            queue.cond.notify()
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.results
+
+    def _queue(self, key, dispatch):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Threads do not survive a fork
+                self._queues = {}
+                self._executor = None
+                self._pid = os.getpid()
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_inflight)
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = _Queue(dispatch)
+                queue.thread = threading.Thread(
+                    target=self._collect, args=(queue,), daemon=True
+                )
+                self._queues[key] = queue
+                queue.thread.start()
+        return queue
+
+    def _collect(self, queue):
+        while True:
+            with queue.cond:
+                while not queue.items:
+                    queue.cond.wait()
+                deadline = queue.items[0].enqueued + self.max_wait
+                while queue.size < self.max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    queue.cond.wait(remaining)
+                batch = []
+                size = 0
+                while queue.items and (
+                    not batch or size + len(queue.items[0].pgs) <= self.max_batch_size
+                ):
+                    item = queue.items.pop(0)
+                    batch.append(item)
+                    size += len(item.pgs)
+                queue.size -= size
+            self._executor.submit(self._flush, queue.dispatch, batch, size)
+
+    def _flush(self, dispatch, batch, size):
+        now = time.monotonic()
+        live = []
+        for item in batch:
+            if item.deadline is not None and item.deadline <= now:
+                item.error = admission.DeadlineExceeded()
+                item.done.set()
+            else:
+                live.append(item)
+        if not live:
+            return
+        batch = live
+        size = sum(len(item.pgs) for item in batch)
+        self.stats.record(
+            len(batch),
+            size,
+            size / self.max_batch_size,
+            [now - item.enqueued for item in batch],
+        )
+        pgs = [seg for item in batch for seg in item.pgs]
+        tgt_pgs = None
+        if batch[0].tgt_pgs is not None:
+            tgt_pgs = [seg for item in batch for seg in item.tgt_pgs]
+        # The merged call may run as long as its most patient caller
+        deadlines = [item.deadline for item in batch]
+        deadline = None if None in deadlines else max(deadlines)
+        encodings = batch[0].encodings
+        if encodings is not None and len(batch) > 1:
+            encodings = encodings.merged(item.encodings for item in batch[1:])
+        try:
+            results = dispatch(pgs, tgt_pgs, deadline=deadline, encodings=encodings)
+        except Exception as error:
+            for item in batch:
+                item.error = error
+                item.done.set()
+            return
+        offset = 0
+        for item in batch:
+            item.results = results[offset : offset + len(item.pgs)]
+            offset += len(item.pgs)
+            item.done.set()
+
+
+_BATCHER = None
+_BATCHER_LOCK = threading.Lock()
+
+
+def get_batcher():
+    """ Return the process wide micro-batcher """
+    global _BATCHER
+    if _BATCHER is None:
+        with _BATCHER_LOCK:
+            if _BATCHER is None:
+                _BATCHER = MicroBatcher()
+    return _BATCHER
+
+
+def configure(**kwargs):
+    """ Replace the process wide micro-batcher """
+    global _BATCHER
+    with _BATCHER_LOCK:
+        _BATCHER = MicroBatcher(**kwargs)
+    return _BATCHER
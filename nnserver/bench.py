@@ -0,0 +1,754 @@
+#!/usr/bin/env python3
+"""
+    Reynir: Natural language processing for Icelandic
+
+    Benchmarks
+
+    Copyright (C) 2020 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    Benchmarks for the nnserver hot paths, and load tests of the HTTP API.
+
+    Example usage:
+    python -m nnserver.bench padding --server onmt-enis --input sentences.txt
+    python -m nnserver.bench transport --server translate --input sentences.txt \
+        --host localhost --model_name translate_enis16k_v4_rev-avg-ckpt-2.10M
+    python -m nnserver.bench load --local --concurrency 32 --results runs.jsonl
+    python -m nnserver.bench compare --results runs.jsonl --fail
+
+    Load tests run against a live nnserver (--url) or, with --local, against
+    the app served in process in front of nnserver.mock_model_server, with
+    the segment cache and translation memory off so that every segment
+    reaches the model server.  Warmup requests use bodies of their own.
+
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+_SERVER_NAMES = ("parse", "translate", "score", "onmt-enis", "onmt-isen")
+
+
+def _server_classes():
+    from nnserver import main
+
+    return {
+        "parse": main.ParsingServer,
+        "translate": main.TranslateServer,
+        "score": main.TranslationScoringServer,
+        "onmt-enis": main.OpenNMTTranslationServerEnIs,
+        "onmt-isen": main.OpenNMTTranslationServerIsEn,
+    }
+
+
+def _read_segments(path, limit=None):
+    segments = []
+    with open(path, "r") as fp:
+        for line in fp:
+            line = line.strip()
+            if line:
+                segments.append(line)
+            if limit and len(segments) >= limit:
+                break
+    return segments
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def bench_padding(args):
+    """ Padding ratio of request sized batches with and without length
+        bucketing """
+    from nnserver import bucketing
+
+    server = _server_classes()[args.server]
+    segments = _read_segments(args.input, args.limit)
+    lengths = server.segment_lengths(segments)
+
+    totals = {"tokens": 0, "padded_tokens_before": 0, "padded_tokens_after": 0}
+    num_buckets = 0
+    for batch in _chunks(lengths, args.batch_size):
+        buckets = bucketing.length_buckets(batch, args.bucket_tokens)
+        report = bucketing.padding_report(batch, buckets)
+        num_buckets += len(buckets)
+        for key in totals:
+            totals[key] += report[key]
+
+    real = totals["tokens"]
+    before, after = totals["padded_tokens_before"], totals["padded_tokens_after"]
+    return {
+        "benchmark": "padding",
+        "server": args.server,
+        "segments": len(segments),
+        "batches": -(-len(segments) // args.batch_size),
+        "sub_batches": num_buckets,
+        "bucket_tokens": args.bucket_tokens,
+        "tokens": real,
+        "padding_ratio_before": (before - real) / before if before else 0.0,
+        "padding_ratio_after": (after - real) / after if after else 0.0,
+    }
+
+
+def _timed(fn, repeat):
+    """ Best wall time of fn over repeat runs, in seconds """
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_transport(args):
+    """ Request encoding cost and size of the RESTful JSON payload compared
+        to the gRPC PredictRequest, optionally with live round trips """
+    from nnserver import grpc_client, main as nnmain
+
+    server = _server_classes()[args.server]
+    segments = _read_segments(args.input, args.limit)
+    batches = list(_chunks(segments, args.batch_size))
+    model_name = args.model_name or server._model_name
+
+    def rest_payloads():
+        return [server.package_body(batch) for batch in batches]
+
+    rest_secs, payloads = _timed(rest_payloads, args.repeat)
+    result = {
+        "benchmark": "transport",
+        "server": args.server,
+        "segments": len(segments),
+        "rest": {
+            "encode_us_per_segment": 1e6 * rest_secs / len(segments),
+            "bytes": sum(len(payload) for payload in payloads),
+        },
+    }
+
+    if grpc_client.available():
+        from tensorflow_serving.apis import predict_pb2
+
+        def grpc_requests():
+            messages = []
+            for batch in batches:
+                request = predict_pb2.PredictRequest()
+                request.model_spec.name = model_name
+                for name, tensor in server.package_tensors(batch).items():
+                    request.inputs[name].CopyFrom(tensor)
+                messages.append(request.SerializeToString())
+            return messages
+
+        grpc_secs, messages = _timed(grpc_requests, args.repeat)
+        result["grpc"] = {
+            "encode_us_per_segment": 1e6 * grpc_secs / len(segments),
+            "bytes": sum(len(message) for message in messages),
+        }
+
+    if args.host:
+        nnmain.app.config["out_host"] = args.host
+        nnmain.app.config["out_port"] = args.port
+        nnmain.app.config["out_grpc_port"] = args.grpc_port
+        transports = [grpc_client.REST]
+        if grpc_client.available():
+            transports.append(grpc_client.GRPC)
+        for name in transports:
+            nnmain.app.config["transport"] = name
+
+            def round_trips():
+                for batch in batches:
+                    server._request_batch(batch, model_name=model_name)
+
+            secs, _ = _timed(round_trips, args.repeat)
+            result[name]["round_trip_ms_per_batch"] = 1000 * secs / len(batches)
+
+    return result
+
+
+def bench_decode(args):
+    """ CompositeTokenEncoder.decode one sequence at a time compared to
+        decode_batch over the whole predictions array """
+    from nnserver.composite_encoder import CompositeTokenEncoder
+
+    encoder = CompositeTokenEncoder()
+    segments = _read_segments(args.input, args.limit)
+    rows = [encoder.encode(segment) for segment in segments]
+    num_ids = sum(len(row) for row in rows)
+
+    loop_secs, expected = _timed(
+        lambda: [encoder.decode(row) for row in rows], args.repeat
+    )
+    batch_secs, actual = _timed(lambda: encoder.decode_batch(rows), args.repeat)
+    if actual != expected:
+        raise AssertionError("decode_batch does not match decode")
+    return {
+        "benchmark": "decode",
+        "rows": len(rows),
+        "ids": num_ids,
+        "decode_ids_per_sec": num_ids / loop_secs,
+        "decode_batch_ids_per_sec": num_ids / batch_secs,
+        "speedup": loop_secs / batch_secs,
+    }
+
+
+def bench_encode(args):
+    """ CompositeTokenEncoder.encode throughput with and without the
+        token memo table """
+    from nnserver import _PARSING_VOCAB
+    from nnserver.composite_encoder import CompositeTokenEncoder
+
+    segments = _read_segments(args.input, args.limit)
+    num_tokens = sum(len(segment.split(" ")) for segment in segments)
+
+    uncached = CompositeTokenEncoder(memo_size=0)
+    memoized = CompositeTokenEncoder(warm_path=_PARSING_VOCAB)
+    uncached_secs, expected = _timed(
+        lambda: [uncached.encode(segment) for segment in segments], args.repeat
+    )
+    memo_secs, actual = _timed(
+        lambda: [memoized.encode(segment) for segment in segments], args.repeat
+    )
+    if actual != expected:
+        raise AssertionError("Memoized encode does not match")
+    return {
+        "benchmark": "encode",
+        "segments": len(segments),
+        "tokens": num_tokens,
+        "uncached_tokens_per_sec": num_tokens / uncached_secs,
+        "memoized_tokens_per_sec": num_tokens / memo_secs,
+        "memo_entries": len(memoized._memo),
+    }
+
+
+def bench_subword(args):
+    """ SubwordTextEncoder.encode one segment at a time compared to the
+        batched, cached front-end over the whole input """
+    from tensor2tensor.data_generators import text_encoder
+
+    from nnserver import _ENIS_VOCAB
+    from nnserver.subword_encoder import BatchSubwordEncoder
+
+    segments = _read_segments(args.input, args.limit)
+    encoder = text_encoder.SubwordTextEncoder(_ENIS_VOCAB)
+    batched = BatchSubwordEncoder(text_encoder.SubwordTextEncoder(_ENIS_VOCAB))
+
+    loop_secs, expected = _timed(
+        lambda: [encoder.encode(segment) for segment in segments], args.repeat
+    )
+    batch_secs, actual = _timed(
+        lambda: [
+            ids
+            for chunk in _chunks(segments, args.batch_size)
+            for ids in batched.encode_batch(chunk)
+        ],
+        args.repeat,
+    )
+    if actual != expected:
+        raise AssertionError("encode_batch does not match encode")
+    return {
+        "benchmark": "subword",
+        "segments": len(segments),
+        "subtokens": sum(len(ids) for ids in expected),
+        "encode_segments_per_sec": len(segments) / loop_secs,
+        "encode_batch_segments_per_sec": len(segments) / batch_secs,
+        "speedup": loop_secs / batch_secs,
+        "cached_tokens": len(batched._cache),
+    }
+
+
+def bench_example(args):
+    """ tf.Example messages built and serialized with protobuf compared to
+        the direct serializer, per example and for whole REST bodies """
+    import base64
+
+    from tensorflow.core.example import example_pb2, feature_pb2
+
+    from nnserver import subword_encoder, tf_example
+
+    server = _server_classes()["translate"]
+    segments = _read_segments(args.input, args.limit)
+    rows = [ids + [1] for ids in subword_encoder.encode_batch(server.src_enc, segments)]
+    batches = list(_chunks(rows, args.batch_size))
+
+    def reference(ids):
+        feature = feature_pb2.Feature(int64_list=feature_pb2.Int64List(value=ids))
+        features = feature_pb2.Features(feature={"inputs": feature})
+        return example_pb2.Example(features=features).SerializeToString()
+
+    def reference_bodies():
+        return [
+            json.dumps(
+                {
+                    "signature_name": "serving_default",
+                    "instances": [
+                        {"input": {"b64": base64.b64encode(reference(ids)).decode()}}
+                        for ids in batch
+                    ],
+                }
+            ).encode()
+            for batch in batches
+        ]
+
+    def direct_bodies():
+        return [
+            tf_example.rest_body([tf_example.serialize_example(ids) for ids in batch])
+            for batch in batches
+        ]
+
+    ref_secs, expected = _timed(lambda: [reference(ids) for ids in rows], args.repeat)
+    direct_secs, actual = _timed(
+        lambda: [tf_example.serialize_example(ids) for ids in rows], args.repeat
+    )
+    if actual != expected:
+        raise AssertionError("serialize_example does not match protobuf")
+    ref_body_secs, expected = _timed(reference_bodies, args.repeat)
+    direct_body_secs, actual = _timed(direct_bodies, args.repeat)
+    if actual != expected:
+        raise AssertionError("rest_body does not match json.dumps")
+    return {
+        "benchmark": "example",
+        "segments": len(rows),
+        "protobuf_us_per_example": 1e6 * ref_secs / len(rows),
+        "direct_us_per_example": 1e6 * direct_secs / len(rows),
+        "protobuf_body_us_per_segment": 1e6 * ref_body_secs / len(rows),
+        "direct_body_us_per_segment": 1e6 * direct_body_secs / len(rows),
+        "body_speedup": ref_body_secs / direct_body_secs,
+    }
+
+
+def bench_json(args):
+    """ Standard library JSON compared to nnserver.jsoncodec, on model
+        server replies and API replies of large batches """
+    from nnserver import jsoncodec
+
+    rng = random.Random(args.seed)
+    predictions = [
+        {
+            "outputs": [rng.randrange(2, 16000) for _ in range(args.length)] + [1],
+            "scores": rng.uniform(-20, 0),
+        }
+        for _ in range(args.batch_size)
+    ]
+    reply = json.dumps({"predictions": predictions}).encode("utf-8")
+    results = [
+        {"outputs": "Þetta er próf á þýðingu " * (args.length // 6), "scores": -1.5}
+        for _ in range(args.batch_size)
+    ]
+
+    # resp.text followed by json.loads, and what Flask jsonify writes
+    stdlib_loads_secs, expected = _timed(
+        lambda: json.loads(reply.decode("utf-8")), args.repeat
+    )
+    codec_loads_secs, actual = _timed(lambda: jsoncodec.loads(reply), args.repeat)
+    if actual != expected:
+        raise AssertionError("jsoncodec.loads does not match json.loads")
+    stdlib_dumps_secs, _ = _timed(
+        lambda: json.dumps(
+            results, ensure_ascii=True, sort_keys=True, separators=(",", ":")
+        ).encode("utf-8"),
+        args.repeat,
+    )
+    codec_dumps_secs, body = _timed(lambda: jsoncodec.dumps(results), args.repeat)
+    if json.loads(body) != results:
+        raise AssertionError("jsoncodec.dumps does not round trip")
+    return {
+        "benchmark": "json",
+        "backend": jsoncodec.backend,
+        "segments": args.batch_size,
+        "reply_bytes": len(reply),
+        "stdlib_loads_ms": 1000 * stdlib_loads_secs,
+        "codec_loads_ms": 1000 * codec_loads_secs,
+        "stdlib_dumps_ms": 1000 * stdlib_dumps_secs,
+        "codec_dumps_ms": 1000 * codec_dumps_secs,
+    }
+
+
+def bench_bpe(args):
+    """ subword-nmt BPE.process_line compared to BytePairEncoder, on cold
+        and warm word caches """
+    from subword_nmt import apply_bpe
+
+    from nnserver import _ONMT_EN_VOCAB, _ONMT_IS_VOCAB
+    from nnserver.bpe import BytePairEncoder
+
+    path = _ONMT_EN_VOCAB if args.lang == "en" else _ONMT_IS_VOCAB
+    segments = _read_segments(args.input, args.limit)
+    num_words = sum(len(segment.split()) for segment in segments)
+
+    def reference():
+        with open(path, "r") as fp:
+            return apply_bpe.BPE(fp)
+
+    def cold(encoder_class, process):
+        encoder = encoder_class()
+        start = time.perf_counter()
+        result = process(encoder)
+        return time.perf_counter() - start, result, encoder
+
+    ref_cold_secs, expected, ref = cold(
+        reference, lambda bpe: [bpe.process_line(segment) for segment in segments]
+    )
+    cold_secs, actual, fast = cold(
+        lambda: BytePairEncoder(path), lambda bpe: bpe.process_lines(segments)
+    )
+    if actual != expected:
+        raise AssertionError("BytePairEncoder does not match subword-nmt")
+    ref_warm_secs, _ = _timed(
+        lambda: [ref.process_line(segment) for segment in segments], args.repeat
+    )
+    warm_secs, _ = _timed(lambda: fast.process_lines(segments), args.repeat)
+    return {
+        "benchmark": "bpe",
+        "segments": len(segments),
+        "words": num_words,
+        "subword_nmt_cold_words_per_sec": num_words / ref_cold_secs,
+        "cold_words_per_sec": num_words / cold_secs,
+        "subword_nmt_warm_words_per_sec": num_words / ref_warm_secs,
+        "warm_words_per_sec": num_words / warm_secs,
+        "warm_speedup": ref_warm_secs / warm_secs,
+    }
+
+
+def _percentile(values, q):
+    """ Nearest rank percentile of sorted values """
+    if not values:
+        return None
+    rank = max(int(round(q / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def _sentence_lengths(spec, rng):
+    """ Word count generator from "fixed:N", "uniform:LO:HI" or
+        "lognormal:MU:SIGMA" """
+    kind, *params = spec.split(":")
+    params = [float(param) for param in params]
+    if kind == "fixed":
+        return lambda: int(params[0])
+    if kind == "uniform":
+        return lambda: rng.randint(int(params[0]), int(params[1]))
+    if kind == "lognormal":
+        return lambda: max(1, int(rng.lognormvariate(params[0], params[1])))
+    raise ValueError("Unknown length distribution {}".format(spec))
+
+
+def _cpu_seconds(pid):
+    """ User and system CPU time of a process, None where /proc is missing """
+    try:
+        with open("/proc/{}/stat".format(pid)) as fp:
+            fields = fp.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def _start_local(args):
+    """ Stand-in model server and nnserver app in this process, returns
+        the base url of the app """
+    from werkzeug.serving import make_server
+
+    from nnserver import cache, main as nnmain, mock_model_server, translation_memory
+
+    mock = mock_model_server.serve(
+        config=mock_model_server.MockConfig(
+            latency_ms=args.mock_latency_ms, per_segment_ms=args.mock_per_segment_ms
+        )
+    )
+    nnmain.app.config["out_host"] = "localhost"
+    nnmain.app.config["out_port"] = str(mock.server_address[1])
+    nnmain.app.config["transport"] = "rest"
+    cache.configure(max_size=0)
+    translation_memory.configure(max_size=0)
+    app_server = make_server("localhost", 0, nnmain.app, threaded=True)
+    threading.Thread(target=app_server.serve_forever, daemon=True).start()
+    return "http://localhost:{}".format(app_server.server_port)
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_load(args):
+    """ Latency percentiles, throughput and CPU per request of concurrent
+        /translate.api or /parse.api requests """
+    import requests
+
+    rng = random.Random(args.seed)
+    words = (
+        [word for segment in _read_segments(args.input) for word in segment.split()]
+        if args.input
+        else ["orð{}".format(idx) for idx in range(5000)]
+    )
+    num_words = _sentence_lengths(args.lengths, rng)
+    bodies = []
+    for _ in range(args.warmup + args.requests):
+        pgs = [
+            " ".join(rng.choice(words) for _ in range(num_words())) + "."
+            for _ in range(args.pgs)
+        ]
+        obj = {"pgs": pgs}
+        if args.route == "translate":
+            obj.update(model=args.model, source=args.source, target=args.target)
+        bodies.append(json.dumps(obj))
+
+    base_url = _start_local(args) if args.local else args.url
+    url = "{}/{}.api".format(base_url.rstrip("/"), args.route)
+    local = threading.local()
+
+    def send(body):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            resp = session.post(url, data=body.encode("utf-8"), timeout=args.timeout)
+            ok = resp.status_code == 200 and all(
+                result.get("valid", True) for result in resp.json()
+            )
+        except (requests.RequestException, ValueError, AttributeError):
+            ok = False
+        return time.perf_counter() - start, ok
+
+    warmup, bodies = bodies[: args.warmup], bodies[args.warmup :]
+    for body in warmup:
+        send(body)
+
+    pid = args.server_pid or (os.getpid() if args.local else None)
+    cpu_before = _cpu_seconds(pid) if pid else None
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        outcomes = list(executor.map(send, bodies))
+    elapsed = time.perf_counter() - start
+    cpu_after = _cpu_seconds(pid) if pid else None
+
+    latencies = sorted(1000 * secs for (secs, _) in outcomes)
+    errors = sum(1 for (_, ok) in outcomes if not ok)
+    result = {
+        "benchmark": "load",
+        "params": {
+            "route": args.route,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "pgs": args.pgs,
+            "lengths": args.lengths,
+            "local": args.local,
+        },
+        "latency_ms": {
+            "p50": _percentile(latencies, 50),
+            "p95": _percentile(latencies, 95),
+            "p99": _percentile(latencies, 99),
+            "mean": sum(latencies) / len(latencies) if latencies else None,
+        },
+        "requests_per_sec": len(outcomes) / elapsed,
+        "segments_per_sec": len(outcomes) * args.pgs / elapsed,
+        "errors": errors,
+        # In --local mode the client load runs in the same process
+        "cpu_ms_per_request": (
+            1000 * (cpu_after - cpu_before) / len(outcomes)
+            if cpu_before is not None and cpu_after is not None
+            else None
+        ),
+    }
+    if args.results:
+        record = dict(result, time=time.time(), revision=_git_revision())
+        with open(args.results, "a") as fp:
+            fp.write(json.dumps(record) + "\n")
+    return result
+
+
+_COMPARED = (
+    ("latency_ms.p50", False),
+    ("latency_ms.p95", False),
+    ("latency_ms.p99", False),
+    ("requests_per_sec", True),
+    ("cpu_ms_per_request", False),
+)
+
+
+def bench_compare(args):
+    """ Latest stored load run compared to the previous run with the same
+        parameters, flagging changes for the worse beyond the threshold """
+    with open(args.results, "r") as fp:
+        records = [json.loads(line) for line in fp if line.strip()]
+    if not records:
+        raise SystemExit("No stored runs in {}".format(args.results))
+    latest = records[-1]
+    previous = [
+        record for record in records[:-1] if record["params"] == latest["params"]
+    ]
+    if not previous:
+        raise SystemExit("No earlier run with the same parameters")
+    baseline = previous[-1]
+
+    def value(record, path):
+        for key in path.split("."):
+            record = record.get(key) if record else None
+        return record
+
+    changes = {}
+    regressions = []
+    for path, higher_is_better in _COMPARED:
+        before, after = value(baseline, path), value(latest, path)
+        if not before or after is None:
+            continue
+        change = (after - before) / before
+        changes[path] = {"before": before, "after": after, "change": change}
+        worse = -change if higher_is_better else change
+        if worse > args.threshold:
+            regressions.append(path)
+    result = {
+        "benchmark": "compare",
+        "baseline_revision": baseline.get("revision"),
+        "revision": latest.get("revision"),
+        "changes": changes,
+        "regressions": regressions,
+    }
+    if regressions and args.fail:
+        json.dump(result, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+        raise SystemExit(1)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="nnserver benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    padding = subparsers.add_parser("padding", help="Padding waste per batch")
+    padding.add_argument("--server", choices=sorted(_SERVER_NAMES), required=True)
+    padding.add_argument("--input", required=True, help="One segment per line")
+    padding.add_argument("--limit", type=int, default=None)
+    padding.add_argument("--batch_size", type=int, default=64)
+    padding.add_argument("--bucket_tokens", type=int, default=4096)
+    padding.set_defaults(func=bench_padding)
+
+    transport = subparsers.add_parser("transport", help="REST versus gRPC")
+    transport.add_argument("--server", choices=sorted(_SERVER_NAMES), required=True)
+    transport.add_argument("--input", required=True, help="One segment per line")
+    transport.add_argument("--limit", type=int, default=None)
+    transport.add_argument("--batch_size", type=int, default=64)
+    transport.add_argument("--repeat", type=int, default=3)
+    transport.add_argument("--model_name", default=None)
+    transport.add_argument(
+        "--host", default=None, help="Model server for live round trips"
+    )
+    transport.add_argument("--port", default="8501", help="REST port")
+    transport.add_argument("--grpc_port", default="8500")
+    transport.set_defaults(func=bench_transport)
+
+    decode = subparsers.add_parser("decode", help="Parse tree decoding")
+    decode.add_argument(
+        "--input", required=True, help="One flattened parse tree per line"
+    )
+    decode.add_argument("--limit", type=int, default=None)
+    decode.add_argument("--repeat", type=int, default=3)
+    decode.set_defaults(func=bench_decode)
+
+    encode = subparsers.add_parser("encode", help="Parse tree encoding")
+    encode.add_argument(
+        "--input", required=True, help="One flattened parse tree per line"
+    )
+    encode.add_argument("--limit", type=int, default=None)
+    encode.add_argument("--repeat", type=int, default=3)
+    encode.set_defaults(func=bench_encode)
+
+    subword = subparsers.add_parser("subword", help="Subword text encoding")
+    subword.add_argument("--input", required=True, help="One segment per line")
+    subword.add_argument("--limit", type=int, default=None)
+    subword.add_argument("--batch_size", type=int, default=64)
+    subword.add_argument("--repeat", type=int, default=3)
+    subword.set_defaults(func=bench_subword)
+
+    example = subparsers.add_parser("example", help="tf.Example serialization")
+    example.add_argument("--input", required=True, help="One segment per line")
+    example.add_argument("--limit", type=int, default=None)
+    example.add_argument("--batch_size", type=int, default=64)
+    example.add_argument("--repeat", type=int, default=5)
+    example.set_defaults(func=bench_example)
+
+    json_codec = subparsers.add_parser("json", help="JSON codec")
+    json_codec.add_argument("--batch_size", type=int, default=1024)
+    json_codec.add_argument("--length", type=int, default=64, help="Ids per output")
+    json_codec.add_argument("--seed", type=int, default=0)
+    json_codec.add_argument("--repeat", type=int, default=5)
+    json_codec.set_defaults(func=bench_json)
+
+    bpe = subparsers.add_parser("bpe", help="OpenNMT byte pair encoding")
+    bpe.add_argument("--input", required=True, help="One segment per line")
+    bpe.add_argument("--lang", choices=["en", "is"], default="en")
+    bpe.add_argument("--limit", type=int, default=None)
+    bpe.add_argument("--repeat", type=int, default=3)
+    bpe.set_defaults(func=bench_bpe)
+
+    load = subparsers.add_parser("load", help="Load test of the HTTP API")
+    load.add_argument("--route", choices=["translate", "parse"], default="translate")
+    load.add_argument("--url", default="http://localhost:5005")
+    load.add_argument(
+        "--local",
+        action="store_true",
+        help="Serve the app and a stand-in model server in this process",
+    )
+    load.add_argument("--mock_latency_ms", type=float, default=10.0)
+    load.add_argument("--mock_per_segment_ms", type=float, default=0.1)
+    load.add_argument("--concurrency", type=int, default=8)
+    load.add_argument("--requests", type=int, default=200)
+    load.add_argument("--warmup", type=int, default=10)
+    load.add_argument("--pgs", type=int, default=4, help="Segments per request")
+    load.add_argument(
+        "--lengths",
+        default="uniform:5:40",
+        help="Words per segment: fixed:N, uniform:LO:HI or lognormal:MU:SIGMA",
+    )
+    load.add_argument("--input", default=None, help="Text to draw words from")
+    load.add_argument("--model", default="transformer")
+    load.add_argument("--source", default="is")
+    load.add_argument("--target", default="en")
+    load.add_argument("--seed", type=int, default=0)
+    load.add_argument("--timeout", type=float, default=300)
+    load.add_argument(
+        "--server_pid", type=int, default=None, help="Measure CPU of this process"
+    )
+    load.add_argument("--results", default=None, help="JSONL file to append to")
+    load.set_defaults(func=bench_load)
+
+    compare = subparsers.add_parser("compare", help="Compare stored load runs")
+    compare.add_argument("--results", required=True)
+    compare.add_argument("--threshold", type=float, default=0.1)
+    compare.add_argument(
+        "--fail", action="store_true", help="Exit with 1 on a regression"
+    )
+    compare.set_defaults(func=bench_compare)
+
+    args = parser.parse_args(argv)
+    result = args.func(args)
+    json.dump(result, sys.stdout, indent=2, ensure_ascii=False)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
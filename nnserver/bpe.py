@@ -0,0 +1,177 @@
+"""
+    Reynir: Natural language processing for Icelandic
+
+    Byte pair encoding
+
+    Copyright (C) 2020 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    Applies the merges of a subword-nmt codes file with the same output as
+    subword_nmt.apply_bpe.BPE.process_line (without vocabulary filtering,
+    glossaries or dropout, which the OpenNMT servers do not use).
+
+    Symbols are interned as integers and each adjacent symbol pair is
+    looked up by a single integer key, which gives its merge rank and the
+    merged symbol.  Segmented words are cached as finished output strings
+    in a bounded table, so a known word costs one dict lookup.
+
+"""
+
+import os
+import threading
+
+WORD_CACHE_SIZE = 1 << 18
+
+_END = "</w>"
+
+
+def _pair_key(left, right):
+    return (left << 32) | right
+
+
+class BytePairEncoder:
+    """ Segments whitespace tokenized text into subword units """
+
+    def __init__(self, path, separator="@@", cache_size=None):
+        self.separator = separator
+        self.cache_size = int(
+            cache_size
+            if cache_size is not None
+            else os.environ.get("NNSERVER_BPE_CACHE_SIZE", WORD_CACHE_SIZE)
+        )
+        self._symbols = {}
+        self._names = []
+        self._symbols_lock = threading.Lock()
+        # Pair key -> (rank, left id, right id, merged id)
+        self._merges = {}
+        # Word -> segmented word, bounded by cache_size entries
+        self._cache = {}
+        with open(path, "r", encoding="utf-8") as fp:
+            self._load(fp)
+
+    def _load(self, fp):
+        first = fp.readline()
+        if first.startswith("#version:"):
+            version = first.split()[-1].split(".")
+            while len(version) > 1 and int(version[-1]) == 0:
+                version.pop()
+            self.version = tuple(int(part) for part in version)
+            lines = fp.read()
+        else:
+            self.version = (0, 1)
+            lines = first + fp.read()
+        if self.version not in ((0, 1), (0, 2)):
+            raise ValueError("Unsupported BPE codes version {}".format(self.version))
+
+        merges = self._merges
+        for rank, line in enumerate(lines.rstrip("\n").split("\n")):
+            pair = line.strip("\r\n ").split(" ")
+            if len(pair) != 2:
+                raise ValueError("Invalid line in BPE codes: {}".format(line))
+            left, right = self._symbol(pair[0]), self._symbol(pair[1])
+            key = _pair_key(left, right)
+            # Only the first of duplicate merges counts, as in subword-nmt
+            if key not in merges:
+                merges[key] = (rank, left, right, self._symbol(pair[0] + pair[1]))
+
+    def _symbol(self, name):
+        """ Integer id of a symbol, interning it on first sight """
+        symbol = self._symbols.get(name)
+        if symbol is None:
+            with self._symbols_lock:
+                symbol = self._symbols.get(name)
+                if symbol is None:
+                    symbol = len(self._names)
+                    self._names.append(name)
+                    self._symbols[name] = symbol
+        return symbol
+
+    def segment_word(self, word):
+        """ Subword units of a single word """
+        if len(word) == 1:
+            return (word,)
+        if self.version == (0, 1):
+            units = list(word) + [_END]
+        else:
+            units = list(word[:-1]) + [word[-1] + _END]
+        symbol = self._symbol
+        ids = [symbol(unit) for unit in units]
+
+        merges = self._merges
+        while len(ids) > 1:
+            best = None
+            for idx in range(len(ids) - 1):
+                merge = merges.get(_pair_key(ids[idx], ids[idx + 1]))
+                if merge is not None and (best is None or merge[0] < best[0]):
+                    best = merge
+            if best is None:
+                break
+            _, left, right, merged = best
+            merged_ids = []
+            idx = 0
+            last = len(ids) - 1
+            while idx <= last:
+                if idx < last and ids[idx] == left and ids[idx + 1] == right:
+                    merged_ids.append(merged)
+                    idx += 2
+                else:
+                    merged_ids.append(ids[idx])
+                    idx += 1
+            ids = merged_ids
+
+        names = self._names
+        units = [names[unit] for unit in ids]
+        if units[-1] == _END:
+            units.pop()
+        elif units[-1].endswith(_END):
+            units[-1] = units[-1][: -len(_END)]
+        return tuple(units)
+
+    def _encode_word(self, word, computed=None):
+        encoded = self._cache.get(word)
+        if encoded is None and computed is not None:
+            encoded = computed.get(word)
+        if encoded is None:
+            encoded = (self.separator + " ").join(self.segment_word(word))
+            if len(self._cache) < self.cache_size:
+                self._cache[word] = encoded
+            elif computed is not None:
+                computed[word] = encoded
+        return encoded
+
+    def process_line(self, line, computed=None):
+        """ Segmented line, keeping leading and trailing whitespace """
+        out = ""
+        leading = len(line) - len(line.lstrip("\r\n "))
+        if leading:
+            out += line[:leading]
+
+        encode_word = self._encode_word
+        out += " ".join(
+            encode_word(word, computed)
+            for word in line.strip("\r\n ").split(" ")
+            if word
+        )
+
+        trailing = len(line) - len(line.rstrip("\r\n "))
+        if trailing and trailing != len(line):
+            out += line[-trailing:]
+        return out
+
+    def process_lines(self, lines):
+        """ Segmented lines, segmenting each distinct word once, also when
+            the word cache is full """
+        computed = {}
+        return [self.process_line(line, computed) for line in lines]
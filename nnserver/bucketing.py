@@ -0,0 +1,140 @@
+"""
+    Reynir: Natural language processing for Icelandic
+
+    Length bucketing of model server batches
+
+    Copyright (C) 2020 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    A batch sent to the model server is padded to its longest segment, so
+    a single long paragraph makes every short sentence in the batch pay
+    for its length.  This module sorts segments by subword length and
+    splits them into sub-batches whose padded size (segments times longest
+    segment) stays within a token budget.
+
+"""
+
+import os
+import threading
+
+
+def length_buckets(lengths, max_tokens):
+    """ Split segment indices into buckets of similar length, such that
+        len(bucket) * max(length in bucket) <= max_tokens.  A segment longer
+        than max_tokens gets a bucket of its own.  Indices within a bucket
+        are in ascending length order; with max_tokens <= 0 everything goes
+        into a single bucket in the original order. """
+    if not lengths:
+        return []
+    if max_tokens <= 0:
+        return [list(range(len(lengths)))]
+    order = sorted(range(len(lengths)), key=lambda idx: lengths[idx])
+    buckets = []
+    current = []
+    for idx in order:
+        # Ascending order, so the new segment is the longest in the bucket
+        if current and (len(current) + 1) * lengths[idx] > max_tokens:
+            buckets.append(current)
+            current = []
+        current.append(idx)
+    buckets.append(current)
+    return buckets
+
+
+def padded_size(lengths, buckets):
+    """ Number of tokens (real plus padding) the buckets occupy """
+    return sum(len(bucket) * max(lengths[idx] for idx in bucket) for bucket in buckets)
+
+
+def padding_report(lengths, buckets):
+    """ Padding ratio of one batch padded to the longest segment compared
+        to that of the given buckets """
+    real = sum(lengths)
+    before = len(lengths) * max(lengths) if lengths else 0
+    after = padded_size(lengths, buckets) if lengths else 0
+    return {
+        "segments": len(lengths),
+        "buckets": len(buckets),
+        "tokens": real,
+        "padded_tokens_before": before,
+        "padded_tokens_after": after,
+        "padding_ratio_before": (before - real) / before if before else 0.0,
+        "padding_ratio_after": (after - real) / after if after else 0.0,
+    }
+
+
+class Bucketer:
+    """ Length bucketing with a configurable token budget per sub-batch,
+        keeping running padding totals """
+
+    def __init__(self, max_tokens=None):
+        self.max_tokens = int(
+            max_tokens
+            if max_tokens is not None
+            else os.environ.get("NNSERVER_BUCKET_TOKENS", 4096)
+        )
+        self._lock = threading.Lock()
+        self.tokens = 0
+        self.padded_before = 0
+        self.padded_after = 0
+        self.batches = 0
+        self.sub_batches = 0
+
+    def split(self, lengths):
+        buckets = length_buckets(lengths, self.max_tokens)
+        if lengths:
+            report = padding_report(lengths, buckets)
+            with self._lock:
+                self.tokens += report["tokens"]
+                self.padded_before += report["padded_tokens_before"]
+                self.padded_after += report["padded_tokens_after"]
+                self.batches += 1
+                self.sub_batches += len(buckets)
+        return buckets
+
+    def stats(self):
+        with self._lock:
+            before, after = self.padded_before, self.padded_after
+            return {
+                "max_tokens": self.max_tokens,
+                "batches": self.batches,
+                "sub_batches": self.sub_batches,
+                "padding_ratio_before": (before - self.tokens) / before
+                if before
+                else 0.0,
+                "padding_ratio_after": (after - self.tokens) / after if after else 0.0,
+            }
+
+
+_BUCKETER = None
+_BUCKETER_LOCK = threading.Lock()
+
+
+def get_bucketer():
+    """ Return the process wide bucketer """
+    global _BUCKETER
+    if _BUCKETER is None:
+        with _BUCKETER_LOCK:
+            if _BUCKETER is None:
+                _BUCKETER = Bucketer()
+    return _BUCKETER
+
+
+def configure(**kwargs):
+    """ Replace the process wide bucketer """
+    global _BUCKETER
+    with _BUCKETER_LOCK:
+        _BUCKETER = Bucketer(**kwargs)
+    return _BUCKETER
@@ -0,0 +1,313 @@
+"""
+    Reynir: Natural language processing for Icelandic
+
+    Segment level result cache
+
+    Copyright (C) 2020 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    This module caches model results per (model name, source segment) so
+    that repeated segments are not sent to the model server again.  The
+    default backend is an in-process LRU, the SQLite backend is shared by
+    all gunicorn workers on a host.  Error results and results reused by
+    the translation memory are not cached.
+
+"""
+
+import asyncio
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from nnserver.dispatch import is_error_result
+
+
+def _storable(value):
+    """ Whether a result is the model's own and may be cached """
+    return not is_error_result(value) and not value.get("reused")
+
+
+def normalize_segment(segment):
+    """ Canonical form of a source segment used as cache key """
+    return " ".join(unicodedata.normalize("NFC", segment).split())
+
+
+class MemoryBackend:
+    """ Size bounded LRU with optional time to live (in seconds) """
+
+    def __init__(self, max_size, ttl=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            created, value = entry
+            if self.ttl and time.time() - created > self.ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SqliteBackend:
+    """ File backed store shared between processes.  Entries are evicted
+        least recently used first once max_size is exceeded. """
+
+    _EVICT_EVERY = 256
+
+    def __init__(self, path, max_size, ttl=0):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self._local = threading.local()
+        self._puts = 0
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS segment_cache ("
+                " key TEXT PRIMARY KEY, value TEXT, created REAL, used REAL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS segment_cache_used ON segment_cache (used)"
+            )
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT value, created FROM segment_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        value, created = row
+        now = time.time()
+        if self.ttl and now - created > self.ttl:
+            conn.execute("DELETE FROM segment_cache WHERE key = ?", (key,))
+            return None
+        conn.execute("UPDATE segment_cache SET used = ? WHERE key = ?", (now, key))
+        return json.loads(value)
+
+    def put(self, key, value):
+        conn = self._connection()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO segment_cache (key, value, created, used)"
+            " VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False), now, now),
+        )
+        self._puts += 1
+        if self._puts % self._EVICT_EVERY == 0:
+            conn.execute(
+                "DELETE FROM segment_cache WHERE key IN (SELECT key FROM segment_cache"
+                " ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (self.max_size,),
+            )
+
+    def __len__(self):
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM segment_cache"
+        ).fetchone()[0]
+
+
+class SegmentCache:
+    """ Result cache keyed by (model name, normalized segment) that keeps
+        hit and miss counts """
+
+    def __init__(self, max_size=None, ttl=None, path=None):
+        env = os.environ.get
+        self.max_size = int(
+            max_size if max_size is not None else env("NNSERVER_CACHE_SIZE", 10000)
+        )
+        self.ttl = float(ttl if ttl is not None else env("NNSERVER_CACHE_TTL", 0))
+        path = path if path is not None else env("NNSERVER_CACHE_PATH", "")
+        self.backend = None
+        if self.max_size > 0:
+            if path:
+                self.backend = SqliteBackend(path, self.max_size, self.ttl)
+            else:
+                self.backend = MemoryBackend(self.max_size, self.ttl)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    @staticmethod
+    def _key(model_name, segment):
+        return "{}\t{}".format(model_name, normalize_segment(segment))
+
+    def lookup(self, model_name, pgs, fetch):
+        """ Return one result per segment in pgs, calling fetch(segments)
+            only for distinct segments that are not already cached """
+        keys, found, missing = self._partition(model_name, pgs)
+        if missing:
+            self._store(found, missing, fetch(list(missing.values())))
+        return self._collect(keys, found)
+
+    async def lookup_async(self, model_name, pgs, fetch):
+        """ Same as lookup, for a coroutine function fetch, with the
+            backend I/O in the default executor """
+        loop = asyncio.get_running_loop()
+        keys, found, missing = await loop.run_in_executor(
+            None, self._partition, model_name, pgs
+        )
+        if missing:
+            fetched = await fetch(list(missing.values()))
+            await loop.run_in_executor(None, self._store, found, missing, fetched)
+        return self._collect(keys, found)
+
+    def lookup_stream(self, model_name, pgs, fetch):
+        """ Yield (index, result) for each segment in pgs, cached ones first.
+            fetch(segments) must return an iterable of (index into
+            segments, result) pairs in any order; it is called before the
+            first cached result is yielded, so that it may admit the
+            request before anything is sent. """
+        keys, found, missing = self._partition(model_name, pgs)
+        positions = self._positions(keys, found)
+        fetched = fetch(list(missing.values())) if missing else ()
+        for idx, key in enumerate(keys):
+            if key in found:
+                yield idx, copy.deepcopy(found[key])
+        if missing:
+            missing_keys = list(missing.keys())
+            for local_idx, value in fetched:
+                for item in self._store_one(missing_keys[local_idx], value, positions):
+                    yield item
+
+    async def lookup_stream_async(self, model_name, pgs, fetch):
+        """ Same as lookup_stream, for a coroutine function fetch that
+            returns an async iterable, with the backend I/O in the default
+            executor """
+        loop = asyncio.get_running_loop()
+        keys, found, missing = await loop.run_in_executor(
+            None, self._partition, model_name, pgs
+        )
+        positions = self._positions(keys, found)
+        fetched = await fetch(list(missing.values())) if missing else None
+        for idx, key in enumerate(keys):
+            if key in found:
+                yield idx, copy.deepcopy(found[key])
+        if missing:
+            missing_keys = list(missing.keys())
+            async for local_idx, value in fetched:
+                items = await loop.run_in_executor(
+                    None, self._store_one, missing_keys[local_idx], value, positions
+                )
+                for item in items:
+                    yield item
+
+    @staticmethod
+    def _positions(keys, found):
+        positions = {}
+        for idx, key in enumerate(keys):
+            if key not in found:
+                positions.setdefault(key, []).append(idx)
+        return positions
+
+    def _store_one(self, key, value, positions):
+        if _storable(value):
+            self.backend.put(key, value)
+        return [(idx, copy.deepcopy(value)) for idx in positions[key]]
+
+    def _partition(self, model_name, pgs):
+        keys = [self._key(model_name, segment) for segment in pgs]
+        found = {}
+        missing = OrderedDict()
+        for key, segment in zip(keys, pgs):
+            if key in found or key in missing:
+                continue
+            value = self.backend.get(key)
+            if value is None:
+                missing[key] = segment
+            else:
+                found[key] = value
+        with self._lock:
+            self.hits += len(pgs) - len(missing)
+            self.misses += len(missing)
+        return keys, found, missing
+
+    def _store(self, found, missing, fetched):
+        for key, value in zip(missing.keys(), fetched):
+            if _storable(value):
+                self.backend.put(key, value)
+            found[key] = value
+
+    @staticmethod
+    def _collect(keys, found):
+        # Callers may mutate their results, never hand out the cached object
+        return [copy.deepcopy(found[key]) for key in keys]
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self.backend) if self.enabled else 0,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_cache():
+    """ Return the process wide segment cache """
+    global _CACHE
+    if _CACHE is None:
+        with _CACHE_LOCK:
+            if _CACHE is None:
+                _CACHE = SegmentCache()
+    return _CACHE
+
+
+def configure(**kwargs):
+    """ Replace the process wide segment cache """
+    global _CACHE
+    with _CACHE_LOCK:
+        _CACHE = SegmentCache(**kwargs)
+    return _CACHE
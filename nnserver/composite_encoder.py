@@ -27,10 +27,15 @@
 
 """
 
+import numpy as np
+
 from tensor2tensor.data_generators import text_encoder
 
 UNK = "<UNK>"
+# The closed parsing vocabulary has under two thousand distinct terminals
+MEMO_SIZE = 1 << 16
 EOS_ID = text_encoder.EOS_ID
+PAD_ID = text_encoder.PAD_ID
 
 
 class GRAMMAR_ITEMS:
@@ -203,10 +208,13 @@ class CompositeTokenEncoder:
     Subtokens should follow a simple right recursive rule with a couple of exceptions,
     namely case-control of verbs."""
 
-    def __init__(self, reorder=True):
+    def __init__(self, reorder=True, warm_path=None, memo_size=MEMO_SIZE):
         self._num_reserved_ids = len(text_encoder.RESERVED_TOKENS)
         self._reorder = reorder
         self._preprocess_word = lambda x: x
+        # Raw token -> tuple of subtoken ids, bounded by memo_size entries
+        self._memo = {}
+        self._memo_size = memo_size
 
         nonterminals = list(GRAMMAR_ITEMS.nonterminals) + [
             "/" + i for i in GRAMMAR_ITEMS.nonterminals
@@ -242,17 +250,49 @@ class CompositeTokenEncoder:
         self._htok_ids = set(self._htok_to_tok_id.values())
         self._ttok_ids = set(self._ttok_to_tok_id.values())
 
+        # Lookup table for decode_batch: each id maps to its string prefixed
+        # by the separator decode puts in front of it, a space when the id
+        # starts a new composite token and an underscore when it continues one
+        self._tok_id_to_joined = np.array(
+            [self._joined_subtoken(tok_id) for tok_id in range(len(self._all_tokens))],
+            dtype=object,
+        )
+
+        if warm_path is not None:
+            self.warm(warm_path)
+
+    def warm(self, path):
+        """Fill the memo table from a file with one token per line, such as
+        resources/parsing_tokens_191202.txt"""
+        with open(path, "r") as fp:
+            for line in fp:
+                token = line.strip()
+                if token:
+                    self._token_to_subtoken_ids(token)
+
     def encode(self, string):
-        result = self._tokens_to_subtoken_ids(list(string.split(" ")))
+        result = self._tokens_to_subtoken_ids(string.split(" "))
         return result
 
-    def _tokens_to_subtoken_ids(self, words):
+    def _tokens_to_subtoken_ids(self, tokens):
         result = []
-        for word in words:
-            result.extend(self._token_to_subtoken_ids(word))
+        memo = self._memo
+        for token in tokens:
+            ids = memo.get(token)
+            if ids is None:
+                ids = self._token_to_subtoken_ids(token)
+            result.extend(ids)
         return result
 
     def _token_to_subtoken_ids(self, token):
+        ids = self._memo.get(token)
+        if ids is None:
+            ids = tuple(self._compute_subtoken_ids(token))
+            if len(self._memo) < self._memo_size:
+                self._memo[token] = ids
+        return ids
+
+    def _compute_subtoken_ids(self, token):
         token = self._preprocess_word(token)
         if token in self._ftok_to_tok_id:
             return [self._ftok_to_tok_id[token]]
@@ -334,6 +374,49 @@ class CompositeTokenEncoder:
         result = ["_".join(subtokens) for subtokens in result if subtokens]
         return " ".join(result)
 
+    def _joined_subtoken(self, tok_id):
+        if 0 <= tok_id < self._num_reserved_ids:
+            return " " + text_encoder.RESERVED_TOKENS[tok_id]
+        if tok_id in self._ftok_ids or tok_id in self._htok_ids:
+            return " " + self._tok_id_to_tok_str[tok_id]
+        if tok_id in self._ttok_ids:
+            return "_" + self._tok_id_to_tok_str[tok_id]
+        return "_" + UNK
+
+    def decode_batch(self, rows, strip_eos=False):
+        """Decode many id sequences at once, returning the same strings as
+        decode for each row.  rows is a list of id lists or a 2d NumPy array;
+        with strip_eos each row is cut at its first EOS or padding id."""
+        if isinstance(rows, np.ndarray) and rows.ndim == 2:
+            matrix = rows
+        else:
+            rows = [np.asarray(row, dtype=np.int64) for row in rows]
+            if not rows:
+                return []
+            lengths = [len(row) for row in rows]
+            width = max(lengths)
+            if min(lengths) != width:
+                return [self._decode_row(row, strip_eos) for row in rows]
+            matrix = np.stack(rows) if width else np.zeros((len(rows), 0), np.int64)
+
+        ends = np.full(len(matrix), matrix.shape[1], dtype=np.int64)
+        if strip_eos and matrix.shape[1]:
+            stop = (matrix == EOS_ID) | (matrix == PAD_ID)
+            has_stop = stop.any(axis=1)
+            ends[has_stop] = stop.argmax(axis=1)[has_stop]
+        table = self._tok_id_to_joined
+        ids = np.clip(matrix, 0, len(table) - 1)
+        joined = table[ids]
+        return ["".join(row[:end].tolist())[1:] for (row, end) in zip(joined, ends)]
+
+    def _decode_row(self, row, strip_eos=False):
+        if strip_eos and len(row):
+            stop = np.flatnonzero((row == EOS_ID) | (row == PAD_ID))
+            if len(stop):
+                row = row[: stop[0]]
+        table = self._tok_id_to_joined
+        return "".join(table[np.clip(row, 0, len(table) - 1)].tolist())[1:]
+
     def decode_list(self, ids):
         result = []
         for tok_id in ids:
@@ -347,12 +430,6 @@ class CompositeTokenEncoder:
                 result.append(UNK)
         return result
 
-    def _tokens_to_subtoken_ids(self, tokens):
-        result = []
-        for token in tokens:
-            result.extend(self._token_to_subtoken_ids(token))
-        return result
-
     @property
     def vocab_size(self):
         return (
@@ -0,0 +1,169 @@
+"""
+    Reynir: Natural language processing for Icelandic
+
+    Per request decoding options
+
+    Copyright (C) 2020 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    A translate.api request may ask for "beam_size", "n_best" and
+    "max_length".  The exported models fix their beam at export time, so a
+    beam size is served by the model server signature exported with it,
+    from NNSERVER_BEAM_SIGNATURES, e.g. '{"1": "greedy", "4":
+    "serving_default"}'; a beam size without a signature is refused.
+    n_best keeps that many of the hypotheses the model returns, which come
+    back as a "hypotheses" list of {"outputs", "score"} with the best one
+    also in "outputs"; it is at most the beam size, which without a
+    beam_size is that of the beam mapped to "serving_default", or 1.  The
+    models bound their decode length by the input length, so max_length
+    (capped by NNSERVER_MAX_DECODE_LENGTH, 0 for no cap) refuses segments
+    longer than that many subword tokens before they reach the model
+    server.
+
+"""
+
+import json
+import os
+import threading
+from collections import namedtuple
+
+DEFAULT_SIGNATURE = "serving_default"
+
+
+class InvalidOptions(ValueError):
+    """ Decoding options that cannot be served, with the reason """
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class DecodeOptions(namedtuple("DecodeOptions", "beam_size n_best max_length")):
+    """ Decoding options of a request, None where the model default holds """
+
+    __slots__ = ()
+
+    @property
+    def default(self):
+        """ Whether results are those of the default decode, so that cached
+            results apply """
+        return self.beam_size is None and self.n_best is None
+
+
+DEFAULT = DecodeOptions(None, None, None)
+
+
+class DecodingConfig:
+    """ Beam signatures and limits of the decoding options """
+
+    def __init__(self, signatures=None, max_n_best=None, max_length=None):
+        env = os.environ.get
+        if signatures is None:
+            signatures = json.loads(env("NNSERVER_BEAM_SIGNATURES", "{}"))
+        self.signatures = {int(beam): name for (beam, name) in signatures.items()}
+        # Beam size of the default decode, as far as the signatures tell
+        self.default_beam = max(
+            (
+                beam
+                for (beam, name) in self.signatures.items()
+                if name == DEFAULT_SIGNATURE
+            ),
+            default=1,
+        )
+        self.max_n_best = int(
+            max_n_best if max_n_best is not None else env("NNSERVER_MAX_N_BEST", 8)
+        )
+        self.max_length = int(
+            max_length
+            if max_length is not None
+            else env("NNSERVER_MAX_DECODE_LENGTH", 0)
+        )
+
+    def _positive(self, obj, name):
+        value = obj.get(name)
+        if value is None:
+            return None
+        if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+            raise InvalidOptions("{} must be a positive integer".format(name))
+        return value
+
+    def options(self, obj):
+        """ Validated decoding options of a request """
+        beam_size = self._positive(obj, "beam_size")
+        n_best = self._positive(obj, "n_best")
+        max_length = self._positive(obj, "max_length")
+        if beam_size is not None and beam_size not in self.signatures:
+            raise InvalidOptions(
+                "Beam size {} not available, choose from {}".format(
+                    beam_size, sorted(self.signatures)
+                )
+            )
+        if n_best is not None:
+            if n_best > self.max_n_best:
+                raise InvalidOptions("n_best is at most {}".format(self.max_n_best))
+            beams = self.default_beam if beam_size is None else beam_size
+            if n_best > beams:
+                raise InvalidOptions("n_best is at most the beam size {}".format(beams))
+        if self.max_length:
+            max_length = min(max_length or self.max_length, self.max_length)
+        return DecodeOptions(beam_size, n_best, max_length)
+
+    def signature(self, options):
+        """ Model server signature that decodes with the options """
+        if options is None or options.beam_size is None:
+            return DEFAULT_SIGNATURE
+        return self.signatures[options.beam_size]
+
+
+def select(results, options):
+    """ Keep the n_best first hypotheses of each result """
+    if options is None or options.n_best is None:
+        return results
+    for result in results:
+        hypotheses = result.get("hypotheses")
+        if hypotheses is None:
+            continue
+        if options.n_best == 1:
+            del result["hypotheses"]
+        else:
+            result["hypotheses"] = hypotheses[: options.n_best]
+    return results
+
+
+_CONFIG = None
+_CONFIG_LOCK = threading.Lock()
+
+
+def get_config():
+    """ Return the process wide decoding configuration """
+    global _CONFIG
+    if _CONFIG is None:
+        with _CONFIG_LOCK:
+            if _CONFIG is None:
+                _CONFIG = DecodingConfig()
+    return _CONFIG
+
+
+def configure(**kwargs):
+    """ Replace the process wide decoding configuration """
+    global _CONFIG
+    with _CONFIG_LOCK:
+        _CONFIG = DecodingConfig(**kwargs)
+    return _CONFIG
+
+
+def options_from(obj):
+    """ Decoding options of a request, see DecodingConfig.options """
+    return get_config().options(obj)
@@ -0,0 +1,134 @@
+"""
+    Reynir: Natural language processing for Icelandic
+
+    Concurrent dispatch of sub-batches
+
+    Copyright (C) 2020 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    Large documents are split into chunks that are sent to the model
+    server concurrently by a bounded pool of worker threads.  A failing
+    chunk yields error results for its own segments instead of failing
+    the whole document.
+
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def error_result(reason):
+    """ Result returned in place of a segment whose chunk failed """
+    return {"valid": False, "reason": reason}
+
+
+def is_error_result(result):
+    return isinstance(result, dict) and result.get("valid") is False
+
+
+def chunked(indices, size):
+    """ Split a list of indices into pieces of at most size items """
+    if size <= 0:
+        return [indices]
+    return [indices[start : start + size] for start in range(0, len(indices), size)]
+
+
+class Dispatcher:
+    """ Runs a function over chunks with at most max_workers chunks in
+        flight at a time """
+
+    def __init__(self, max_workers=None, chunk_size=None):
+        env = os.environ.get
+        self.max_workers = int(
+            max_workers
+            if max_workers is not None
+            else env("NNSERVER_DISPATCH_WORKERS", 4)
+        )
+        self.chunk_size = int(
+            chunk_size if chunk_size is not None else env("NNSERVER_CHUNK_SIZE", 64)
+        )
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = os.getpid()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def map(self, fn, chunks):
+        """ Return fn(chunk) for each chunk in order, or the exception
+            it raised """
+        if len(chunks) <= 1 or self.max_workers <= 1:
+            outcomes = []
+            for chunk in chunks:
+                try:
+                    outcomes.append(fn(chunk))
+                except Exception as error:
+                    outcomes.append(error)
+            return outcomes
+
+        futures = [self._get_executor().submit(fn, chunk) for chunk in chunks]
+        outcomes = []
+        for future in futures:
+            error = future.exception()
+            outcomes.append(error if error is not None else future.result())
+        return outcomes
+
+    def imap_unordered(self, fn, chunks):
+        """ Yield (chunk, fn(chunk) or the exception it raised) as each
+            chunk finishes """
+        if len(chunks) <= 1 or self.max_workers <= 1:
+            for chunk in chunks:
+                try:
+                    yield chunk, fn(chunk)
+                except Exception as error:
+                    yield chunk, error
+            return
+
+        futures = {self._get_executor().submit(fn, chunk): chunk for chunk in chunks}
+        try:
+            for future in as_completed(futures):
+                error = future.exception()
+                yield futures[future], error if error is not None else future.result()
+        finally:
+            # The consumer went away (e.g. client disconnected), drop queued work
+            for future in futures:
+                future.cancel()
+
+
+_DISPATCHER = None
+_DISPATCHER_LOCK = threading.Lock()
+
+
+def get_dispatcher():
+    """ Return the process wide dispatcher """
+    global _DISPATCHER
+    if _DISPATCHER is None:
+        with _DISPATCHER_LOCK:
+            if _DISPATCHER is None:
+                _DISPATCHER = Dispatcher()
+    return _DISPATCHER
+
+
+def configure(**kwargs):
+    """ Replace the process wide dispatcher """
+    global _DISPATCHER
+    with _DISPATCHER_LOCK:
+        _DISPATCHER = Dispatcher(**kwargs)
+    return _DISPATCHER
@@ -63,7 +63,9 @@ class ParsingIcelandic16kV5(TranslateProblemV2):
 
   def feature_encoders(self, data_dir):
     enis_vocab = text_encoder.SubwordTextEncoder(_ENIS_VOCAB)
-    parse_token_vocab = composite_encoder.CompositeTokenEncoder(_PARSING_VOCAB)
+    parse_token_vocab = composite_encoder.CompositeTokenEncoder(
+        warm_path=_PARSING_VOCAB
+    )
     return {
         "inputs": enis_vocab,
         "targets": parse_token_vocab
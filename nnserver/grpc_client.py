@@ -0,0 +1,232 @@
+"""
+    Reynir: Natural language processing for Icelandic
+
+    gRPC transport to tensorflow_model_server
+
+    Copyright (C) 2020 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    This module sends predict calls over the gRPC PredictionService instead
+    of the RESTful interface.  Inputs are TensorProtos built directly from
+    the encoded batch, so serialized examples are not base64 encoded and
+    wrapped in JSON.  Responses are converted to the same row format as the
+    "predictions" list of the RESTful interface, so extract_results works
+    unchanged for both transports.
+
+    Requires the optional grpcio and tensorflow-serving-api packages, when
+    they are missing the RESTful transport is used.
+
+"""
+
+import os
+import threading
+
+import numpy
+from tensorflow.core.framework import tensor_pb2
+from tensorflow.core.framework import tensor_shape_pb2
+from tensorflow.core.framework import types_pb2
+
+try:
+    import grpc
+    from tensorflow_serving.apis import predict_pb2
+    from tensorflow_serving.apis import prediction_service_pb2_grpc
+except ImportError:
+    grpc = None
+
+
+REST = "rest"
+GRPC = "grpc"
+
+# Maximum message size, batches of long documents exceed the 4MB default
+_MAX_MESSAGE_BYTES = 256 * 1024 * 1024
+
+
+def available():
+    return grpc is not None
+
+
+def transport(default=None):
+    """ The configured transport, gRPC only when its packages are installed """
+    name = os.environ.get("NNSERVER_TRANSPORT", default or REST).lower()
+    if name == GRPC and available():
+        return GRPC
+    return REST
+
+
+def grpc_port(default=None):
+    return os.environ.get("MS_GRPC_PORT", default or 8500)
+
+
+def _shape(dims):
+    return tensor_shape_pb2.TensorShapeProto(
+        dim=[tensor_shape_pb2.TensorShapeProto.Dim(size=size) for size in dims]
+    )
+
+
+def string_tensor(values, dims=None):
+    """ DT_STRING tensor from a flat list of bytes or str values """
+    values = [v if isinstance(v, bytes) else v.encode("utf-8") for v in values]
+    return tensor_pb2.TensorProto(
+        dtype=types_pb2.DT_STRING,
+        tensor_shape=_shape(dims or [len(values)]),
+        string_val=values,
+    )
+
+
+def int_tensor(values, dims=None, dtype=types_pb2.DT_INT32):
+    tensor = tensor_pb2.TensorProto(
+        dtype=dtype, tensor_shape=_shape(dims or [len(values)])
+    )
+    if dtype == types_pb2.DT_INT64:
+        tensor.int64_val.extend(values)
+    else:
+        tensor.int_val.extend(values)
+    return tensor
+
+
+_VALUE_FIELDS = {
+    types_pb2.DT_FLOAT: "float_val",
+    types_pb2.DT_DOUBLE: "double_val",
+    types_pb2.DT_INT32: "int_val",
+    types_pb2.DT_INT16: "int_val",
+    types_pb2.DT_INT8: "int_val",
+    types_pb2.DT_UINT8: "int_val",
+    types_pb2.DT_INT64: "int64_val",
+    types_pb2.DT_STRING: "string_val",
+    types_pb2.DT_BOOL: "bool_val",
+}
+
+
+_CONTENT_DTYPES = {
+    types_pb2.DT_FLOAT: "<f4",
+    types_pb2.DT_DOUBLE: "<f8",
+    types_pb2.DT_INT32: "<i4",
+    types_pb2.DT_INT64: "<i8",
+}
+
+
+def _tensor_values(tensor):
+    dims = [dim.size for dim in tensor.tensor_shape.dim]
+    count = 1
+    for size in dims:
+        count *= size
+    if tensor.tensor_content and tensor.dtype in _CONTENT_DTYPES:
+        values = numpy.frombuffer(
+            tensor.tensor_content, dtype=_CONTENT_DTYPES[tensor.dtype]
+        ).tolist()
+        return dims, values
+    field = _VALUE_FIELDS.get(tensor.dtype)
+    if field is None:
+        raise ValueError("Unsupported output dtype {}".format(tensor.dtype))
+    values = list(getattr(tensor, field))
+    if tensor.dtype == types_pb2.DT_STRING:
+        values = [value.decode("utf-8") for value in values]
+    if values and len(values) < count:
+        # TensorProto convention: the last value fills the remainder
+        values.extend([values[-1]] * (count - len(values)))
+    return dims, values
+
+
+def _nest(values, dims):
+    if len(dims) <= 1:
+        return values
+    step = len(values) // dims[0] if dims[0] else 0
+    return [_nest(values[i * step : (i + 1) * step], dims[1:]) for i in range(dims[0])]
+
+
+def to_predictions(outputs):
+    """ Convert a map of output TensorProtos into the row format of the
+        RESTful interface: one dict per batch item """
+    columns = {}
+    batch_size = None
+    for name, tensor in outputs.items():
+        dims, values = _tensor_values(tensor)
+        if not dims:
+            continue
+        batch_size = dims[0] if batch_size is None else batch_size
+        columns[name] = _nest(values, dims)
+    if batch_size is None:
+        return []
+    return [
+        {name: rows[idx] for name, rows in columns.items()}
+        for idx in range(batch_size)
+    ]
+
+
+class GrpcClient:
+    """ Keeps one channel per model server host and port """
+
+    def __init__(self, timeout=None):
+        self.timeout = float(
+            timeout
+            if timeout is not None
+            else os.environ.get("NNSERVER_READ_TIMEOUT", 300)
+        )
+        self._lock = threading.Lock()
+        self._stubs = {}
+        self._pid = os.getpid()
+
+    def _stub(self, host, port):
+        key = (str(host), str(port))
+        with self._lock:
+            if self._pid != os.getpid():
+                self._stubs = {}
+                self._pid = os.getpid()
+            stub = self._stubs.get(key)
+            if stub is None:
+                channel = grpc.insecure_channel(
+                    "{}:{}".format(host, port),
+                    options=[
+                        ("grpc.max_send_message_length", _MAX_MESSAGE_BYTES),
+                        ("grpc.max_receive_message_length", _MAX_MESSAGE_BYTES),
+                    ],
+                )
+                stub = prediction_service_pb2_grpc.PredictionServiceStub(channel)
+                self._stubs[key] = stub
+        return stub
+
+    def predict(
+        self,
+        host,
+        port,
+        model_name,
+        inputs,
+        signature_name="serving_default",
+        timeout=None,
+    ):
+        """ Call Predict and return a dict like the RESTful response """
+        request = predict_pb2.PredictRequest()
+        request.model_spec.name = model_name
+        request.model_spec.signature_name = signature_name
+        for name, tensor in inputs.items():
+            request.inputs[name].CopyFrom(tensor)
+        response = self._stub(host, port).Predict(
+            request, timeout=self.timeout if timeout is None else timeout
+        )
+        return {"predictions": to_predictions(response.outputs)}
+
+
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_client():
+    """ Return the process wide gRPC client """
+    global _CLIENT
+    if _CLIENT is None:
+        with _CLIENT_LOCK:
+            if _CLIENT is None:
+                _CLIENT = GrpcClient()
+    return _CLIENT
@@ -0,0 +1,203 @@
+"""
+    Reynir: Natural language processing for Icelandic
+
+    Model server connection pool
+
+    Copyright (C) 2020 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    This module keeps one keep-alive requests.Session per model server
+    (host, port) in each worker process, so that consecutive calls to
+    the model server reuse TCP connections instead of opening a new one
+    for every request.
+
+"""
+
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def _env_bool(name, default):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() not in ("0", "false", "no", "off", "")
+
+
+class PoolConfig:
+    """ Settings for the model server connection pool, read from the
+        environment with NNSERVER_ prefixed variables """
+
+    def __init__(
+        self,
+        pool_size=None,
+        keepalive=None,
+        connect_timeout=None,
+        read_timeout=None,
+        retries=None,
+        backoff=None,
+    ):
+        env = os.environ.get
+        self.pool_size = int(
+            pool_size if pool_size is not None else env("NNSERVER_POOL_SIZE", 10)
+        )
+        self.keepalive = (
+            keepalive
+            if keepalive is not None
+            else _env_bool("NNSERVER_POOL_KEEPALIVE", True)
+        )
+        self.connect_timeout = float(
+            connect_timeout
+            if connect_timeout is not None
+            else env("NNSERVER_CONNECT_TIMEOUT", 5)
+        )
+        # Matches the gunicorn worker timeout in the Dockerfile
+        self.read_timeout = float(
+            read_timeout
+            if read_timeout is not None
+            else env("NNSERVER_READ_TIMEOUT", 300)
+        )
+        self.retries = int(retries if retries is not None else env("NNSERVER_RETRIES", 2))
+        self.backoff = float(
+            backoff if backoff is not None else env("NNSERVER_RETRY_BACKOFF", 0.2)
+        )
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+
+class SessionPool:
+    """ Per process registry of keep-alive sessions, keyed by model server
+        host and port.
+
+        Predict calls are side effect free, so POST is retried (with
+        exponential backoff) on connection errors and on the gateway
+        status codes a restarting model server answers with.  A read
+        timeout is not retried: the model server may still be working on
+        the batch, and waiting for it again would outlast the worker
+        timeout. """
+
+    RETRY_STATUS = (502, 503, 504)
+
+    def __init__(self, config=None):
+        self.config = config or PoolConfig()
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._pid = os.getpid()
+
+    def _make_session(self):
+        config = self.config
+        retry = Retry(
+            total=config.retries,
+            connect=config.retries,
+            read=False,
+            status=config.retries,
+            backoff_factor=config.backoff,
+            status_forcelist=self.RETRY_STATUS,
+            allowed_methods=frozenset(["GET", "POST"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=config.pool_size, max_retries=retry
+        )
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if not config.keepalive:
+            session.headers["Connection"] = "close"
+        return session
+
+    def session(self, host, port):
+        """ Return the session for a model server, creating it on first use """
+        key = (str(host), str(port))
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked (e.g. gunicorn with --preload), sockets must not be shared
+                self._sessions = {}
+                self._pid = os.getpid()
+            session = self._sessions.get(key)
+            if session is None:
+                session = self._make_session()
+                self._sessions[key] = session
+        return session
+
+    def post(self, host, port, url, **kwargs):
+        kwargs.setdefault("timeout", self.config.timeout)
+        return self.session(host, port).post(url, **kwargs)
+
+    def get(self, host, port, url, **kwargs):
+        kwargs.setdefault("timeout", self.config.timeout)
+        return self.session(host, port).get(url, **kwargs)
+
+    def stats(self):
+        """ Connection reuse counters per model server.  A hit is a request
+            served on an already open connection, a miss is a request that
+            had to open a new one. """
+        result = {}
+        with self._lock:
+            sessions = list(self._sessions.items())
+        for (host, port), session in sessions:
+            requests_made = connections_made = 0
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for pool_key in pools.keys():
+                    pool = pools.get(pool_key)
+                    if pool is None:
+                        continue
+                    requests_made += pool.num_requests
+                    connections_made += pool.num_connections
+            hits = max(requests_made - connections_made, 0)
+            result["{}:{}".format(host, port)] = {
+                "requests": requests_made,
+                "hits": hits,
+                "misses": connections_made,
+                "reuse_rate": hits / requests_made if requests_made else 0.0,
+            }
+        return result
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool():
+    """ Return the process wide session pool """
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                _POOL = SessionPool()
+    return _POOL
+
+
+def configure(**kwargs):
+    """ Replace the process wide pool with one using the given settings """
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.close()
+        _POOL = SessionPool(PoolConfig(**kwargs))
+    return _POOL
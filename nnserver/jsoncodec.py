@@ -0,0 +1,72 @@
+"""
+    Reynir: Natural language processing for Icelandic
+
+    JSON encoding and decoding
+
+    Copyright (C) 2020 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    Model server replies hold thousands of ids and scores per batch, and
+    API replies hold the results of every segment.  loads parses straight
+    from the bytes of a body and dumps returns compact UTF-8 bytes, with
+    the optional orjson package when it is installed and the standard
+    library otherwise.  NNSERVER_JSON=json forces the standard library.
+
+"""
+
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ORJSON = "orjson"
+STDLIB = "json"
+
+
+def _backend():
+    name = os.environ.get("NNSERVER_JSON", ORJSON).lower()
+    if name == ORJSON and orjson is not None:
+        return ORJSON
+    return STDLIB
+
+
+backend = _backend()
+
+if backend == ORJSON:
+    _OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    def loads(data):
+        """ Parse JSON from bytes or str """
+        return orjson.loads(data)
+
+    def dumps(obj):
+        """ Compact UTF-8 encoded JSON """
+        return orjson.dumps(obj, option=_OPTIONS)
+
+
+else:
+
+    def loads(data):
+        """ Parse JSON from bytes or str """
+        return json.loads(data)
+
+    def dumps(obj):
+        """ Compact UTF-8 encoded JSON """
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode(
+            "utf-8"
+        )
@@ -31,6 +31,13 @@
         http://localhost:8080/translate.api \
         --data '{"pgs":["Hvernig komstu þangað?"],"signature_name":"serving_default"}'
 
+    Add "stream": true to a translate.api request to receive one JSON line per
+    segment, {"index": ..., "result": ...}, in the order they finish.
+
+    Add "segment": true to split each paragraph in pgs into sentences before
+    translating or parsing; each paragraph result then holds the joined
+    "outputs", a list of sentence "scores" and the full "sentences" results.
+
     To test a running model server directly, try:
     curl --header "Content-Type: application/json" \
         --request POST \
@@ -49,26 +56,47 @@
 """
 
 import base64
-import json
+import contextlib
+import functools
 import os
-import requests
 import itertools
+import time
 
 from tensor2tensor.data_generators import text_encoder
-from tensorflow.core.example import feature_pb2
-from tensorflow.core.example import example_pb2
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, request, stream_with_context
 
 from nnserver import _ENIS_VOCAB, _ONMT_EN_VOCAB, _ONMT_IS_VOCAB
 from nnserver.composite_encoder import CompositeTokenEncoder
+from nnserver.request_log import RequestLog, new_request_id
+from nnserver import (
+    admission,
+    balancer,
+    batching,
+    bpe,
+    bucketing,
+    cache,
+    decoding,
+    dispatch,
+    grpc_client,
+    http_pool,
+    jsoncodec,
+    metrics,
+    segmentation,
+    subword_encoder,
+    tf_example,
+    translation_memory,
+    vocab,
+)
 
-from subword_nmt import apply_bpe
 
 EOS_ID = text_encoder.EOS_ID
 PAD_ID = text_encoder.PAD_ID
 
+_JSON_CONTENT_TYPE = {"Content-Type": "application/json"}
+
 app = Flask(__name__)
+request_log = RequestLog(app.logger)
 
 
 MODEL_NAMES = {
@@ -86,12 +114,14 @@ class _SubwordNmtEncoder:
     """Wrap subword-nmt's BPE encoder with Tensor2tensors api"""
 
     def __init__(self, path):
-        with open(path, "r") as fp:
-            self._bpe = apply_bpe.BPE(fp)
+        self._bpe = bpe.BytePairEncoder(path)
 
     def encode(self, text):
         return self._bpe.process_line(text)
 
+    def encode_batch(self, texts):
+        return self._bpe.process_lines(texts)
+
     def decode(self, flat_text):
         res = flat_text.replace("@@ ", "")
         if len(res) > 1 and flat_text[-2] == "@@":
@@ -101,6 +131,53 @@ class _SubwordNmtEncoder:
     def decode_list(self, flat_text):
         return flat_text
 
+
+def _subword_text_encoder(path):
+    return subword_encoder.BatchSubwordEncoder(text_encoder.SubwordTextEncoder(path))
+
+
+class Encodings:
+    """ Subword encoding of each distinct segment of a request, made by the
+        length pass and read again when the batch is serialized, so that
+        a segment is encoded once """
+
+    def __init__(self, server):
+        self.server = server
+        self.src = {}
+        self.tgt = {}
+
+    def add(self, pgs, tgt_pgs=None):
+        """ Encode the segments not seen before """
+        self.source(pgs)
+        if tgt_pgs is not None:
+            self.target(tgt_pgs)
+
+    def source(self, pgs):
+        return self._encode(self.src, self.server.src_enc, pgs)
+
+    def target(self, tgt_pgs):
+        return self._encode(self.tgt, self.server.tgt_enc, tgt_pgs)
+
+    def _encode(self, memo, enc, segments):
+        missing = [segment for segment in dict.fromkeys(segments) if segment not in memo]
+        if missing:
+            memo.update(zip(missing, self.server.encode_segments(missing, enc)))
+        return [memo[segment] for segment in segments]
+
+    def merged(self, others):
+        """ Encodings of self and others together, for a merged batch """
+        merged = Encodings(self.server)
+        for encodings in [self] + list(others):
+            merged.src.update(encodings.src)
+            merged.tgt.update(encodings.tgt)
+        return merged
+
+    def tokens(self):
+        """ Model side tokens of the distinct segments encoded so far """
+        length = self.server.encoded_length
+        return sum(map(length, self.src.values())) + sum(map(length, self.tgt.values()))
+
+
 class NnServer:
     """ Client that mimics the HTTP RESTful interface of
         a tensorflow model server, but accepts plain text. """
@@ -108,18 +185,267 @@ class NnServer:
     _tfms_version = "v1"
     _model_name = "transformer"
     _verb = "predict"
+    # Whether results for a segment may be served from the segment cache
+    _cacheable = False
+    # Whether translations of near duplicate segments may be reused
+    _reusable = False
     src_enc = None
     tgt_enc = None
 
     @classmethod
-    def request(cls, pgs, tgt_pgs=None, model_name=None):
-        """ Send serialized request to remote model server """
+    def request(
+        cls,
+        pgs,
+        tgt_pgs=None,
+        model_name=None,
+        deadline=None,
+        options=None,
+        encodings=None,
+    ):
+        """ Send serialized request to remote model server, merged with
+            concurrent requests to the same model when batching is enabled.
+            The segments sent are encoded into encodings, if given. """
+
+        if model_name is None:
+            model_name = cls._model_name
+        if encodings is None:
+            encodings = Encodings(cls)
+        if options is not None and options.max_length:
+            keep, results = cls.within_length(
+                pgs, tgt_pgs, options.max_length, encodings
+            )
+            if keep:
+                kept = cls.request(
+                    [pgs[idx] for idx in keep],
+                    None if tgt_pgs is None else [tgt_pgs[idx] for idx in keep],
+                    model_name=model_name,
+                    deadline=deadline,
+                    options=options._replace(max_length=None),
+                    encodings=encodings,
+                )
+                for idx, result in zip(keep, kept):
+                    results[idx] = result
+            return results
+
+        def fetch(segments, tgt_segments=None):
+            encodings.add(segments, tgt_segments)
+            return batching.get_batcher().submit(
+                (cls, model_name, options),
+                functools.partial(cls._request, model_name=model_name, options=options),
+                segments,
+                tgt_segments,
+                deadline=deadline,
+                encodings=encodings,
+            )
+
+        # Remembered and cached results are those of the default decode
+        default = options is None or options.default
+        memory = translation_memory.get_memory()
+        if cls._reusable and tgt_pgs is None and default and memory.enabled:
+            model_fetch = fetch
+
+            def fetch(segments, tgt_segments=None):
+                return memory.lookup(model_name, segments, model_fetch)
+
+        segment_cache = cache.get_cache()
+        if cls._cacheable and tgt_pgs is None and default and segment_cache.enabled:
+            return segment_cache.lookup(model_name, pgs, fetch)
+        return fetch(pgs, tgt_pgs)
+
+    @classmethod
+    def within_length(cls, pgs, tgt_pgs, max_length, encodings=None):
+        """ Indices of the segments of at most max_length subword tokens,
+            and a result list holding an error for the others """
+        lengths = cls.segment_lengths(pgs, tgt_pgs, encodings)
+        keep = [idx for (idx, length) in enumerate(lengths) if length <= max_length]
+        results = [dispatch.error_result("Segment too long") for _ in pgs]
+        return keep, results
+
+    @classmethod
+    def request_stream(
+        cls, pgs, model_name=None, deadline=None, options=None, encodings=None
+    ):
+        """ Yield (index, result) pairs as soon as each sub-batch is
+            done, cached segments first.  The request is admitted before
+            the first pair is yielded, so admission.Rejected is raised by
+            the first next() and never in the middle of the stream. """
 
         if model_name is None:
             model_name = cls._model_name
+        if encodings is None:
+            encodings = Encodings(cls)
+        if options is not None and options.max_length:
+            keep, results = cls.within_length(pgs, None, options.max_length, encodings)
+            kept = set(keep)
+            refused = [
+                (idx, result) for (idx, result) in enumerate(results) if idx not in kept
+            ]
+            if keep:
+                for idx, result in cls.request_stream(
+                    [pgs[idx] for idx in keep],
+                    model_name=model_name,
+                    deadline=deadline,
+                    options=options._replace(max_length=None),
+                    encodings=encodings,
+                ):
+                    yield keep[idx], result
+                    # After the first result, once the request is admitted
+                    yield from refused
+                    refused = []
+            yield from refused
+            return
+
+        dispatcher = dispatch.get_dispatcher()
+
+        def stream(segments, chunks):
+            def send_chunk(chunk):
+                return cls._request_batch(
+                    [segments[idx] for idx in chunk],
+                    model_name=model_name,
+                    deadline=deadline,
+                    options=options,
+                    encodings=encodings,
+                )
+
+            for chunk, outcome in dispatcher.imap_unordered(send_chunk, chunks):
+                if isinstance(outcome, Exception):
+                    outcome = cls.chunk_error(chunk, outcome)
+                yield from zip(chunk, outcome)
+
+        # Held until this generator finishes or is closed
+        with contextlib.ExitStack() as admitted:
+
+            def fetch(segments):
+                """ Admit the segments now, and stream their results """
+                lengths = cls.segment_lengths(segments, encodings=encodings)
+                controller = admission.get_controller()
+                admitted.enter_context(
+                    controller.admit(model_name, len(segments), sum(lengths), deadline)
+                )
+                chunks = cls.plan_chunks(
+                    segments, None, dispatcher.chunk_size, model_name, lengths
+                )
+                return stream(segments, chunks)
+
+            segment_cache = cache.get_cache()
+            default = options is None or options.default
+            if cls._cacheable and default and segment_cache.enabled:
+                yield from segment_cache.lookup_stream(model_name, pgs, fetch)
+            else:
+                yield from fetch(pgs)
+
+    @classmethod
+    def _request(
+        cls,
+        pgs,
+        tgt_pgs=None,
+        model_name=None,
+        deadline=None,
+        options=None,
+        encodings=None,
+    ):
+        """ Split a batch into length buckets and send them concurrently
+            to the remote model server, results are in the order of pgs.
+            Segments of a failed chunk get an error result unless every
+            chunk failed, in which case the error is raised. """
+
+        dispatcher = dispatch.get_dispatcher()
+        if encodings is None:
+            encodings = Encodings(cls)
+        lengths = cls.segment_lengths(pgs, tgt_pgs, encodings)
+        controller = admission.get_controller()
+        with controller.admit(model_name, len(pgs), sum(lengths), deadline):
+            chunks = cls.plan_chunks(
+                pgs, tgt_pgs, dispatcher.chunk_size, model_name, lengths
+            )
 
+            def send_chunk(chunk):
+                return cls._request_batch(
+                    [pgs[idx] for idx in chunk],
+                    None if tgt_pgs is None else [tgt_pgs[idx] for idx in chunk],
+                    model_name=model_name,
+                    deadline=deadline,
+                    options=options,
+                    encodings=encodings,
+                )
+
+            outcomes = dispatcher.map(send_chunk, chunks)
+        return cls.merge_chunks(len(pgs), chunks, outcomes)
+
+    @classmethod
+    def segment_lengths(cls, pgs, tgt_pgs=None, encodings=None):
+        """ Model side length of each segment, or of its target if longer """
+        if encodings is None:
+            encodings = Encodings(cls)
+        lengths = [cls.encoded_length(ids) for ids in encodings.source(pgs)]
+        if tgt_pgs is not None:
+            lengths = [
+                max(length, cls.encoded_length(tgt_ids))
+                for (length, tgt_ids) in zip(lengths, encodings.target(tgt_pgs))
+            ]
+        return lengths
+
+    @classmethod
+    def plan_chunks(
+        cls, pgs, tgt_pgs=None, chunk_size=0, model_name=None, lengths=None
+    ):
+        """ Indices of pgs grouped into length bucketed chunks """
+        if lengths is None:
+            lengths = cls.segment_lengths(pgs, tgt_pgs)
+        metrics.observe_segments(model_name or cls._model_name, lengths)
+        buckets = bucketing.get_bucketer().split(lengths)
+        return [
+            chunk for bucket in buckets for chunk in dispatch.chunked(bucket, chunk_size)
+        ]
+
+    @staticmethod
+    def chunk_error(chunk, error):
+        """ Error results for the segments of a failed chunk """
+        if isinstance(error, admission.Rejected):
+            return [dispatch.error_result(error.reason) for _ in chunk]
+        app.logger.error("Chunk of {} segments failed: {}".format(len(chunk), error))
+        return [dispatch.error_result("Model server error") for _ in chunk]
+
+    @classmethod
+    def merge_chunks(cls, num_segments, chunks, outcomes):
+        """ Results of each chunk (or the exception it raised) put back in
+            the original segment order """
+        errors = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+        if errors and len(errors) == len(outcomes):
+            raise errors[0]
+
+        results = [None] * num_segments
+        for chunk, outcome in zip(chunks, outcomes):
+            if isinstance(outcome, Exception):
+                outcome = cls.chunk_error(chunk, outcome)
+            for idx, result in zip(chunk, outcome):
+                results[idx] = result
+        return results
+
+    @classmethod
+    def encode_segments(cls, pgs, enc=None):
+        """ Subtoken ids of each segment """
+        return subword_encoder.encode_batch(enc or cls.src_enc, pgs)
+
+    @staticmethod
+    def encoded_length(ids):
+        """ Number of subword tokens the model sees for an encoded segment """
+        return len(ids) + 1
+
+    @classmethod
+    def choose_replica(cls, model_name):
+        """ Model server replica to send the next call for a model to, and
+            whether the call is its half open trial """
         ms_host = os.environ.get("MS_HOST", app.config.get("out_host"))
         ms_port = os.environ.get("MS_PORT", app.config.get("out_port"))
+        return balancer.get_balancer().choose(model_name, ms_host, ms_port)
+
+    @classmethod
+    def model_url(cls, model_name, replica=None):
+        """ Host, port and RESTful endpoint of a model on the model server """
+        if replica is None:
+            replica, _ = cls.choose_replica(model_name)
+        ms_host, ms_port = replica.host, replica.port
 
         url = "http://{host}:{port}/{version}/models/{model}:{verb}".format(
             port=ms_port,
@@ -128,17 +454,94 @@ class NnServer:
             model=model_name,
             verb=cls._verb,
         )
-        payload = cls.package_data(pgs, tgt_pgs)
-        headers = {"content-type": "application/json"}
-
-        app.logger.debug(payload)
+        return ms_host, ms_port, url
 
-        resp = requests.post(url, json=payload)
-        resp.raise_for_status()
+    @classmethod
+    def _request_batch(
+        cls,
+        pgs,
+        tgt_pgs=None,
+        model_name=None,
+        deadline=None,
+        options=None,
+        encodings=None,
+    ):
+        """ Send a single serialized batch to the remote model server """
 
-        obj = json.loads(resp.text)
-        results = cls.extract_results(
-            obj, pgs, tgt_pgs=tgt_pgs, src_enc=cls.src_enc, tgt_enc=cls.tgt_enc
+        if model_name is None:
+            model_name = cls._model_name
+        admission.check(deadline)
+        left = admission.remaining(deadline)
+        signature_name = decoding.get_config().signature(options)
+
+        metrics.observe_batch(model_name, len(pgs))
+        transport = grpc_client.transport(app.config.get("transport"))
+
+        start = time.perf_counter()
+        if transport == grpc_client.GRPC:
+            ms_grpc_port = grpc_client.grpc_port(app.config.get("out_grpc_port"))
+            with metrics.timed("encode", model_name):
+                inputs = cls.package_tensors(pgs, tgt_pgs, encodings)
+            encoded = time.perf_counter()
+            replica, trial = cls.choose_replica(model_name)
+            client = grpc_client.get_client()
+            own_timeout = left is None or left >= client.timeout
+            with metrics.timed("model_server", model_name), replica.track(
+                own_timeout, trial
+            ):
+                obj = client.predict(
+                    replica.host,
+                    replica.grpc_port or ms_grpc_port,
+                    model_name,
+                    inputs,
+                    signature_name=signature_name,
+                    timeout=left,
+                )
+        else:
+            with metrics.timed("encode", model_name):
+                body = cls.package_body(pgs, tgt_pgs, signature_name, encodings)
+            encoded = time.perf_counter()
+
+            if request_log.trace():
+                request_log.detail("payload: %s", body.decode("utf-8"))
+
+            replica, trial = cls.choose_replica(model_name)
+            ms_host, ms_port, url = cls.model_url(model_name, replica)
+            pool = http_pool.get_pool()
+            timeout = pool.config.timeout
+            own_timeout = left is None or left >= timeout[1]
+            if not own_timeout:
+                timeout = (pool.config.connect_timeout, left)
+            with metrics.timed("model_server", model_name), replica.track(
+                own_timeout, trial
+            ):
+                resp = pool.post(
+                    ms_host,
+                    ms_port,
+                    url,
+                    data=body,
+                    headers=_JSON_CONTENT_TYPE,
+                    timeout=timeout,
+                )
+                resp.raise_for_status()
+                obj = jsoncodec.loads(resp.content)
+        received = time.perf_counter()
+
+        with metrics.timed("decode", model_name):
+            results = cls.extract_results(
+                obj, pgs, tgt_pgs=tgt_pgs, src_enc=cls.src_enc, tgt_enc=cls.tgt_enc
+            )
+            results = decoding.select(results, options)
+        request_log.summary(
+            "batch",
+            model=model_name,
+            transport=transport,
+            replica="{}:{}".format(replica.host, replica.port),
+            segments=len(pgs),
+            chars=sum(len(segment) for segment in pgs),
+            encode_ms=round(1000 * (encoded - start), 2),
+            model_server_ms=round(1000 * (received - encoded), 2),
+            decode_ms=round(1000 * (time.perf_counter() - received), 2),
         )
         return results
 
@@ -149,81 +552,161 @@ class NnServer:
         src_enc = src_enc or cls.src_enc
         tgt_enc = tgt_enc or cls.tgt_enc
 
-        def process_response_instance(instance, src_enc=src_enc, tgt_enc=tgt_enc):
+        trace = request_log.trace()
+
+        def process_response_instance(
+            instance, outputs=None, src_enc=src_enc, tgt_enc=tgt_enc
+        ):
             scores = instance["scores"]
             output_ids = instance["outputs"]
 
-            app.logger.debug("scores: " + str(scores))
-            app.logger.debug("output_ids: " + str(output_ids))
+            if trace:
+                request_log.detail("scores: %s", scores)
+                request_log.detail("output_ids: %s", output_ids)
 
             # Strip padding and eos token
             length = len(output_ids)
             pad_start = output_ids.index(PAD_ID) if PAD_ID in output_ids else length
             eos_start = output_ids.index(EOS_ID) if EOS_ID in output_ids else length
             sent_end = min(pad_start, eos_start)
-            outputs = tgt_enc.decode(output_ids[:sent_end])
+            if outputs is None:
+                outputs = tgt_enc.decode(output_ids[:sent_end])
 
-            app.logger.debug(
-                "tokenized and depadded: "
-                + str(tgt_enc.decode_list(output_ids[:sent_end]))
-            )
-            app.logger.info(outputs)
+            if trace:
+                request_log.detail(
+                    "tokenized and depadded: %s",
+                    tgt_enc.decode_list(output_ids[:sent_end]),
+                )
+                request_log.detail("outputs: %s", outputs)
 
             instance["outputs"] = outputs
             return instance
 
-        predictions = resp_json_obj["predictions"]
+        predictions = resp_json_obj["predictions"][: len(pgs)]
+        if predictions and predictions[0]["outputs"]:
+            if isinstance(predictions[0]["outputs"][0], list):
+                return cls.extract_beams(predictions, src_enc, tgt_enc)
+        if hasattr(tgt_enc, "decode_batch"):
+            decoded = tgt_enc.decode_batch(
+                [inst["outputs"] for inst in predictions], strip_eos=True
+            )
+        else:
+            decoded = itertools.repeat(None)
         results = [
-            process_response_instance(inst) for (inst, sent) in zip(predictions, pgs)
+            process_response_instance(inst, outputs)
+            for (inst, outputs) in zip(predictions, decoded)
         ]
         return results
 
     @classmethod
-    def package_data(cls, pgs, tgt_pgs=None):
+    def extract_beams(cls, predictions, src_enc=None, tgt_enc=None):
+        """ Results of a model exported with return_beams, whose outputs
+            hold one row of ids and scores one score per hypothesis """
+        rows = [
+            {"outputs": output_ids, "scores": score}
+            for inst in predictions
+            for (output_ids, score) in zip(inst["outputs"], inst["scores"])
+        ]
+        decoded = cls.extract_results(
+            {"predictions": rows}, rows, src_enc=src_enc, tgt_enc=tgt_enc
+        )
+        results = []
+        offset = 0
+        for inst in predictions:
+            hypotheses = [
+                {"outputs": row["outputs"], "score": row["scores"]}
+                for row in decoded[offset : offset + len(inst["outputs"])]
+            ]
+            offset += len(inst["outputs"])
+            results.append(
+                {
+                    "outputs": hypotheses[0]["outputs"],
+                    "scores": hypotheses[0]["score"],
+                    "hypotheses": hypotheses,
+                }
+            )
+        return results
 
-        def serialize_to_instance(
-            src_segment, src_enc=None, tgt_segment=None, tgt_enc=None
-        ):
-            """ Encodes a single sentence into the format expected by the RESTful
-                interface of tensorflow_model_server running an exported tensor2tensor
+    @classmethod
+    def serialize_examples(cls, pgs, tgt_pgs=None, encodings=None):
+        """ Serialized tf.Example protobufs, one per segment """
+        if encodings is None:
+            encodings = Encodings(cls)
+        trace = request_log.trace()
+        src_enc = cls.src_enc
+        tgt_enc = cls.tgt_enc
+
+        def serialize_example(src_segment, input_ids, tgt_segment=None, tgt_ids=None):
+            """ Encodes a single sentence into the tf.Example expected by
+                tensorflow_model_server running an exported tensor2tensor
                 transformer translation model
             """
 
-            src_enc = src_enc or cls.src_enc
-            tgt_enc = tgt_enc or cls.tgt_enc
-
-            input_ids = src_enc.encode(src_segment) + [EOS_ID]
-            app.logger.info("input_segment: " + src_segment)
-            app.logger.debug("input_subtokens: " + str(src_enc.decode_list(input_ids)))
-            app.logger.debug("input_ids: " + str(input_ids))
-
-            int64_list = feature_pb2.Int64List(value=input_ids)
-            feature = feature_pb2.Feature(int64_list=int64_list)
-            feature_map = {"inputs": feature}
+            input_ids = input_ids + [EOS_ID]
+            if trace:
+                request_log.detail("input_segment: %s", src_segment)
+                request_log.detail("input_subtokens: %s", src_enc.decode_list(input_ids))
+                request_log.detail("input_ids: %s", input_ids)
 
             if tgt_segment is not None:
-                tgt_ids = tgt_enc.encode(tgt_segment) + [EOS_ID]
-                app.logger.info("target_segment: " + tgt_segment)
-                app.logger.debug("target_subtokens: " + str(tgt_enc.decode_list(tgt_ids)))
-                app.logger.debug("target_ids: " + str(tgt_ids))
-                tgt_int64_list = feature_pb2.Int64List(value=tgt_ids)
-                tgt_feature = feature_pb2.Feature(int64_list=tgt_int64_list)
-                feature_map["targets"] = tgt_feature
-
-            features = feature_pb2.Features(feature=feature_map)
-            example = example_pb2.Example(features=features)
-
-            b64_example = base64.b64encode(example.SerializeToString()).decode()
-            return {"input": {"b64": b64_example}}
+                tgt_ids = tgt_ids + [EOS_ID]
+                if trace:
+                    request_log.detail("target_segment: %s", tgt_segment)
+                    request_log.detail(
+                        "target_subtokens: %s", tgt_enc.decode_list(tgt_ids)
+                    )
+                    request_log.detail("target_ids: %s", tgt_ids)
+
+            return tf_example.serialize_example(input_ids, tgt_ids)
+
+        batch_ids = encodings.source(pgs)
+        if tgt_pgs:
+            tgt_batch_ids = encodings.target(tgt_pgs)
+        else:
+            tgt_pgs = tgt_batch_ids = itertools.repeat(None)
+        return [
+            serialize_example(segment, input_ids, tgt_segment, tgt_ids)
+            for (segment, input_ids, tgt_segment, tgt_ids) in zip(
+                pgs, batch_ids, tgt_pgs, tgt_batch_ids
+            )
+        ]
 
-        tgt_pgs = tgt_pgs or itertools.repeat(None)
+    @classmethod
+    def package_data(
+        cls,
+        pgs,
+        tgt_pgs=None,
+        signature_name=decoding.DEFAULT_SIGNATURE,
+        encodings=None,
+    ):
+        """ Payload for the RESTful interface of tensorflow_model_server """
         instances = [
-            serialize_to_instance(segment, tgt_segment=tgt_segment)
-            for (segment, tgt_segment) in zip(pgs, tgt_pgs)
+            {"input": {"b64": base64.b64encode(example).decode()}}
+            for example in cls.serialize_examples(pgs, tgt_pgs, encodings)
         ]
-        payload = {"signature_name": "serving_default", "instances": instances}
+        payload = {"signature_name": signature_name, "instances": instances}
         return payload
 
+    @classmethod
+    def package_body(
+        cls,
+        pgs,
+        tgt_pgs=None,
+        signature_name=decoding.DEFAULT_SIGNATURE,
+        encodings=None,
+    ):
+        """ package_data as a JSON request body, written directly from the
+            serialized examples """
+        return tf_example.rest_body(
+            cls.serialize_examples(pgs, tgt_pgs, encodings), signature_name
+        )
+
+    @classmethod
+    def package_tensors(cls, pgs, tgt_pgs=None, encodings=None):
+        """ Input tensors for the gRPC interface of tensorflow_model_server """
+        examples = cls.serialize_examples(pgs, tgt_pgs, encodings)
+        return {"input": grpc_client.string_tensor(examples)}
+
 
 
 class ParsingServer(NnServer):
@@ -231,8 +714,8 @@ class ParsingServer(NnServer):
         and returns a flattened parse tree according
         to the Reynir schema """
 
-    src_enc = text_encoder.SubwordTextEncoder(_ENIS_VOCAB)
-    tgt_enc = CompositeTokenEncoder()
+    src_enc = vocab.LazyEncoder(_subword_text_encoder, _ENIS_VOCAB)
+    tgt_enc = vocab.LazyEncoder(CompositeTokenEncoder)
     _model_name = "parse"
 
 
@@ -240,46 +723,72 @@ class TranslateServer(NnServer):
     """ Client that accepts plain text Icelandic
         and returns an English translation of the text """
 
-    src_enc = text_encoder.SubwordTextEncoder(_ENIS_VOCAB)
+    src_enc = vocab.LazyEncoder(_subword_text_encoder, _ENIS_VOCAB)
     tgt_enc = src_enc
     _model_name = "translate_v2"
+    _cacheable = True
+    _reusable = True
 
 
 class TranslationScoringServer(NnServer):
     """ Client that accepts source and target text and returns
         subword-wise estimate of translation probabilities"""
 
-    src_enc = text_encoder.SubwordTextEncoder(_ENIS_VOCAB)
+    src_enc = vocab.LazyEncoder(_subword_text_encoder, _ENIS_VOCAB)
     tgt_enc = src_enc
     _model_name = "translate_enis16k_v3-scorer"
+    # Exponent of the length penalty ((length + 1) / 6) ** alpha
+    length_penalty_alpha = 0.7
+
+    @classmethod
+    def segment_lengths(cls, pgs, tgt_pgs=None, encodings=None):
+        """ Source plus target length of each pair, since the scorer pads
+            both the inputs and the targets of a batch """
+        if encodings is None:
+            encodings = Encodings(cls)
+        lengths = [cls.encoded_length(ids) for ids in encodings.source(pgs)]
+        if tgt_pgs is not None:
+            lengths = [
+                length + cls.encoded_length(tgt_ids)
+                for (length, tgt_ids) in zip(lengths, encodings.target(tgt_pgs))
+            ]
+        return lengths
+
+    @classmethod
+    def normalized_score(cls, log_probs):
+        """ Sum of the log probabilities divided by the length penalty """
+        penalty = ((len(log_probs) + 1) / 6) ** cls.length_penalty_alpha
+        return sum(log_probs) / penalty
 
     @classmethod
     def extract_results(
         cls, resp_json_obj, pgs, tgt_pgs=None, src_enc=None, tgt_enc=None
     ):
         src_enc = src_enc or cls.src_enc
-        tgt_enc = src_enc or cls.tgt_enc
+        tgt_enc = tgt_enc or cls.tgt_enc
+        trace = request_log.trace()
 
-        def process_response_instance(instance, src_enc=None, tgt_enc=None):
-            # Strip padding and eos token
+        def process_response_instance(instance):
+            # Strip padding, keeping the eos token which is scored too
             output_ids = instance["outputs"]
             length = len(output_ids)
             pad_start = output_ids.index(PAD_ID) if PAD_ID in output_ids else length
             eos_start = output_ids.index(EOS_ID) if EOS_ID in output_ids else length
             sent_end = min(pad_start, eos_start)
-            sent_end_with_eos = sent_end + 1
+            sent_end_with_eos = min(sent_end + 1, length)
 
-            log_probs = instance["scores"]
-            log_probs = log_probs[:sent_end_with_eos]
+            log_probs = instance["scores"][:sent_end_with_eos]
+            score = cls.normalized_score(log_probs)
 
-            alpha = 0.7
-            penalty = ((len(log_probs) + 1) / 6) ** alpha
-            score = sum(log_probs) / penalty
+            if trace:
+                request_log.detail("log_probs: %s", log_probs)
+                request_log.detail("scores: %s", score)
 
-            app.logger.debug("log_probs: " + str(log_probs))
-            app.logger.debug("scores: " + str(score))
-
-            return instance
+            return {
+                "score": score,
+                "log_probs": log_probs,
+                "tokens": tgt_enc.decode_list(output_ids[:sent_end_with_eos]),
+            }
 
         predictions = resp_json_obj["predictions"]
         results = [
@@ -292,11 +801,27 @@ class OpenNMTTranslationServer(NnServer):
     """ Same as TranslateServer, except uses subword-nmt as the encoder
         along with using the OpenNMT model api"""
 
+    _cacheable = True
+
     @classmethod
-    def package_data(cls, pgs, tgt_pgs=None):
-        batch = [
-            cls.src_enc.encode(segment).split() for segment in pgs
+    def encode_segments(cls, pgs, enc=None):
+        """ Subword tokens of each segment """
+        return [
+            encoded.split()
+            for encoded in subword_encoder.encode_batch(enc or cls.src_enc, pgs)
         ]
+
+    @staticmethod
+    def encoded_length(tokens):
+        return len(tokens)
+
+    @classmethod
+    def padded_batch(cls, pgs, encodings=None):
+        """ Subword tokens of each segment, padded to the longest segment,
+            along with the unpadded lengths """
+        if encodings is None:
+            encodings = Encodings(cls)
+        batch = [list(tokens) for tokens in encodings.source(pgs)]
         batch_width = max(len(item) for item in batch)
 
         lengths = []
@@ -307,26 +832,64 @@ class OpenNMTTranslationServer(NnServer):
             lengths.append(length)
             item.extend(padding)
             padded_batch.append(item)
+        return padded_batch, lengths
+
+    @classmethod
+    def package_data(
+        cls,
+        pgs,
+        tgt_pgs=None,
+        signature_name=decoding.DEFAULT_SIGNATURE,
+        encodings=None,
+    ):
+        padded_batch, lengths = cls.padded_batch(pgs, encodings)
 
         instances = [
-            {"tokens":item, "length":len(item)} for item in padded_batch
+            {"tokens": item, "length": length}
+            for (item, length) in zip(padded_batch, lengths)
         ]
 
-        payload = {"signature_name": "serving_default", "instances": instances}
+        payload = {"signature_name": signature_name, "instances": instances}
         return payload
 
+    @classmethod
+    def package_body(
+        cls,
+        pgs,
+        tgt_pgs=None,
+        signature_name=decoding.DEFAULT_SIGNATURE,
+        encodings=None,
+    ):
+        return jsoncodec.dumps(
+            cls.package_data(pgs, tgt_pgs, signature_name, encodings)
+        )
+
+    @classmethod
+    def package_tensors(cls, pgs, tgt_pgs=None, encodings=None):
+        padded_batch, lengths = cls.padded_batch(pgs, encodings)
+        batch_width = len(padded_batch[0]) if padded_batch else 0
+        return {
+            "tokens": grpc_client.string_tensor(
+                [token for item in padded_batch for token in item],
+                dims=[len(padded_batch), batch_width],
+            ),
+            "length": grpc_client.int_tensor(lengths),
+        }
+
     @classmethod
     def extract_results(
         cls, resp_json_obj, pgs, tgt_pgs = None, src_enc = None, tgt_enc = None
     ):
         tgt_enc = tgt_enc or cls.tgt_enc
+        trace = request_log.trace()
 
         def process_response_instance(instance):
             log_probs = instance["log_probs"]
             tokens = instance["tokens"]
 
-            app.logger.debug("log_probs: " + str(log_probs))
-            app.logger.debug("tokens: " + str(tokens))
+            if trace:
+                request_log.detail("log_probs: %s", log_probs)
+                request_log.detail("tokens: %s", tokens)
 
             lengths = instance["length"]
             # strip eos token
@@ -335,12 +898,18 @@ class OpenNMTTranslationServer(NnServer):
                 length = lengths[i]
                 outputs.append(tgt_enc.decode(" ".join(tokens[i][:length])))
 
-            app.logger.info(outputs)
+            if trace:
+                request_log.detail("outputs: %s", outputs)
 
             instance = {
-                "outputs": "\n\n".join(outputs),
+                "outputs": outputs[0] if outputs else "",
                 "scores": log_probs,
             }
+            if len(outputs) > 1:
+                instance["hypotheses"] = [
+                    {"outputs": output, "score": score}
+                    for (output, score) in zip(outputs, log_probs)
+                ]
             return instance
 
         predictions = resp_json_obj["predictions"]
@@ -354,59 +923,356 @@ class OpenNMTTranslationServerEnIs(OpenNMTTranslationServer):
     """ Same as TranslateServer, except uses subword-nmt as the encoder
         along with using the OpenNMT model api"""
 
-    src_enc = _SubwordNmtEncoder(_ONMT_EN_VOCAB)
-    tgt_enc = _SubwordNmtEncoder(_ONMT_IS_VOCAB)
+    src_enc = vocab.LazyEncoder(_SubwordNmtEncoder, _ONMT_EN_VOCAB)
+    tgt_enc = vocab.LazyEncoder(_SubwordNmtEncoder, _ONMT_IS_VOCAB)
     _model_name = "translate_enis16k_v4.onmt-bilstm"
 
 
 class OpenNMTTranslationServerIsEn(OpenNMTTranslationServer):
     """Reverse direction of OpenNMTTranslationServerEnIs"""
 
-    src_enc = _SubwordNmtEncoder(_ONMT_IS_VOCAB)
-    tgt_enc = _SubwordNmtEncoder(_ONMT_EN_VOCAB)
+    src_enc = vocab.LazyEncoder(_SubwordNmtEncoder, _ONMT_IS_VOCAB)
+    tgt_enc = vocab.LazyEncoder(_SubwordNmtEncoder, _ONMT_EN_VOCAB)
     _model_name = "translate_enis16k_v4.onmt-bilstm_rev"
 
 
+def translation_server(obj):
+    """ Server class and model name for the model, source and target
+        of a translate.api request """
+    model_name = MODEL_NAMES[obj["model"]][
+        "{}-{}".format(obj["source"], obj["target"])
+    ]
+    if "lstm" in obj["model"]:
+        onmt_server = OpenNMTTranslationServerIsEn
+        if "en" in obj["source"]:
+            onmt_server = OpenNMTTranslationServerEnIs
+        return onmt_server, model_name
+    return TranslateServer, model_name
+
+
+MODEL_SERVERS = {
+    "parse": (ParsingServer,),
+    "translate": (
+        TranslateServer,
+        TranslationScoringServer,
+        OpenNMTTranslationServerEnIs,
+        OpenNMTTranslationServerIsEn,
+    ),
+}
+
+
+# Routes that use the models of another route
+ROUTE_MODELS = {"score": "translate"}
+
+
+def model_enabled(route):
+    """ Whether the models of a route are served, per --only or
+        NNSERVER_ONLY (all of them by default) """
+    only = app.config.get("only") or os.environ.get("NNSERVER_ONLY")
+    return not only or only == ROUTE_MODELS.get(route, route)
+
+
+def preload():
+    """ Load the vocabularies of the enabled models up front, the others
+        are never loaded """
+    for route, servers in MODEL_SERVERS.items():
+        if model_enabled(route):
+            for server in servers:
+                server.src_enc, server.tgt_enc
+
+
+def request_paragraphs(
+    server,
+    pgs,
+    segment=False,
+    model_name=None,
+    deadline=None,
+    options=None,
+    encodings=None,
+):
+    """ Results for each paragraph in pgs.  With segment, the paragraphs
+        are split into sentences which are sent together as one batch """
+    if not segment:
+        return server.request(
+            pgs,
+            model_name=model_name,
+            deadline=deadline,
+            options=options,
+            encodings=encodings,
+        )
+    sentences, spans = segmentation.split_paragraphs(pgs)
+    results = (
+        server.request(
+            sentences,
+            model_name=model_name,
+            deadline=deadline,
+            options=options,
+            encodings=encodings,
+        )
+        if sentences
+        else []
+    )
+    return segmentation.join_paragraphs(results, spans)
+
+
+def request_paragraphs_stream(
+    server, pgs, segment=False, model_name=None, deadline=None, options=None
+):
+    """ Yield (index, result, sentence index) as results come in, the
+        sentence index being None when paragraphs are not segmented """
+    if not segment:
+        for idx, result in server.request_stream(
+            pgs, model_name=model_name, deadline=deadline, options=options
+        ):
+            yield idx, result, None
+        return
+    sentences, spans = segmentation.split_paragraphs(pgs)
+    index = segmentation.paragraph_index(spans)
+    if sentences:
+        for flat_idx, result in server.request_stream(
+            sentences, model_name=model_name, deadline=deadline, options=options
+        ):
+            pg_idx, sent_idx = index[flat_idx]
+            yield pg_idx, result, sent_idx
+
+
+# Fields of a scoring result that are only returned on request
+_PER_SUBWORD = ("log_probs", "tokens")
+
+
+def score_pairs(pgs, tgt_pgs, log_probs=False, deadline=None, encodings=None):
+    """ Length normalized score of each (source, target) pair, with the
+        log probability of each target subword when log_probs is set """
+    if len(pgs) != len(tgt_pgs):
+        raise ValueError("pgs and tgt_pgs differ in length")
+    results = TranslationScoringServer.request(
+        pgs, tgt_pgs, deadline=deadline, encodings=encodings
+    )
+    if log_probs:
+        return results
+    return [strip_log_probs(result) for result in results]
+
+
+def strip_log_probs(result):
+    """ A scoring result without the per subword log probabilities """
+    return {key: value for (key, value) in result.items() if key not in _PER_SUBWORD}
+
+
+def request_deadline(obj):
+    """ Deadline from the X-Request-Timeout header or the "timeout" field
+        of the request, in seconds """
+    timeout = request.headers.get("X-Request-Timeout")
+    if timeout is None and isinstance(obj, dict):
+        timeout = obj.get("timeout")
+    return admission.deadline_from(timeout)
+
+
+def json_response(obj, status=200):
+    """ Response with obj encoded by the JSON codec """
+    return Response(
+        jsoncodec.dumps(obj),
+        status=status,
+        content_type="application/json; charset=utf-8",
+    )
+
+
+def rejected_response(error):
+    """ Answer to a request that was not admitted """
+    resp = json_response(dict(valid=False, reason=error.reason), error.status)
+    resp.headers["Retry-After"] = str(error.retry_after)
+    return resp
+
+
+def ndjson_record(idx, result, sentence=None):
+    record = {"index": idx, "result": result}
+    if sentence is not None:
+        record["sentence"] = sentence
+    return jsoncodec.dumps(record) + b"\n"
+
+
+def started(records):
+    """ An iterator over records that has already taken the first one,
+        so that the request is admitted (or admission.Rejected raised)
+        before a response starts """
+    records = iter(records)
+    first = next(records, None)
+    if first is None:
+        return iter(())
+    return itertools.chain([first], records)
+
+
+def ndjson_response(records, done=None):
+    """ Streamed response with one JSON line per (index, result, sentence)
+        record, written as soon as the record is available.  done(valid) is
+        called when the stream finishes or the client goes away. """
+
+    def generate():
+        valid = False
+        try:
+            for record in records:
+                yield ndjson_record(*record)
+            valid = True
+        except admission.Rejected as error:
+            yield jsoncodec.dumps(dict(valid=False, reason=error.reason)) + b"\n"
+        except Exception as error:
+            app.logger.exception(error)
+            yield jsoncodec.dumps(dict(valid=False, reason="Invalid request")) + b"\n"
+        finally:
+            if done is not None:
+                done(valid)
+
+    return Response(
+        stream_with_context(generate()),
+        content_type="application/x-ndjson; charset=utf-8",
+    )
+
+
+def stats():
+    return dict(
+        pool=http_pool.get_pool().stats(),
+        replicas=balancer.get_balancer().stats(),
+        batching=batching.get_batcher().stats.as_dict(),
+        cache=cache.get_cache().stats(),
+        bucketing=bucketing.get_bucketer().stats(),
+        vocabularies=vocab.loaded(),
+        admission=admission.get_controller().stats(),
+        translation_memory=translation_memory.get_memory().stats(),
+    )
+
+
+def log_request(route, request_id, start, pgs, valid):
+    request_log.summary(
+        "request",
+        id=request_id,
+        route=route,
+        segments=len(pgs) if pgs else 0,
+        chars=sum(len(segment) for segment in pgs) if pgs else 0,
+        ms=round(1000 * (time.perf_counter() - start), 2),
+        valid=valid,
+    )
+
+
 @app.route("/parse.api", methods=["POST"])
 def parse_api():
+    if not model_enabled("parse"):
+        return json_response(dict(valid=False, reason="Model not enabled"), 404)
+    request_id = request.headers.get("X-Request-Id") or new_request_id()
+    start = time.perf_counter()
+    pgs = None
+    valid = True
     try:
-        req_body = request.data.decode("utf-8")
-        obj = json.loads(req_body)
+        obj = jsoncodec.loads(request.get_data())
         # TODO: validate form?
         pgs = obj["pgs"]
-        model_response = ParsingServer.request(pgs)
-        resp = jsonify(model_response)
+        model_response = request_paragraphs(
+            ParsingServer, pgs, segmentation.enabled(obj), deadline=request_deadline(obj)
+        )
+        resp = json_response(model_response)
+    except admission.Rejected as error:
+        resp = rejected_response(error)
+        valid = False
     except Exception as error:
-        resp = jsonify(valid=False, reason="Invalid request")
+        resp = json_response(dict(valid=False, reason="Invalid request"))
         app.logger.exception(error)
-    resp.headers["Content-Type"] = "application/json; charset=utf-8"
+        valid = False
+    log_request("parse", request_id, start, pgs, valid)
     return resp
 
 
 @app.route("/translate.api", methods=["POST"])
 def translate_api():
+    if not model_enabled("translate"):
+        return json_response(dict(valid=False, reason="Model not enabled"), 404)
+    request_id = request.headers.get("X-Request-Id") or new_request_id()
+    start = time.perf_counter()
+    pgs = None
+    valid = True
     try:
-        req_body = request.data.decode("utf-8")
-        obj = json.loads(req_body)
+        obj = jsoncodec.loads(request.get_data())
         pgs = obj["pgs"]
-        model_name = MODEL_NAMES[obj["model"]][
-            "{}-{}".format(obj["source"], obj["target"])
-        ]
-        if "lstm" in obj["model"]:
-            onmt_server = OpenNMTTranslationServerIsEn
-            if "en" in obj["source"]:
-                onmt_server = OpenNMTTranslationServerEnIs
-            model_response = onmt_server.request(pgs, model_name=model_name)
-        else:
-            model_response = TranslateServer.request(pgs, model_name=model_name)
-        resp = jsonify(model_response)
+        server, model_name = translation_server(obj)
+        segment = segmentation.enabled(obj)
+        deadline = request_deadline(obj)
+        options = decoding.options_from(obj)
+        if obj.get("stream"):
+            return ndjson_response(
+                started(
+                    request_paragraphs_stream(
+                        server,
+                        pgs,
+                        segment,
+                        model_name=model_name,
+                        deadline=deadline,
+                        options=options,
+                    )
+                ),
+                done=functools.partial(
+                    log_request, "translate", request_id, start, pgs
+                ),
+            )
+        model_response = request_paragraphs(
+            server,
+            pgs,
+            segment,
+            model_name=model_name,
+            deadline=deadline,
+            options=options,
+        )
+        resp = json_response(model_response)
+    except decoding.InvalidOptions as error:
+        resp = json_response(dict(valid=False, reason=error.reason), 400)
+        valid = False
+    except admission.Rejected as error:
+        resp = rejected_response(error)
+        valid = False
     except Exception as error:
-        resp = jsonify(valid=False, reason="Invalid request")
+        resp = json_response(dict(valid=False, reason="Invalid request"))
         app.logger.exception(error)
-    resp.headers["Content-Type"] = "application/json; charset=utf-8"
+        valid = False
+    log_request("translate", request_id, start, pgs, valid)
     return resp
 
 
+@app.route("/score.api", methods=["POST"])
+def score_api():
+    if not model_enabled("score"):
+        return json_response(dict(valid=False, reason="Model not enabled"), 404)
+    request_id = request.headers.get("X-Request-Id") or new_request_id()
+    start = time.perf_counter()
+    pgs = None
+    valid = True
+    try:
+        obj = jsoncodec.loads(request.get_data())
+        pgs = obj["pgs"]
+        model_response = score_pairs(
+            pgs,
+            obj["tgt_pgs"],
+            log_probs=bool(obj.get("log_probs")),
+            deadline=request_deadline(obj),
+        )
+        resp = json_response(model_response)
+    except admission.Rejected as error:
+        resp = rejected_response(error)
+        valid = False
+    except Exception as error:
+        resp = json_response(dict(valid=False, reason="Invalid request"))
+        app.logger.exception(error)
+        valid = False
+    log_request("score", request_id, start, pgs, valid)
+    return resp
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_api():
+    content_type, body = metrics.render()
+    return Response(body, content_type=content_type)
+
+
+@app.route("/stats.api", methods=["GET"])
+def stats_api():
+    return json_response(stats())
+
+
 if __name__ == "__main__":
     import argparse
 
@@ -466,9 +1332,308 @@ if __name__ == "__main__":
         required=False,
         type=str,
         choices=["parse", "translate"],
-        help="Only use one model (otherwise both).",
+        help="Only serve and load one model (otherwise both).",
+    )
+    parser.add_argument(
+        "--pool_size",
+        dest="POOL_SIZE",
+        default=None,
+        required=False,
+        type=int,
+        help="Max keep-alive connections per model server (per worker)",
+    )
+    parser.add_argument(
+        "--connect_timeout",
+        dest="CONNECT_TIMEOUT",
+        default=None,
+        required=False,
+        type=float,
+        help="Seconds to wait for a model server connection",
+    )
+    parser.add_argument(
+        "--read_timeout",
+        dest="READ_TIMEOUT",
+        default=None,
+        required=False,
+        type=float,
+        help="Seconds to wait for a model server response",
+    )
+    parser.add_argument(
+        "--retries",
+        dest="RETRIES",
+        default=None,
+        required=False,
+        type=int,
+        help="Retries (with backoff) on failed model server calls",
+    )
+    parser.add_argument(
+        "--batch_size",
+        dest="BATCH_SIZE",
+        default=None,
+        required=False,
+        type=int,
+        help="Max segments merged into one model server call",
+    )
+    parser.add_argument(
+        "--batch_wait",
+        dest="BATCH_WAIT",
+        default=None,
+        required=False,
+        type=float,
+        help="Max milliseconds to hold a segment for batching (0 disables)",
+    )
+    parser.add_argument(
+        "--cache_size",
+        dest="CACHE_SIZE",
+        default=None,
+        required=False,
+        type=int,
+        help="Max cached translated segments (0 disables the cache)",
+    )
+    parser.add_argument(
+        "--cache_ttl",
+        dest="CACHE_TTL",
+        default=None,
+        required=False,
+        type=float,
+        help="Seconds a cached translation stays valid (0 for no expiry)",
+    )
+    parser.add_argument(
+        "--cache_path",
+        dest="CACHE_PATH",
+        default=None,
+        required=False,
+        type=str,
+        help="SQLite file for a segment cache shared between workers",
+    )
+    parser.add_argument(
+        "--bucket_tokens",
+        dest="BUCKET_TOKENS",
+        default=None,
+        required=False,
+        type=int,
+        help="Padded token budget per length bucketed sub-batch (0 disables)",
+    )
+    parser.add_argument(
+        "--dispatch_workers",
+        dest="DISPATCH_WORKERS",
+        default=None,
+        required=False,
+        type=int,
+        help="Max concurrent model server calls for one large request",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        dest="CHUNK_SIZE",
+        default=None,
+        required=False,
+        type=int,
+        help="Max segments per model server call",
+    )
+    parser.add_argument(
+        "--transport",
+        dest="TRANSPORT",
+        default="rest",
+        required=False,
+        type=str,
+        choices=["rest", "grpc"],
+        help="Protocol for model server calls (gRPC needs tensorflow-serving-api)",
+    )
+    parser.add_argument(
+        "-mg",
+        "--model_grpc_port",
+        dest="OUT_GRPC_PORT",
+        default="8500",
+        required=False,
+        type=str,
+        help="gRPC port of model server",
+    )
+    parser.add_argument(
+        "--model_servers",
+        dest="MODEL_SERVERS",
+        default=None,
+        required=False,
+        type=str,
+        help="Comma separated host:port[:grpc_port] replicas of the model server",
+    )
+    parser.add_argument(
+        "--balance",
+        dest="BALANCE",
+        default=None,
+        required=False,
+        type=str,
+        choices=[balancer.POWER_OF_TWO, balancer.LEAST_OUTSTANDING],
+        help="Replica choice: power of two random choices or least outstanding",
+    )
+    parser.add_argument(
+        "--health_interval",
+        dest="HEALTH_INTERVAL",
+        default=None,
+        required=False,
+        type=float,
+        help="Seconds between replica status checks (0 disables)",
+    )
+    parser.add_argument(
+        "--health_timeout",
+        dest="HEALTH_TIMEOUT",
+        default=None,
+        required=False,
+        type=float,
+        help="Seconds before a replica status check counts as failed",
+    )
+    parser.add_argument(
+        "--beam_signatures",
+        dest="BEAM_SIGNATURES",
+        default=None,
+        required=False,
+        type=str,
+        help='Model server signature per beam size, e.g. \'{"1": "greedy"}\'',
+    )
+    parser.add_argument(
+        "--max_n_best",
+        dest="MAX_N_BEST",
+        default=None,
+        required=False,
+        type=int,
+        help="Most hypotheses a request may ask for",
+    )
+    parser.add_argument(
+        "--max_decode_length",
+        dest="MAX_DECODE_LENGTH",
+        default=None,
+        required=False,
+        type=int,
+        help="Longest segment in subword tokens sent to the model (0 for no cap)",
+    )
+    parser.add_argument(
+        "--tm_size",
+        dest="TM_SIZE",
+        default=None,
+        required=False,
+        type=int,
+        help="Translated segments kept for near duplicate reuse (0 disables)",
+    )
+    parser.add_argument(
+        "--tm_similarity",
+        dest="TM_SIMILARITY",
+        default=None,
+        required=False,
+        type=float,
+        help="Fraction of tokens a segment must share with a remembered one",
+    )
+    parser.add_argument(
+        "--max_inflight_segments",
+        dest="MAX_INFLIGHT_SEGMENTS",
+        default=None,
+        required=False,
+        type=int,
+        help="Segments in flight per model before requests wait (0 disables)",
+    )
+    parser.add_argument(
+        "--max_inflight_tokens",
+        dest="MAX_INFLIGHT_TOKENS",
+        default=None,
+        required=False,
+        type=int,
+        help="Subword tokens in flight per model before requests wait (0 disables)",
+    )
+    parser.add_argument(
+        "--admission_queue",
+        dest="ADMISSION_QUEUE",
+        default=None,
+        required=False,
+        type=int,
+        help="Requests waiting per model before new ones get 429",
+    )
+    parser.add_argument(
+        "--admission_wait",
+        dest="ADMISSION_WAIT",
+        default=None,
+        required=False,
+        type=float,
+        help="Milliseconds a request may wait for admission before it gets 503",
+    )
+    parser.add_argument(
+        "--asgi",
+        dest="ASGI",
+        default=False,
+        action="store_true",
+        required=False,
+        help="Serve with the asyncio (ASGI) app under uvicorn instead of Flask",
+    )
+    parser.add_argument(
+        "--log_sample_rate",
+        dest="LOG_SAMPLE_RATE",
+        default=None,
+        required=False,
+        type=float,
+        help="Fraction of batches whose per segment details are logged at DEBUG",
     )
     args = parser.parse_args()
+    request_log.sample_rate = (
+        args.LOG_SAMPLE_RATE
+        if args.LOG_SAMPLE_RATE is not None
+        else request_log.sample_rate
+    )
+    dispatch.configure(max_workers=args.DISPATCH_WORKERS, chunk_size=args.CHUNK_SIZE)
+    bucketing.configure(max_tokens=args.BUCKET_TOKENS)
+    cache.configure(
+        max_size=args.CACHE_SIZE, ttl=args.CACHE_TTL, path=args.CACHE_PATH
+    )
+    batching.configure(max_batch_size=args.BATCH_SIZE, max_wait_ms=args.BATCH_WAIT)
+    http_pool.configure(
+        pool_size=args.POOL_SIZE,
+        connect_timeout=args.CONNECT_TIMEOUT,
+        read_timeout=args.READ_TIMEOUT,
+        retries=args.RETRIES,
+    )
+    balancer.configure(
+        endpoints=(
+            balancer.parse_endpoints(args.MODEL_SERVERS)
+            if args.MODEL_SERVERS
+            else None
+        ),
+        strategy=args.BALANCE,
+        check_interval=args.HEALTH_INTERVAL,
+        check_timeout=args.HEALTH_TIMEOUT,
+    )
+    decoding.configure(
+        signatures=(
+            jsoncodec.loads(args.BEAM_SIGNATURES) if args.BEAM_SIGNATURES else None
+        ),
+        max_n_best=args.MAX_N_BEST,
+        max_length=args.MAX_DECODE_LENGTH,
+    )
+    translation_memory.configure(
+        max_size=args.TM_SIZE, min_similarity=args.TM_SIMILARITY
+    )
+    admission.configure(
+        max_segments=args.MAX_INFLIGHT_SEGMENTS,
+        max_tokens=args.MAX_INFLIGHT_TOKENS,
+        max_queue=args.ADMISSION_QUEUE,
+        max_wait_ms=args.ADMISSION_WAIT,
+    )
     app.config["out_host"] = args.OUT_HOST
     app.config["out_port"] = args.OUT_PORT
-    app.run(threaded=True, debug=args.DEBUG, host=args.IN_HOST, port=args.IN_PORT)
+    app.config["out_grpc_port"] = args.OUT_GRPC_PORT
+    app.config["transport"] = args.TRANSPORT
+    app.config["only"] = args.ONLY
+    if args.TRANSPORT == "grpc" and not grpc_client.available():
+        app.logger.warning("tensorflow-serving-api not installed, using REST")
+    if args.ASGI:
+        import uvicorn
+        from nnserver import asgi
+
+        # asgi imports this file as nnserver.main, which has its own app
+        asgi.main.app.config.update(app.config)
+        asgi.client = asgi.ModelServerClient(http_pool.get_pool().config)
+        asgi.main.preload()
+        uvicorn.run(
+            asgi.app,
+            host=args.IN_HOST,
+            port=int(args.IN_PORT),
+            log_level="debug" if args.DEBUG else "info",
+        )
+    else:
+        preload()
+        app.run(threaded=True, debug=args.DEBUG, host=args.IN_HOST, port=args.IN_PORT)
@@ -0,0 +1,138 @@
+"""
+    Reynir: Natural language processing for Icelandic
+
+    Prometheus metrics
+
+    Copyright (C) 2020 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    Per stage latency histograms (encode, model_server, decode), segment,
+    token and error counts and batch sizes, labelled by model name and
+    served in the Prometheus text format on /metrics.
+
+    Under gunicorn, set PROMETHEUS_MULTIPROC_DIR to an empty directory so
+    that every worker writes its samples there and /metrics aggregates
+    over all of them, and load this module as gunicorn config so that
+    samples of dead workers are cleaned up:
+
+    gunicorn -c python:nnserver.metrics main:app
+
+    Requires the optional prometheus_client package, without it all
+    instrumentation is a no-op.
+
+"""
+
+import os
+import time
+from contextlib import contextmanager
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+STAGES = ("encode", "model_server", "decode")
+
+_LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+    120, 300,
+)
+_BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+if prometheus_client is not None:
+    STAGE_SECONDS = prometheus_client.Histogram(
+        "nnserver_stage_seconds",
+        "Time spent per request stage",
+        ["model", "stage"],
+        buckets=_LATENCY_BUCKETS,
+    )
+    SEGMENTS = prometheus_client.Counter(
+        "nnserver_segments_total", "Segments sent to the model server", ["model"]
+    )
+    TOKENS = prometheus_client.Counter(
+        "nnserver_tokens_total", "Subword tokens sent to the model server", ["model"]
+    )
+    BATCH_SEGMENTS = prometheus_client.Histogram(
+        "nnserver_batch_segments",
+        "Segments per model server call",
+        ["model"],
+        buckets=_BATCH_BUCKETS,
+    )
+    ERRORS = prometheus_client.Counter(
+        "nnserver_errors_total", "Failed request stages", ["model", "stage"]
+    )
+
+
+def enabled():
+    return prometheus_client is not None
+
+
+@contextmanager
+def timed(stage, model):
+    """ Record the duration of a stage, and count it as an error if it
+        raises """
+    if prometheus_client is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        ERRORS.labels(model, stage).inc()
+        raise
+    finally:
+        STAGE_SECONDS.labels(model, stage).observe(time.perf_counter() - start)
+
+
+def observe_segments(model, lengths):
+    """ Count segments and tokens of a request """
+    if prometheus_client is None:
+        return
+    SEGMENTS.labels(model).inc(len(lengths))
+    TOKENS.labels(model).inc(sum(lengths))
+
+
+def observe_batch(model, size):
+    if prometheus_client is None:
+        return
+    BATCH_SEGMENTS.labels(model).observe(size)
+
+
+def render():
+    """ Content type and body for the /metrics endpoint, aggregated over
+        all worker processes in multiprocess mode """
+    if prometheus_client is None:
+        return "text/plain; charset=utf-8", b"# prometheus_client not installed\n"
+    if _multiprocess_dir():
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return prometheus_client.CONTENT_TYPE_LATEST, prometheus_client.generate_latest(
+        registry
+    )
+
+
+def _multiprocess_dir():
+    return os.environ.get(
+        "PROMETHEUS_MULTIPROC_DIR", os.environ.get("prometheus_multiproc_dir")
+    )
+
+
+def child_exit(server, worker):
+    """ gunicorn hook, drops the live gauges of a worker that exited """
+    if prometheus_client is not None and _multiprocess_dir():
+        multiprocess.mark_process_dead(worker.pid)
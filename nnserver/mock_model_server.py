@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+    Reynir: Natural language processing for Icelandic
+
+    Stand-in for tensorflow_model_server
+
+    Copyright (C) 2020 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    Answers the RESTful :predict calls of nnserver with canned results
+    after a configurable latency, so that the middleware can be load
+    tested without GPUs or exported models.  tensor2tensor style
+    instances get the canned "outputs" ids and "scores", which for the
+    scoring model hold one log probability per output id; OpenNMT style
+    instances, which carry "tokens", get their own tokens back with
+    "length" and "log_probs".
+    GET /v1/models/<name> reports every model AVAILABLE.
+
+    Example usage:
+    python -m nnserver.mock_model_server --port 9000 --latency_ms 20 \
+        --per_segment_ms 0.5
+
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# "This is a test." in the translation vocabulary, and EOS
+TRANSLATE_OUTPUTS = [248, 34, 10, 285, 27, 1]
+# A one word parse tree in the CompositeTokenEncoder vocabulary, and EOS
+PARSE_OUTPUTS = [51, 47, 36, 54, 172, 190, 183, 191, 120, 102, 113, 117, 1]
+
+
+class MockConfig:
+    """ Latency and canned results of the stand-in model server """
+
+    def __init__(
+        self,
+        latency_ms=10.0,
+        per_segment_ms=0.0,
+        jitter_ms=0.0,
+        outputs=None,
+        parse_outputs=None,
+        score=-1.5,
+        error_rate=0.0,
+    ):
+        self.latency_ms = latency_ms
+        self.per_segment_ms = per_segment_ms
+        self.jitter_ms = jitter_ms
+        self.outputs = outputs or TRANSLATE_OUTPUTS
+        self.parse_outputs = parse_outputs or PARSE_OUTPUTS
+        self.score = score
+        self.error_rate = error_rate
+
+    def delay(self, num_instances):
+        """ Seconds to wait before answering a batch """
+        delay_ms = self.latency_ms + self.per_segment_ms * num_instances
+        if self.jitter_ms:
+            delay_ms += random.uniform(0, self.jitter_ms)
+        return delay_ms / 1000.0
+
+    def prediction(self, model_name, instance):
+        if "tokens" in instance:
+            tokens = [token for token in instance["tokens"] if token]
+            return {
+                "tokens": [tokens],
+                "length": [len(tokens)],
+                "log_probs": [self.score],
+            }
+        outputs = self.parse_outputs if model_name == "parse" else self.outputs
+        if model_name.endswith("-scorer"):
+            return {"outputs": outputs, "scores": [self.score] * len(outputs)}
+        return {
+            "outputs": outputs,
+            "scores": self.score,
+            "log_probs": [self.score / len(outputs)] * len(outputs),
+        }
+
+
+def _handler(config):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, status, obj):
+            body = json.dumps(obj).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            version_status = [{"version": "1", "state": "AVAILABLE"}]
+            self._reply(200, {"model_version_status": version_status})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            instances = payload.get("instances", [])
+            time.sleep(config.delay(len(instances)))
+            if config.error_rate and random.random() < config.error_rate:
+                self._reply(503, {"error": "Injected failure"})
+                return
+            model_name = self.path.rsplit("/", 1)[-1].split(":")[0]
+            predictions = [
+                config.prediction(model_name, instance) for instance in instances
+            ]
+            self._reply(200, {"predictions": predictions})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(host="localhost", port=0, config=None):
+    """ Start the stand-in in a daemon thread and return the server, whose
+        server_address holds the bound port """
+    server = ThreadingHTTPServer((host, port), _handler(config or MockConfig()))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stand-in tensorflow_model_server")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency_ms", type=float, default=10.0)
+    parser.add_argument("--per_segment_ms", type=float, default=0.0)
+    parser.add_argument("--jitter_ms", type=float, default=0.0)
+    parser.add_argument(
+        "--outputs", default=None, help="JSON list of canned translation ids"
+    )
+    parser.add_argument(
+        "--parse_outputs", default=None, help="JSON list of canned parse ids"
+    )
+    parser.add_argument("--score", type=float, default=-1.5)
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    args = parser.parse_args(argv)
+
+    config = MockConfig(
+        latency_ms=args.latency_ms,
+        per_segment_ms=args.per_segment_ms,
+        jitter_ms=args.jitter_ms,
+        outputs=json.loads(args.outputs) if args.outputs else None,
+        parse_outputs=json.loads(args.parse_outputs) if args.parse_outputs else None,
+        score=args.score,
+        error_rate=args.error_rate,
+    )
+    server = ThreadingHTTPServer((args.host, args.port), _handler(config))
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
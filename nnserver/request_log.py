@@ -0,0 +1,76 @@
+"""
+    Reynir: Natural language processing for Icelandic
+
+    Request logging
+
+    Copyright (C) 2020 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    Logging that stays off the hot path: per segment details (ids,
+    subtokens, outputs) are only formatted at DEBUG level and for a
+    sampled fraction of batches, while every request and model server
+    call gets a single summary record with ids, lengths and timings,
+    rendered as JSON only when the record is actually emitted.
+
+"""
+
+import json
+import logging
+import os
+import random
+import uuid
+
+
+class _Fields:
+    """ Log argument that is serialized to JSON only when formatted """
+
+    __slots__ = ("fields",)
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __str__(self):
+        return json.dumps(self.fields, ensure_ascii=False, default=str)
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+
+class RequestLog:
+    """ Sampled, level guarded detail logging and summary records """
+
+    def __init__(self, logger, sample_rate=None):
+        self.logger = logger
+        self.sample_rate = float(
+            sample_rate
+            if sample_rate is not None
+            else os.environ.get("NNSERVER_LOG_SAMPLE_RATE", 1.0)
+        )
+
+    def trace(self):
+        """ Whether per segment details should be logged for this batch """
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return False
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def detail(self, msg, *args):
+        """ Per segment detail, callers check trace() before building args """
+        self.logger.debug(msg, *args)
+
+    def summary(self, kind, **fields):
+        """ One structured record per request or model server call """
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info("%s %s", kind, _Fields(fields))
@@ -0,0 +1,104 @@
+"""
+    Reynir: Natural language processing for Icelandic
+
+    Sentence segmentation of input paragraphs
+
+    Copyright (C) 2020 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    Model cost grows faster than linearly with segment length, and quality
+    drops for inputs longer than those seen in training.  This module
+    splits each paragraph of a request into sentences with the tokenizer
+    package, so that the sentences of all paragraphs can be sent as one
+    batch of short segments, and stitches the sentence results back into
+    one result per paragraph.
+
+"""
+
+import os
+
+import tokenizer
+from tokenizer import TOK
+
+from nnserver.dispatch import is_error_result
+
+
+def enabled(obj):
+    """ Whether a request asks for segmentation, defaulting to the
+        NNSERVER_SEGMENT environment variable """
+    default = os.environ.get("NNSERVER_SEGMENT", "0").lower() in ("1", "true", "yes")
+    return bool(obj.get("segment", default))
+
+
+def split_sentences(paragraph):
+    """ Sentences of a paragraph, with the spacing of normal text, as
+        delimited by the sentence begin and end tokens of the tokenizer """
+    sentences = []
+    words = []
+    for token in tokenizer.tokenize(paragraph):
+        if token.kind == TOK.S_BEGIN:
+            words = []
+        elif token.kind == TOK.S_END:
+            if words:
+                sentences.append(tokenizer.correct_spaces(" ".join(words)))
+            words = []
+        elif token.txt:
+            words.append(token.txt)
+    if words:
+        sentences.append(tokenizer.correct_spaces(" ".join(words)))
+    return sentences
+
+
+def split_paragraphs(pgs):
+    """ Flat list of the sentences of all paragraphs, along with the
+        (start, end) range of each paragraph in that list """
+    sentences = []
+    spans = []
+    for paragraph in pgs:
+        start = len(sentences)
+        sentences.extend(split_sentences(paragraph))
+        spans.append((start, len(sentences)))
+    return sentences, spans
+
+
+def paragraph_index(spans):
+    """ Map from position in the flat sentence list to
+        (paragraph index, sentence index within the paragraph) """
+    index = {}
+    for pg_idx, (start, end) in enumerate(spans):
+        for flat_idx in range(start, end):
+            index[flat_idx] = (pg_idx, flat_idx - start)
+    return index
+
+
+def join_paragraphs(results, spans):
+    """ One result per paragraph from the per sentence results: the
+        sentence outputs joined with spaces, the sentence scores in a list
+        and the full sentence results under "sentences" """
+    paragraphs = []
+    for start, end in spans:
+        sentence_results = results[start:end]
+        errors = [result for result in sentence_results if is_error_result(result)]
+        if errors:
+            paragraphs.append(errors[0])
+            continue
+        paragraphs.append(
+            {
+                "outputs": " ".join(result["outputs"] for result in sentence_results),
+                "scores": [result.get("scores") for result in sentence_results],
+                "sentences": sentence_results,
+            }
+        )
+    return paragraphs
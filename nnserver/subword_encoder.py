@@ -0,0 +1,108 @@
+"""
+    Reynir: Natural language processing for Icelandic
+
+    Batched front-end for the tensor2tensor subword encoder
+
+    Copyright (C) 2020 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    SubwordTextEncoder.encode classifies every character of a segment in
+    Python to split it into tokens, and then looks up each token in a
+    direct mapped cache that evicts on hash collisions.  This front-end
+    splits segments with a single regular expression over the same
+    alphanumeric characters, encodes each distinct token of a whole
+    batch once, and keeps the token -> subtoken ids mapping in a bounded
+    cache shared across requests.  Ids are identical to those of the
+    wrapped encoder.
+
+"""
+
+import os
+import re
+
+WORD_CACHE_SIZE = 1 << 18
+
+# Without the underscore, \w matches exactly the characters for which
+# str.isalnum() holds, the Unicode letter and number categories that make
+# up tokenizer._ALPHANUMERIC_CHAR_SET
+_TOKEN_RE = re.compile(r"[^\W_]+|[\W_]+")
+
+
+def tokenize(text):
+    """ Same tokens as tokenizer.encode: maximal alphanumeric and
+        non-alphanumeric runs, dropping single spaces between words """
+    if not text:
+        return []
+    runs = _TOKEN_RE.findall(text)
+    if len(runs) < 3:
+        return runs
+    tokens = [runs[0]]
+    tokens.extend(run for run in runs[1:-1] if run != " ")
+    tokens.append(runs[-1])
+    return tokens
+
+
+class BatchSubwordEncoder:
+    """ Wraps a SubwordTextEncoder with batched, cached encoding; every
+        other attribute is that of the wrapped encoder """
+
+    def __init__(self, encoder, cache_size=None):
+        self.encoder = encoder
+        self.cache_size = int(
+            cache_size
+            if cache_size is not None
+            else os.environ.get("NNSERVER_WORD_CACHE_SIZE", WORD_CACHE_SIZE)
+        )
+        # Token -> tuple of subtoken ids, bounded by cache_size entries
+        self._cache = {}
+
+    def __getattr__(self, name):
+        return getattr(self.encoder, name)
+
+    def encode(self, s):
+        return self.encode_batch([s])[0]
+
+    def encode_batch(self, segments):
+        """ Subtoken ids of each segment, encoding each distinct token of
+            the batch once """
+        token_lists = [
+            tokenize(segment.decode("utf-8") if isinstance(segment, bytes) else segment)
+            for segment in segments
+        ]
+        cache = self._cache
+        computed = {}
+        batch = []
+        for tokens in token_lists:
+            ids = []
+            for token in tokens:
+                token_ids = cache.get(token)
+                if token_ids is None:
+                    token_ids = computed.get(token)
+                if token_ids is None:
+                    token_ids = tuple(self.encoder._token_to_subtoken_ids(token))
+                    if len(cache) < self.cache_size:
+                        cache[token] = token_ids
+                    else:
+                        computed[token] = token_ids
+                ids.extend(token_ids)
+            batch.append(ids)
+        return batch
+
+
+def encode_batch(encoder, segments):
+    """ Subtoken ids of each segment, batched if the encoder supports it """
+    if hasattr(encoder, "encode_batch"):
+        return encoder.encode_batch(segments)
+    return [encoder.encode(segment) for segment in segments]
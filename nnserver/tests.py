@@ -1,16 +1,425 @@
+from nnserver import _PARSING_VOCAB
 from nnserver.composite_encoder import CompositeTokenEncoder
 
 
-def test_roundtrip(sample=None):
+def test_roundtrip(sample=None, default_encoder=None):
     if sample is None:
         sample = "P S-MAIN IP NP-SUBJ pfn_et_nf_p3 /NP-SUBJ /IP /S-MAIN /P"
-    default_encoder = CompositeTokenEncoder()
+    if default_encoder is None:
+        default_encoder = CompositeTokenEncoder()
     subtoken_ids = default_encoder.encode(sample)
     decoded_sample = default_encoder.decode(subtoken_ids)
     assert sample == decoded_sample, "Encoding roundtrip does not match, {} - {}".format(sample, decoded_sample)
 
 
 def test_file(infile):
+    default_encoder = CompositeTokenEncoder(warm_path=_PARSING_VOCAB)
     o = open(infile)
     for line in o:
-        test_roundtrip(line.strip())
+        test_roundtrip(line.strip(), default_encoder)
+
+
+def test_memoized_encode():
+    sample = "P S-MAIN IP NP-SUBJ so_1_þf_et_fh_gm_p3_þt /NP-SUBJ /IP /S-MAIN /P"
+    memoized = CompositeTokenEncoder(warm_path=_PARSING_VOCAB)
+    uncached = CompositeTokenEncoder(memo_size=0)
+    expected = uncached.encode(sample)
+    assert memoized.encode(sample) == expected
+    assert all(token in memoized._memo for token in sample.split(" "))
+
+    def recompute(token):
+        raise AssertionError("{} was not memoized".format(token))
+
+    memoized._compute_subtoken_ids = recompute
+    assert memoized.encode(sample) == expected
+    assert not uncached._memo
+
+
+def test_segment_cache():
+    from nnserver.cache import SegmentCache
+
+    fetched = []
+
+    def fetch(segments):
+        fetched.append(list(segments))
+        return [{"outputs": segment.upper()} for segment in segments]
+
+    segment_cache = SegmentCache(max_size=2, ttl=0, path="")
+    first = segment_cache.lookup("model", ["a b", "a  b", "c"], fetch)
+    second = segment_cache.lookup("model", ["c", "d"], fetch)
+    assert [r["outputs"] for r in first] == ["A B", "A B", "C"]
+    assert [r["outputs"] for r in second] == ["C", "D"]
+    assert fetched == [["a b", "c"], ["d"]], fetched
+
+
+def test_decode_batch():
+    sample = "P S-MAIN IP NP-SUBJ pfn_et_nf_p3 /NP-SUBJ /IP /S-MAIN /P"
+    default_encoder = CompositeTokenEncoder()
+    rows = [default_encoder.encode(sample), default_encoder.encode("P /P"), []]
+    expected = [default_encoder.decode(row) for row in rows]
+    assert default_encoder.decode_batch(rows) == expected
+    padded = [rows[1] + [1, 0, 0]]
+    assert default_encoder.decode_batch(padded, strip_eos=True) == ["P /P"]
+
+
+def test_circuit_breaker():
+    from nnserver.balancer import Balancer, NoReplicaAvailable
+
+    replica_balancer = Balancer(
+        endpoints=[("a", "1")], failure_threshold=2, cooldown=60, check_interval=0
+    )
+    replica, trial = replica_balancer.choose("model", None, None)
+    assert not trial
+    for _ in range(2):
+        try:
+            with replica.track():
+                raise ConnectionRefusedError("model server down")
+        except ConnectionRefusedError:
+            pass
+    try:
+        replica_balancer.choose("model", None, None)
+    except NoReplicaAvailable:
+        pass
+    else:
+        assert False, "Replica with open circuit was chosen"
+    # A request sent before the circuit opened, failing during the trial
+    # with an error that is not the replica's fault
+    late = replica.track()
+    late.__enter__()
+    replica.opened_at -= 60
+    chosen, trial = replica_balancer.choose("model", None, None)
+    assert chosen is replica and trial
+    error = ValueError("Invalid response")
+    assert not late.__exit__(ValueError, error, None)
+    try:
+        replica_balancer.choose("model", None, None)
+    except NoReplicaAvailable:
+        pass
+    else:
+        assert False, "Second trial of a half open circuit was chosen"
+    with replica.track(trial=trial):
+        pass
+    assert replica.state == "closed" and replica.outstanding == 0
+
+
+def test_replica_failures():
+    import requests
+    from nnserver.balancer import is_replica_failure
+
+    def http_error(status):
+        response = requests.Response()
+        response.status_code = status
+        return requests.HTTPError(response=response)
+
+    assert not is_replica_failure(http_error(400))
+    assert is_replica_failure(http_error(503))
+    assert is_replica_failure(requests.ConnectionError())
+    assert is_replica_failure(requests.ConnectTimeout(), own_timeout=False)
+    assert is_replica_failure(requests.ReadTimeout())
+    assert not is_replica_failure(requests.ReadTimeout(), own_timeout=False)
+    assert not is_replica_failure(ValueError("malformed reply"))
+
+
+def test_subword_encode_batch():
+    from tensor2tensor.data_generators import text_encoder
+    from nnserver import _ENIS_VOCAB
+    from nnserver.subword_encoder import BatchSubwordEncoder
+
+    segments = [
+        "Hæ, þetta er próf á íslensku.",
+        "Verð: 1.000 kr.  (_undir_ \\ 3,5 km) — 日本語",
+        "",
+        " a b ",
+        "Hæ, þetta er próf á íslensku.",
+    ]
+    encoder = text_encoder.SubwordTextEncoder(_ENIS_VOCAB)
+    batched = BatchSubwordEncoder(text_encoder.SubwordTextEncoder(_ENIS_VOCAB))
+    expected = [encoder.encode(segment) for segment in segments]
+    assert batched.encode_batch(segments) == expected
+    assert [batched.encode(segment) for segment in segments] == expected
+
+
+def test_bpe_parity():
+    from subword_nmt import apply_bpe
+    from nnserver import _ONMT_EN_VOCAB, _ONMT_IS_VOCAB
+    from nnserver.bpe import BytePairEncoder
+
+    lines = [
+        "Hello world , this is a test .",
+        "  Ég sá 3.000 hunda í gær  og   kött \n",
+        "supercalifragilisticexpialidocious @@ __ \\ 日本語",
+        "a",
+        "",
+        "\n",
+    ]
+    for path in (_ONMT_EN_VOCAB, _ONMT_IS_VOCAB):
+        with open(path, "r") as fp:
+            reference = apply_bpe.BPE(fp)
+        encoder = BytePairEncoder(path)
+        expected = [reference.process_line(line) for line in lines]
+        assert encoder.process_lines(lines) == expected
+        assert encoder.process_lines(lines) == expected
+
+
+def test_admission():
+    import threading
+    import time
+    from nnserver.admission import AdmissionController, Rejected, deadline_from
+
+    controller = AdmissionController(
+        max_segments=4, max_tokens=0, max_queue=1, max_wait_ms=50
+    )
+    with controller.admit("model", 4, 40):
+        errors = []
+
+        def wait_in_line():
+            try:
+                with controller.admit("model", 1, 10):
+                    pass
+            except Rejected as error:
+                errors.append(error.status)
+
+        waiter = threading.Thread(target=wait_in_line)
+        waiter.start()
+        time.sleep(0.01)
+        try:
+            with controller.admit("model", 1, 10):
+                pass
+        except Rejected as error:
+            assert error.status == 429
+        else:
+            assert False, "Request admitted past a full queue"
+        waiter.join()
+        assert errors == [503], errors
+    with controller.admit("model", 1, 10):
+        pass
+    try:
+        with controller.admit("model", 1, 10, deadline=deadline_from(-1)):
+            pass
+    except Rejected as error:
+        assert error.reason == "Deadline exceeded"
+    else:
+        assert False, "Request admitted past its deadline"
+    stats = controller.stats()["model"]
+    assert stats["inflight_segments"] == 0 and stats["rejected"] == 1
+
+
+def test_admission_async():
+    import asyncio
+    import threading
+    import time
+    from nnserver.admission import AdmissionController
+
+    controller = AdmissionController(
+        max_segments=1, max_tokens=0, max_queue=4, max_wait_ms=2000
+    )
+    order = []
+
+    async def request(name):
+        async with controller.admit_async("model", 1, 10):
+            order.append(name)
+            await asyncio.sleep(0.01)
+
+    async def requests_in_line():
+        await asyncio.gather(request("a"), request("b"), request("c"))
+
+    asyncio.run(requests_in_line())
+    assert order == ["a", "b", "c"], order
+
+    # A release on another thread wakes the waiting coroutine
+    held = threading.Event()
+
+    def hold():
+        with controller.admit("model", 1, 10):
+            held.set()
+            time.sleep(0.05)
+
+    async def wait_for_room():
+        holder = threading.Thread(target=hold)
+        holder.start()
+        await asyncio.get_running_loop().run_in_executor(None, held.wait)
+        start = time.monotonic()
+        async with controller.admit_async("model", 1, 10):
+            waited = time.monotonic() - start
+        holder.join()
+        return waited
+
+    assert asyncio.run(wait_for_room()) < 1.0
+    assert controller.stats()["model"]["inflight_segments"] == 0
+
+
+def test_translation_memory():
+    from nnserver.cache import SegmentCache
+    from nnserver.translation_memory import TranslationMemory
+
+    translations = {
+        "Fundurinn hefst klukkan 14 í sal 3 á morgun.": (
+            "The meeting starts at 14 in room 3 tomorrow."
+        ),
+        "Verðið er 1.500 kr. fyrir hvern miða.": "The price is ISK 1,500 per ticket.",
+    }
+    fetched = []
+
+    def fetch(segments):
+        fetched.extend(segments)
+        return [
+            {"outputs": translations.get(segment, ""), "scores": -1.5}
+            for segment in segments
+        ]
+
+    memory = TranslationMemory(max_size=10)
+    memory.lookup("model", list(translations), fetch)
+    results = memory.lookup(
+        "model",
+        [
+            "Fundurinn hefst klukkan 16 í sal 7 á morgun.",
+            "Verðið er 2.000 kr. fyrir hvern miða.",
+        ],
+        fetch,
+    )
+    assert results[0] == {
+        "outputs": "The meeting starts at 16 in room 7 tomorrow.",
+        "scores": None,
+        "reused": True,
+    }
+    # The amount was reformatted in the translation, so it goes to the model
+    assert fetched[-1] == "Verðið er 2.000 kr. fyrir hvern miða."
+    assert memory.stats()["skipped_model_calls"] == 1
+
+    # Reused results are not cached as if the model made them
+    segment_cache = SegmentCache(max_size=10, ttl=0, path="")
+    segment = "Fundurinn hefst klukkan 18 í sal 2 á morgun."
+    segment_cache.lookup(
+        "model", [segment], lambda segments: memory.lookup("model", segments, fetch)
+    )
+    assert segment_cache.stats()["entries"] == 0
+
+
+def test_tf_example():
+    import base64
+    import json
+    from tensorflow.core.example import example_pb2, feature_pb2
+    from nnserver import tf_example
+
+    def reference(input_ids, target_ids=None):
+        feature_map = {
+            "inputs": feature_pb2.Feature(
+                int64_list=feature_pb2.Int64List(value=input_ids)
+            )
+        }
+        if target_ids is not None:
+            feature_map["targets"] = feature_pb2.Feature(
+                int64_list=feature_pb2.Int64List(value=target_ids)
+            )
+        features = feature_pb2.Features(feature=feature_map)
+        return example_pb2.Example(features=features).SerializeToString(
+            deterministic=True
+        )
+
+    rows = [([248, 34, 10, 1], None), ([5, 127, 128, 16383, 16384, 1], [7, 1]), ([], [])]
+    for input_ids, target_ids in rows:
+        expected = reference(input_ids, target_ids)
+        assert tf_example.serialize_example(input_ids, target_ids) == expected
+    examples = [reference(input_ids) for (input_ids, _) in rows]
+    payload = {
+        "signature_name": "serving_default",
+        "instances": [
+            {"input": {"b64": base64.b64encode(example).decode()}}
+            for example in examples
+        ],
+    }
+    assert tf_example.rest_body(examples) == json.dumps(payload).encode()
+    payload = {"signature_name": 'beam "4"', "instances": []}
+    assert tf_example.rest_body([], 'beam "4"') == json.dumps(payload).encode()
+
+
+def test_jsoncodec():
+    from nnserver import jsoncodec
+
+    obj = {"predictions": [{"outputs": [248, 34, 1], "scores": -1.5}], "á": "þýðing"}
+    body = jsoncodec.dumps(obj)
+    assert isinstance(body, bytes)
+    assert jsoncodec.loads(body) == obj
+    assert jsoncodec.loads(body.decode("utf-8")) == obj
+
+
+def test_decode_options():
+    from nnserver import decoding
+
+    config = decoding.DecodingConfig(
+        signatures={"1": "greedy", "4": "serving_default"}, max_n_best=4, max_length=200
+    )
+    assert config.options({}) == decoding.DecodeOptions(None, None, 200)
+    options = config.options({"beam_size": 4, "n_best": 2, "max_length": 500})
+    assert options == decoding.DecodeOptions(4, 2, 200)
+    assert not options.default
+    assert config.signature(options) == "serving_default"
+    assert config.signature(config.options({"beam_size": 1})) == "greedy"
+    for obj in ({"beam_size": 2}, {"n_best": 5}, {"beam_size": 1, "n_best": 2}, {"n_best": 0}):
+        try:
+            config.options(obj)
+        except decoding.InvalidOptions:
+            continue
+        raise AssertionError("Accepted {}".format(obj))
+    assert config.options({"n_best": 3}).n_best == 3
+    beams_only = decoding.DecodingConfig(signatures={"4": "beam4"}, max_n_best=4)
+    try:
+        beams_only.options({"n_best": 2})
+    except decoding.InvalidOptions:
+        pass
+    else:
+        raise AssertionError("Accepted n_best without beams")
+
+    hypotheses = [{"outputs": "a", "score": -0.1}, {"outputs": "b", "score": -0.2}]
+    results = [{"outputs": "a", "scores": -0.1, "hypotheses": list(hypotheses)}]
+    decoding.select(results, options._replace(n_best=1))
+    assert results == [{"outputs": "a", "scores": -0.1}]
+
+
+def test_score_results():
+    from nnserver.main import EOS_ID, PAD_ID, TranslationScoringServer, strip_log_probs
+
+    class Subwords:
+        def decode_list(self, ids):
+            return ["<EOS>" if idx == EOS_ID else "w{}".format(idx) for idx in ids]
+
+    predictions = [
+        {"outputs": [5, 6, EOS_ID, PAD_ID], "scores": [-0.5, -1.0, -0.25, 0.0]},
+        {"outputs": [7, EOS_ID], "scores": [-2.0, -0.5]},
+    ]
+    results = TranslationScoringServer.extract_results(
+        {"predictions": predictions}, ["a b", "c"], ["x y", "z"], tgt_enc=Subwords()
+    )
+    assert results[0]["log_probs"] == [-0.5, -1.0, -0.25]
+    assert results[0]["tokens"] == ["w5", "w6", "<EOS>"]
+    assert results[0]["score"] == -1.75 / (4 / 6) ** 0.7
+    assert results[1]["score"] == TranslationScoringServer.normalized_score([-2.0, -0.5])
+    assert strip_log_probs(results[1]) == {"score": results[1]["score"]}
+
+
+def test_encodings():
+    from nnserver.main import Encodings, TranslateServer
+
+    calls = []
+
+    class Counting(TranslateServer):
+        @classmethod
+        def encode_segments(cls, pgs, enc=None):
+            calls.extend(pgs)
+            return [[len(word) for word in segment.split()] for segment in pgs]
+
+    encodings = Encodings(Counting)
+    pgs = ["Halló heimur", "Góðan dag", "Halló heimur"]
+    assert Counting.segment_lengths(pgs, encodings=encodings) == [3, 3, 3]
+    Counting.serialize_examples(pgs, encodings=encodings)
+    assert calls == ["Halló heimur", "Góðan dag"]
+    assert encodings.tokens() == 6
+
+
+def test_segmentation():
+    from nnserver import segmentation
+
+    pgs = ["Fundurinn hefst kl. 14 í dag. Hvað segirðu?", "", "Já!"]
+    sentences, spans = segmentation.split_paragraphs(pgs)
+    assert sentences == ["Fundurinn hefst kl. 14 í dag.", "Hvað segirðu?", "Já!"]
+    assert spans == [(0, 2), (2, 2), (2, 3)]
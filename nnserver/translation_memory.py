@@ -0,0 +1,301 @@
+"""
+    Reynir: Natural language processing for Icelandic
+
+    Translation memory for near duplicate segments
+
+    Copyright (C) 2020 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    Much of the traffic repeats a template sentence with a different
+    number, date, amount or name.  The segment cache only catches exact
+    repeats; this module remembers translated segments that contain
+    placeholder tokens (as classified by the tokenizer package) and
+    indexes them by their template, the token sequence with each
+    placeholder replaced by its token kind.
+
+    A new segment with the same template as a remembered one, at least
+    min_similarity of its tokens equal to it and at least min_tokens
+    tokens, gets the remembered translation with the differing
+    placeholders substituted.  Only the changed part of a placeholder is
+    replaced ("14" in "klukkan 14"), and only when it occurs exactly once
+    in the remembered translation, so a number that the model reformatted
+    or a name that it inflected sends the segment to the model as before.
+    Such a result has "scores" null and "reused" true, since the scores
+    and hypotheses of the remembered segment do not belong to the new
+    one, and it is not put in the segment cache.
+
+"""
+
+import asyncio
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import tokenizer
+from tokenizer import TOK
+
+from nnserver.dispatch import is_error_result
+
+# Token kinds that are copied into a translation as they are, those that
+# the installed tokenizer version does not have are skipped
+_PLACEHOLDER_NAMES = (
+    "NUMBER",
+    "NUMWLETTER",
+    "PERCENT",
+    "ORDINAL",
+    "YEAR",
+    "DATE",
+    "DATEABS",
+    "DATEREL",
+    "TIME",
+    "TIMESTAMP",
+    "TIMESTAMPABS",
+    "TIMESTAMPREL",
+    "AMOUNT",
+    "MEASUREMENT",
+    "TELNO",
+    "SSN",
+    "SERIALNUMBER",
+    "URL",
+    "DOMAIN",
+    "EMAIL",
+    "HASHTAG",
+    "USERNAME",
+    "MOLECULE",
+    "PERSON",
+    "ENTITY",
+    "COMPANY",
+)
+PLACEHOLDER_KINDS = frozenset(
+    getattr(TOK, name) for name in _PLACEHOLDER_NAMES if hasattr(TOK, name)
+)
+
+# Remembered segments per template, most recent first
+_PER_TEMPLATE = 4
+
+_PIECE_RE = re.compile(r"\w+|[^\w\s]+|\s+")
+
+
+def analyze(segment):
+    """ (template, token texts, placeholder positions) of a segment """
+    template = []
+    texts = []
+    positions = []
+    for token in tokenizer.tokenize(segment):
+        if not token.txt:
+            continue
+        if token.kind in PLACEHOLDER_KINDS:
+            positions.append(len(texts))
+            template.append("\x00{}".format(token.kind))
+        else:
+            template.append(token.txt)
+        texts.append(token.txt)
+    return "\x01".join(template), texts, positions
+
+
+def changed_span(old, new):
+    """ The differing middle of two placeholder texts, without the pieces
+        they share, so that "klukkan 14" -> "klukkan 16" becomes
+        "14" -> "16" """
+    old_pieces = _PIECE_RE.findall(old)
+    new_pieces = _PIECE_RE.findall(new)
+    start = 0
+    while (
+        start < min(len(old_pieces), len(new_pieces))
+        and old_pieces[start] == new_pieces[start]
+    ):
+        start += 1
+    end = 0
+    while (
+        end < min(len(old_pieces), len(new_pieces)) - start
+        and old_pieces[-1 - end] == new_pieces[-1 - end]
+    ):
+        end += 1
+    old_core = "".join(old_pieces[start : len(old_pieces) - end]).strip()
+    new_core = "".join(new_pieces[start : len(new_pieces) - end]).strip()
+    return old_core, new_core
+
+
+def substitute(translation, replacements):
+    """ translation with each (old, new) text replaced, or None if an old
+        text does not occur exactly once as a whole token """
+    spans = []
+    for old, new in replacements:
+        matches = list(
+            re.finditer(r"(?<!\w){}(?!\w)".format(re.escape(old)), translation)
+        )
+        if len(matches) != 1:
+            return None
+        spans.append((matches[0].start(), matches[0].end(), new))
+    spans.sort()
+    if any(prev[1] > cur[0] for prev, cur in zip(spans, spans[1:])):
+        return None
+    for start, end, new in reversed(spans):
+        translation = translation[:start] + new + translation[end:]
+    return translation
+
+
+class TranslationMemory:
+    """ Bounded memory of translated segments with placeholders, keyed by
+        (model name, template) and evicted least recently used first """
+
+    def __init__(self, max_size=None, min_similarity=None, min_tokens=None):
+        env = os.environ.get
+        self.max_size = int(
+            max_size if max_size is not None else env("NNSERVER_TM_SIZE", 0)
+        )
+        self.min_similarity = float(
+            min_similarity
+            if min_similarity is not None
+            else env("NNSERVER_TM_MIN_SIMILARITY", 0.75)
+        )
+        self.min_tokens = int(
+            min_tokens if min_tokens is not None else env("NNSERVER_TM_MIN_TOKENS", 4)
+        )
+        self._lock = threading.Lock()
+        self._templates = OrderedDict()
+        self._entries = 0
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def _match(self, model_name, analysis):
+        """ Translated result for an analyzed segment, or None """
+        template, texts, positions = analysis
+        if not positions or len(texts) < self.min_tokens:
+            return None
+        with self._lock:
+            candidates = self._templates.get((model_name, template))
+            if candidates is None:
+                return None
+            self._templates.move_to_end((model_name, template))
+            candidates = list(candidates)
+
+        best = None
+        for old_texts, translation in candidates:
+            changed = [pos for pos in positions if old_texts[pos] != texts[pos]]
+            similarity = 1.0 - len(changed) / len(texts)
+            if similarity >= self.min_similarity and (
+                best is None or similarity > best[0]
+            ):
+                best = (similarity, changed, old_texts, translation)
+        if best is None:
+            return None
+        _, changed, old_texts, translation = best
+        replacements = [changed_span(old_texts[pos], texts[pos]) for pos in changed]
+        if len({old for (old, _) in replacements}) != len(replacements):
+            return None
+        outputs = None
+        if all(old and new for (old, new) in replacements):
+            outputs = substitute(translation, replacements)
+        if outputs is None:
+            with self._lock:
+                self.rejected += 1
+            return None
+        return {"outputs": outputs, "scores": None, "reused": True}
+
+    def _remember(self, model_name, analysis, result):
+        template, texts, positions = analysis
+        if (
+            not positions
+            or len(texts) < self.min_tokens
+            or is_error_result(result)
+            or not isinstance(result.get("outputs"), str)
+        ):
+            return
+        key = (model_name, template)
+        entry = (texts, result["outputs"])
+        with self._lock:
+            candidates = self._templates.pop(key, [])
+            self._entries -= len(candidates)
+            candidates = [entry] + [
+                candidate for candidate in candidates if candidate[0] != texts
+            ]
+            candidates = candidates[:_PER_TEMPLATE]
+            self._templates[key] = candidates
+            self._entries += len(candidates)
+            while self._entries > self.max_size and self._templates:
+                _, evicted = self._templates.popitem(last=False)
+                self._entries -= len(evicted)
+
+    def _partition(self, model_name, pgs):
+        analyses = [analyze(segment) for segment in pgs]
+        results = [self._match(model_name, analysis) for analysis in analyses]
+        missing = [idx for (idx, result) in enumerate(results) if result is None]
+        with self._lock:
+            self.hits += len(pgs) - len(missing)
+            self.misses += len(missing)
+        return analyses, results, missing
+
+    def _store(self, model_name, analyses, results, missing, fetched):
+        for idx, result in zip(missing, fetched):
+            self._remember(model_name, analyses[idx], result)
+            results[idx] = result
+        return results
+
+    def lookup(self, model_name, pgs, fetch):
+        """ Return one result per segment in pgs, calling fetch(segments)
+            only for segments that the memory cannot translate """
+        analyses, results, missing = self._partition(model_name, pgs)
+        fetched = fetch([pgs[idx] for idx in missing]) if missing else []
+        return self._store(model_name, analyses, results, missing, fetched)
+
+    async def lookup_async(self, model_name, pgs, fetch):
+        """ Same as lookup, for a coroutine function fetch, with the
+            tokenizing in the default executor """
+        loop = asyncio.get_running_loop()
+        analyses, results, missing = await loop.run_in_executor(
+            None, self._partition, model_name, pgs
+        )
+        fetched = await fetch([pgs[idx] for idx in missing]) if missing else []
+        return self._store(model_name, analyses, results, missing, fetched)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "templates": len(self._templates),
+                "entries": self._entries,
+                "skipped_model_calls": self.hits,
+                "misses": self.misses,
+                "rejected": self.rejected,
+            }
+
+
+_MEMORY = None
+_MEMORY_LOCK = threading.Lock()
+
+
+def get_memory():
+    """ Return the process wide translation memory """
+    global _MEMORY
+    if _MEMORY is None:
+        with _MEMORY_LOCK:
+            if _MEMORY is None:
+                _MEMORY = TranslationMemory()
+    return _MEMORY
+
+
+def configure(**kwargs):
+    """ Replace the process wide translation memory """
+    global _MEMORY
+    with _MEMORY_LOCK:
+        _MEMORY = TranslationMemory(**kwargs)
+    return _MEMORY
@@ -0,0 +1,68 @@
+"""
+    Reynir: Natural language processing for Icelandic
+
+    Shared, lazily loaded vocabularies
+
+    Copyright (C) 2020 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    The encoders of the server classes are class attributes.  Building
+    them when the class is defined loads every vocabulary in every worker,
+    once per class even where classes use the same file.  LazyEncoder
+    defers loading to the first access and hands out one encoder per
+    loader and vocabulary file in a process, so models that are never
+    used are never loaded.
+
+"""
+
+import os
+import threading
+
+_ENCODERS = {}
+_ENCODERS_LOCK = threading.Lock()
+
+
+def shared(loader, path=None):
+    """ The process wide encoder built by loader(path), or loader() if
+        path is None """
+    key = (loader, path and os.path.realpath(path))
+    encoder = _ENCODERS.get(key)
+    if encoder is None:
+        with _ENCODERS_LOCK:
+            encoder = _ENCODERS.get(key)
+            if encoder is None:
+                encoder = loader() if path is None else loader(path)
+                _ENCODERS[key] = encoder
+    return encoder
+
+
+class LazyEncoder:
+    """ Class attribute that evaluates to the shared encoder of a
+        vocabulary, loading it on first access """
+
+    def __init__(self, loader, path=None):
+        self.loader = loader
+        self.path = path
+
+    def __get__(self, obj, owner=None):
+        return shared(self.loader, self.path)
+
+
+def loaded():
+    """ Vocabulary files loaded in this process """
+    with _ENCODERS_LOCK:
+        return sorted(
+            os.path.basename(path) for (_, path) in _ENCODERS if path is not None
+        )
@@ -35,15 +35,17 @@ setup(
         "Topic :: Scientific/Engineering :: Artificial Intelligence",
     ],
     packages=find_packages(),
-    scripts=["nnserver/bin/nnserver"],
+    scripts=["nnserver/bin/nnserver", "nnserver/bin/nnserver-batch"],
     package_data={"nnserver": ["resources/*"]},
     install_requires=[
         'gevent<=1.4',
         "flask",
+        "requests",
         "tensorflow<3",
         "tensor2tensor",
         "reynir==1.3.1",
         "tokenizer==1.0.8",
         "subword-nmt",
     ],
+    extras_require={"asgi": ["aiohttp", "uvicorn"]},
 )